@@ -0,0 +1,161 @@
+# Async entry point
+# An ASGI app for running the API on an async server, e.g.
+#   uvicorn --factory asgi:create_asgi_app --workers 4
+# The read-heavy GET routes of events, posts and users (async_views) are
+# answered on the event loop and read through async SQLAlchemy (asyncpg on
+# PostgreSQL, aiosqlite on SQLite). While one of them waits on the database
+# the worker carries on with the others, so a worker serves as many of them
+# at once as its pool has connections, instead of one per thread.
+# They call the same functions as the Flask routes, with the async
+# session, and build the ETag from the same tables, so the responses are
+# the same. Every other request is passed to the Flask app from create_app
+# on ASGI_THREADS threads, and so are the ones the async routes leave to it: streamed (NDJSON) responses and requests without a
+# valid access token, so their errors are the same too.
+# The async routes read from the primary database, not the read replicas,
+# and are not counted in the request metrics or Server-Timing header.
+
+# Built-in Python Libraries
+import os
+
+# External Libraries
+from a2wsgi import WSGIMiddleware
+from flask import request
+from flask_jwt_extended import verify_jwt_in_request
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+# Imports from local files
+from main import create_app
+import db_settings
+from utils import conditional_response, wants_stream
+
+# Define a function to list the routes answered by the async app: endpoint
+# of the Flask route, and the function the route calls, run here with the
+# async session's sync session. The ETag is built from the same tables as
+# the route's conditional_get
+
+
+def async_views():
+    # Imported here, like the blueprints in create_app, once the app has
+    # loaded every model
+    from controllers.event_controller import list_events, read_event
+    from controllers.post_controller import list_posts, read_post
+    from controllers.user_controller import list_users, read_user
+    return {
+        "events.get_all_events": list_events,
+        "events.get_single_event": read_event,
+        "posts.get_all_posts": list_posts,
+        "posts.get_single_post": read_post,
+        "user.get_users": list_users,
+        "user.get_user": read_user
+    }
+
+# Define a function to build the WSGI environ of an ASGI HTTP request,
+# for a Flask request context. GET requests have no body to read
+
+
+def request_environ(scope):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    return EnvironBuilder(
+        path=scope["path"],
+        base_url=(f"{scope.get('scheme', 'http')}://{server[0]}:{server[1]}"
+                  f"{scope.get('root_path', '')}"),
+        query_string=scope["query_string"].decode("latin-1"),
+        method=scope["method"],
+        headers=[(name.decode("latin-1"), value.decode("latin-1"))
+                 for name, value in scope["headers"]],
+        environ_base={"REMOTE_ADDR": client[0]}
+    ).get_environ()
+
+# Define a function to answer a request for one of the async views, run with
+# AsyncSession.run_sync so every query is awaited on the event loop.
+# Returns the Flask response, or None to leave the request to the Flask app
+
+
+def answer(session, flask_app, views, environ):
+    with flask_app.request_context(environ):
+        try:
+            # Protect the route with JWT authentication
+            verify_jwt_in_request()
+        except Exception:
+            return None
+        # NDJSON is streamed from the Flask routes
+        if wants_stream():
+            return None
+        view = views[request.endpoint]
+        tables = flask_app.view_functions[request.endpoint].versioned_tables
+        return conditional_response(
+            tables, lambda: view(**request.view_args, session=session),
+            session)
+
+# Define a function to send a Flask response to an ASGI client
+
+
+async def send_response(send, response):
+    await send({
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response.headers.to_wsgi_list()]
+    })
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+# Define a function to answer the server's startup and shutdown messages,
+# closing the async engine's connections on shutdown
+
+
+async def lifespan(receive, send, engine):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await engine.dispose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# Define a function to create the ASGI app, around the Flask app from
+# create_app unless one is given
+
+
+def create_asgi_app(flask_app=None):
+    flask_app = flask_app or create_app()
+    views = async_views()
+    # Threads running the Flask app for the requests the async routes do
+    # not answer, each one may hold a database connection from its own pool
+    flask_app.config["ASGI_THREADS"] = int(
+        os.environ.get("ASGI_THREADS") or 10)
+    # The same database through its async driver, with the same pool and
+    # statement timeout settings (see db_settings.py)
+    uri = flask_app.config["SQLALCHEMY_DATABASE_URI"]
+    engine = create_async_engine(db_settings.async_database_url(uri),
+                                 **db_settings.async_engine_options(uri))
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    flask_wsgi = WSGIMiddleware(flask_app,
+                                workers=flask_app.config["ASGI_THREADS"])
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await lifespan(receive, send, engine)
+        if scope["type"] == "http" and scope["method"] == "GET":
+            # Find the Flask route of the URL, redirects and errors are
+            # left to Flask
+            try:
+                endpoint, _ = flask_app.url_map.bind(
+                    "", script_name=scope.get("root_path") or None).match(
+                    scope["path"], method="GET")
+            except HTTPException:
+                endpoint = None
+            if endpoint in views:
+                async with sessions() as session:
+                    response = await session.run_sync(
+                        answer, flask_app, views, request_environ(scope))
+                if response is not None:
+                    return await send_response(send, response)
+        await flask_wsgi(scope, receive, send)
+
+    # Keep the engine reachable, e.g. for the benchmark to close it
+    app.engine = engine
+    return app
@@ -0,0 +1,259 @@
+# Benchmark of one server worker answering the read-heavy routes through
+# the Flask app (sync) and through the async entry point (asgi.py).
+# A database is seeded with generated data (see seed_data.py), then at each
+# concurrency level that many clients call the routes in async_views over
+# and over for a while. The sync worker answers on --threads threads, like
+# a threaded WSGI worker, the async worker on its event loop. Requests per
+# second and latency percentiles are printed for both.
+# Both are first checked to give the same responses for the same requests.
+# Run from the project root with 'python -m benchmarks.async_benchmark'
+# e.g. 'python -m benchmarks.async_benchmark --size 1000
+# --concurrency 1,10,50,200 --threads 8 --output async.json'
+# The difference shows when the database is a server (PostgreSQL) that
+# requests wait on. Uses DATABASE_URL if it is set, otherwise a temporary
+# SQLite file.
+# WARNING: the tables in the database are dropped and recreated.
+
+# Built-in Python Libraries
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+
+# External Libraries
+from flask_jwt_extended import create_access_token
+
+# Imports from local files
+from init import db
+from models.user import User
+from models.post import Post
+from models.event import Event
+from asgi import create_asgi_app
+from benchmarks.endpoint_benchmark import build_app, volumes
+
+# Define a function to pick the paths to call, a listing and a single row
+# for each of the async routes
+
+
+def paths(app):
+    with app.app_context():
+        event_id = db.session.scalar(db.select(Event.id).order_by(Event.id))
+        post_id = db.session.scalar(db.select(Post.id).order_by(Post.id))
+        user_id = db.session.scalar(db.select(User.id).order_by(User.id))
+    return ["/events/", f"/events/{event_id}", "/posts/", f"/posts/{post_id}",
+            "/user/", f"/user/{user_id}"]
+
+# Constants
+# Response headers that must be the same from both workers
+COMPARED_HEADERS = ("content-type", "etag", "last-modified", "cache-control",
+                    "vary")
+
+# Define a function to call the ASGI app once, returns the status code,
+# headers (lower case names) and body
+
+
+async def call_asgi(asgi_app, path, headers):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app({
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path":
+        path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers.items()],
+        "server": ("localhost", 80), "client": ("127.0.0.1", 0)
+    }, receive, send)
+    status = next(message["status"] for message in messages
+                  if message["type"] == "http.response.start")
+    headers = next({name.decode("latin-1"): value.decode("latin-1")
+                    for name, value in message["headers"]}
+                   for message in messages
+                   if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages
+                    if message["type"] == "http.response.body")
+    return status, headers, body
+
+# Define a function to check the async app answers like the Flask app,
+# with the same status, COMPARED_HEADERS and body. Also checks an
+# If-None-Match request gets the same 304 from both.
+# Returns the paths whose responses differ
+
+
+async def check_same(app, asgi_app, urls, headers):
+    client = app.test_client()
+    different = []
+    try:
+        for path in urls:
+            response = client.get(path, headers=headers)
+            status, async_headers, body = await call_asgi(
+                asgi_app, path, headers)
+            expected = {name: response.headers.get(name)
+                        for name in COMPARED_HEADERS}
+            answered = {name: async_headers.get(name)
+                        for name in COMPARED_HEADERS}
+            if ((status, answered, json.loads(body))
+                    != (response.status_code, expected, response.get_json())):
+                different.append(path)
+                continue
+            # The ETag must give a 304 on the async worker too
+            status, _, _ = await call_asgi(asgi_app, path, {
+                **headers, "If-None-Match": response.headers["ETag"]})
+            if status != 304:
+                different.append(path)
+    finally:
+        # Connections belong to this event loop, close them with it
+        await asgi_app.engine.dispose()
+    return different
+
+# Define a function to run 'concurrency' clients for 'duration' seconds,
+# each calling the next path as soon as its last request is answered.
+# 'request' is a coroutine function making one request for a path.
+# Returns the requests per second, latency percentiles and errors
+
+
+async def run_clients(request, urls, concurrency, duration):
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client(offset):
+        nonlocal errors
+        index = offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status = await request(urls[index % len(urls)])
+            latencies.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors += 1
+            index += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(offset) for offset in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(quantiles[49], 2),
+        "p95_ms": round(quantiles[94], 2),
+        "p99_ms": round(quantiles[98], 2),
+        "errors": errors
+    }
+
+# Define a function to benchmark the sync worker, a Flask app answering on
+# 'threads' threads
+
+
+def run_sync(app, urls, headers, concurrency, duration, threads):
+    local = threading.local()
+
+    # Each thread keeps its own test client
+    def call(path):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        return local.client.get(path, headers=headers).status_code
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        async def request(path):
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, call, path)
+        return asyncio.run(run_clients(request, urls, concurrency, duration))
+
+# Define a function to benchmark the async worker, the ASGI app answering
+# on one event loop
+
+
+def run_async(asgi_app, urls, headers, concurrency, duration):
+    async def request(path):
+        status, _, _ = await call_asgi(asgi_app, path, headers)
+        return status
+
+    async def run():
+        try:
+            return await run_clients(request, urls, concurrency, duration)
+        finally:
+            # Connections belong to this event loop, close them with it
+            await asgi_app.engine.dispose()
+    return asyncio.run(run())
+
+# Define the benchmark, writes the results to a JSON file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark one sync and one async worker on the read "
+        "routes")
+    parser.add_argument("--size", type=int, default=1000,
+                        help="number of users to seed (default: 1000)")
+    parser.add_argument("--concurrency", default="1,10,50,200",
+                        help="comma separated numbers of clients at once "
+                        "(default: 1,10,50,200)")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads of the sync worker (default: 8)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds each level runs for (default: 10)")
+    parser.add_argument("--output", default="async_benchmark_results.json",
+                        help="file to write the results to "
+                        "(default: async_benchmark_results.json)")
+    args = parser.parse_args(argv)
+
+    app = build_app(args.size)
+    asgi_app = create_asgi_app(app)
+    with app.app_context():
+        admin_id = db.session.scalar(
+            db.select(User.id).filter_by(is_admin=True).order_by(User.id))
+        headers = {"Authorization": "Bearer " + create_access_token(
+            identity=str(admin_id))}
+    urls = paths(app)
+
+    different = asyncio.run(check_same(app, asgi_app, urls, headers))
+    if different:
+        print(f"Responses differ for: {', '.join(different)}")
+        return 1
+
+    results = {}
+    print(f"{'clients':>8} {'worker':>6} {'req/s':>9} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        results[str(concurrency)] = {
+            "sync": run_sync(app, urls, headers, concurrency, args.duration,
+                             args.threads),
+            "async": run_async(asgi_app, urls, headers, concurrency,
+                               args.duration)
+        }
+        for worker, result in results[str(concurrency)].items():
+            print(f"{concurrency:>8} {worker:>6} "
+                  f"{result['requests_per_second']:>9} {result['p50_ms']:>8} "
+                  f"{result['p95_ms']:>8} {result['p99_ms']:>8} "
+                  f"{result['errors']:>7}")
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "database": os.environ["DATABASE_URL"].split(":", 1)[0],
+            "python": platform.python_version(),
+            "threads": args.threads,
+            "duration": args.duration,
+            "volumes": volumes(args.size),
+            "results": results
+        }, file, indent=2)
+    print(f"\nResults written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# Benchmark comparing one POST per record with the bulk routes for
+# attending, likes and invoices.
+# Run from the project root with 'python -m benchmarks.bulk_benchmark'
+# Optional argument: number of records per batch, e.g.
+# 'python -m benchmarks.bulk_benchmark 1000'
+# Uses DATABASE_URL if it is set, otherwise a temporary SQLite file.
+# WARNING: the tables in the database are dropped and recreated.
+
+# Built-in Python Libraries
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+
+# Use a throwaway SQLite database unless one was given
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(), "bulk_benchmark.db"))
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+
+# External Libraries
+from flask_jwt_extended import create_access_token
+
+# Imports from local files
+from main import create_app
+from init import db
+from models.user import User
+from models.post import Post
+from models.event import Event
+from models.attending import Attending
+
+# Define a function to create the users, an event and a post for each run
+# and an attendee to attach invoices to. Returns the ids and tokens
+
+
+def setup(app, records):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Users do not log in, so a placeholder password is enough
+        users = [User(name=f"User {i}", user_name=f"user{i}",
+                      email=f"user{i}@email.com", password="x",
+                      is_admin=i == 0)
+                 for i in range(records)]
+        db.session.add_all(users)
+        events = [Event(title=f"Event {i}", date=date.today(),
+                        ticket_price=10.0, user=users[0]) for i in range(3)]
+        posts = [Post(title=f"post {i}", content="post", date=date.today(),
+                      user=users[0]) for i in range(2)]
+        db.session.add_all(events + posts)
+        db.session.flush()
+        attendee = Attending(total_tickets=1, seat_section="Section A",
+                             timestamp=date.today(), event=events[2],
+                             user=users[0])
+        db.session.add(attendee)
+        db.session.commit()
+        tokens = [create_access_token(identity=str(user.id)) for user in users]
+        return {
+            "user_ids": [user.id for user in users],
+            "event_ids": [event.id for event in events],
+            "post_ids": [post.id for post in posts],
+            "attendee": (events[2].id, attendee.id),
+            "tokens": tokens
+        }
+
+# Define a function to time a function, returns its result and seconds taken
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+# Define the benchmark, prints the records per second of each approach
+
+
+def main(records=1000):
+    app = create_app()
+    data = setup(app, records)
+    client = app.test_client()
+    tokens, user_ids = data["tokens"], data["user_ids"]
+    admin = {"Authorization": f"Bearer {tokens[0]}"}
+
+    # Each case is (name, one POST per record, one bulk POST)
+    single_event, bulk_event, _ = data["event_ids"]
+    single_post, bulk_post = data["post_ids"]
+    invoice_event, attendee = data["attendee"]
+    # Bookings of one ticket each, more than an event can hold, so both
+    # approaches have to turn the same bookings away
+    sections = ["General Admission", "Section A", "Section B", "Section C", "VIP"]
+    bookings = [{"seat_section": sections[i % len(sections)], "total_tickets": 1}
+                for i in range(records)]
+    cases = [
+        ("attending",
+         lambda: [client.post(
+             f"/events/{single_event}/attending/", json=booking,
+             headers={"Authorization": f"Bearer {token}"}).status_code
+             for booking, token in zip(bookings, tokens)].count(201),
+         lambda: client.post(
+             f"/events/{bulk_event}/attending/bulk",
+             json=[{**booking, "attending_id": user_id}
+                   for booking, user_id in zip(bookings, user_ids)],
+             headers=admin).get_json()["created"]),
+        ("likes",
+         lambda: [client.post(
+             f"/posts/{single_post}/likes/",
+             headers={"Authorization": f"Bearer {token}"}).status_code
+             for token in tokens].count(201),
+         lambda: client.post(
+             f"/posts/{bulk_post}/likes/bulk",
+             json=[{"user_id": user_id} for user_id in user_ids],
+             headers=admin).get_json()["created"]),
+        ("invoices",
+         lambda: [client.post(
+             f"/events/{invoice_event}/attending/{attendee}/invoice/",
+             json={"total_cost": 10.0}, headers=admin).status_code
+             for _ in range(records)].count(201),
+         lambda: client.post(
+             f"/events/{invoice_event}/attending/{attendee}/invoice/bulk",
+             json=[{"total_cost": 10.0}] * records,
+             headers=admin).get_json()["created"]),
+    ]
+
+    print(f"{records} records per run")
+    print(f"{'route':<12}{'single':>14}{'bulk':>14}{'speedup':>10}{'created':>10}")
+    for name, single, bulk in cases:
+        single_created, single_time = timed(single)
+        bulk_created, bulk_time = timed(bulk)
+        # Both approaches must accept the same records
+        if single_created != bulk_created:
+            raise AssertionError(
+                f"{name}: {single_created} created one by one, "
+                f"{bulk_created} in bulk")
+        print(f"{name:<12}{records / single_time:>10.0f}/sec"
+              f"{records / bulk_time:>10.0f}/sec"
+              f"{single_time / bulk_time:>9.1f}x{bulk_created:>10}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
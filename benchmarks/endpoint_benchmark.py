@@ -0,0 +1,463 @@
+# Benchmark of every API route at several data sizes.
+# For each size a database is seeded with generated data (see seed_data.py),
+# then each route is called a number of times through the Flask test client
+# and the latency percentiles, SQL queries per request and response size
+# are recorded. Requests that create, change or delete rows get fresh rows
+# to work on before each call, that setup is not timed.
+# Run from the project root with 'python -m benchmarks.endpoint_benchmark'
+# e.g. 'python -m benchmarks.endpoint_benchmark --sizes 100,1000,10000
+# --output after.json --compare before.json'
+# --compare prints the change from a previous run and exits with status 1
+# if a route got slower than --threshold or runs more queries.
+# Uses DATABASE_URL if it is set, otherwise a temporary SQLite file per size.
+# WARNING: the tables in the database are dropped and recreated.
+
+# Built-in Python Libraries
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Use a throwaway SQLite database per size unless one was given
+DATABASE_URL = os.environ.get("DATABASE_URL")
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+
+# External Libraries
+from sqlalchemy import event
+from flask_jwt_extended import create_access_token
+
+# Imports from local files
+from main import create_app
+from init import db
+from models.user import User
+from models.post import Post
+from models.comment import Comment
+from models.event import Event
+from models.attending import Attending
+from models.invoice import Invoice
+from seed_data import seed_synthetic, SEED_PASSWORD
+
+# Constants
+# Blueprints whose routes must all be benchmarked
+BLUEPRINTS = ("auth", "posts", "posts.comments", "posts.likes", "events",
+              "events.attending", "events.attending.invoices", "user", "jobs")
+# Number of items sent to the bulk routes
+BULK_ITEMS = 50
+
+# Define a function to work out how many rows of each kind to generate for a
+# size, the size is the number of users
+
+
+def volumes(size):
+    return {
+        "users": size,
+        "events": max(size // 10, 2),
+        "posts": max(size // 2, 2),
+        "comments": size * 2,
+        "likes": size * 2,
+        "attending": size * 2
+    }
+
+# Define a function to create the app and seed its database for a size.
+# Returns the app
+
+
+def build_app(size):
+    os.environ["DATABASE_URL"] = DATABASE_URL or "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(), f"endpoint_benchmark_{size}.db")
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed_synthetic(**volumes(size), seed=size)
+    return app
+
+# Benchmark state, holds the client, the admin's headers and ids of seeded
+# rows, and makes fresh rows for the routes that need them
+
+
+class Fixture:
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+        self.counter = itertools.count(1)
+        with app.app_context():
+            # The first generated user is the admin
+            self.admin = db.session.scalar(
+                db.select(User).filter_by(is_admin=True).order_by(User.id))
+            self.admin_id = self.admin.id
+            self.headers = {"Authorization": "Bearer " + create_access_token(
+                identity=str(self.admin_id),
+                additional_claims={"is_admin": True})}
+            self.email = self.admin.email
+            self.user_ids = db.session.scalars(
+                db.select(User.id).order_by(User.id).limit(BULK_ITEMS + 1)
+            ).all()[1:]
+            # Seeded rows with children, for the read routes
+            comment = db.session.scalar(db.select(Comment).order_by(Comment.id))
+            self.post_id, self.comment_id = comment.post_id, comment.id
+            invoice = db.session.scalar(db.select(Invoice).order_by(Invoice.id))
+            self.event_id = invoice.event_id
+            self.attending_id, self.invoice_id = invoice.attendee_id, invoice.id
+            self.search = db.session.scalar(
+                db.select(Event.title).order_by(Event.id)).split()[0]
+            self.user_search = db.session.scalar(
+                db.select(User.user_name).order_by(User.id))[:3]
+        # Rows owned by the admin, for the update routes
+        self.own_post = self.new_post()
+        self.own_comment = self.new_comment(self.own_post)
+        self.own_event = self.new_event()
+        self.own_attending = self.new_attending(self.own_event)
+        self.own_invoice = self.new_invoice(self.own_event, self.own_attending)
+        # A queued job, for the job status route
+        self.job_id = self.client.delete(
+            f"/events/{self.new_event()}?async=1",
+            headers=self.headers).get_json()["job_id"]
+
+    # Define a function to call a route as the admin, used for setup
+    def post(self, path, body=None):
+        response = self.client.post(path, json=body, headers=self.headers)
+        if response.status_code != 201:
+            raise AssertionError(f"Setup POST {path} failed: "
+                                 f"{response.status_code} {response.get_json()}")
+        return response.get_json()["id"]
+
+    # Define the functions making fresh rows owned by the admin
+    def new_post(self):
+        return self.post("/posts/", {"title": f"Benchmark post {next(self.counter)}",
+                                     "content": "Benchmark post content"})
+
+    def new_comment(self, post_id):
+        return self.post(f"/posts/{post_id}/comments/",
+                         {"content": "Benchmark comment"})
+
+    def new_like(self, post_id):
+        return self.post(f"/posts/{post_id}/likes/")
+
+    def new_event(self):
+        return self.post("/events/", {"title": f"Benchmark event {next(self.counter)}",
+                                      "description": "Benchmark event",
+                                      "ticket_price": 10.0})
+
+    def new_attending(self, event_id):
+        return self.post(f"/events/{event_id}/attending/",
+                         {"seat_section": "General Admission", "total_tickets": 1})
+
+    def new_invoice(self, event_id, attending_id):
+        return self.post(f"/events/{event_id}/attending/{attending_id}/invoice/",
+                         {"total_cost": 10.0})
+
+    def new_user(self):
+        # Added directly with the seeded password hash, registering would
+        # spend the setup time hashing
+        with self.app.app_context():
+            user = User(name="Benchmark user",
+                        user_name=f"benchmark{next(self.counter)}",
+                        email=f"benchmark{next(self.counter)}@example.com",
+                        password=self.admin.password)
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+
+# Define the list of benchmark cases. Each case is (endpoint, method,
+# prepare), where prepare makes whatever the request needs and returns the
+# path and the JSON body
+
+
+def cases(f):
+    event_path = f"/events/{f.event_id}/attending"
+    invoice_path = f"{event_path}/{f.attending_id}/invoice"
+    own_invoice_path = f"/events/{f.own_event}/attending/{f.own_attending}/invoice"
+    return [
+        # auth_bp
+        ("auth.login_user", "POST", lambda: (
+            "/auth/login", {"email": f.email, "password": SEED_PASSWORD})),
+        ("auth.register_user", "POST", lambda: (
+            "/auth/register", {"name": "Benchmark user",
+                               "user_name": f"bench{next(f.counter)}",
+                               "email": f"bench{next(f.counter)}@example.com",
+                               "password": SEED_PASSWORD})),
+        # posts_bp
+        ("posts.get_all_posts", "GET", lambda: ("/posts/", None)),
+        ("posts.get_single_post", "GET", lambda: (f"/posts/{f.post_id}", None)),
+        ("posts.new_post", "POST", lambda: (
+            "/posts/", {"title": "Benchmark post", "content": "Benchmark content"})),
+        ("posts.update_post", "PUT", lambda: (
+            f"/posts/{f.own_post}", {"title": "Benchmark post updated",
+                                     "content": "Benchmark content"})),
+        ("posts.delete_post", "DELETE", lambda: (f"/posts/{f.new_post()}", None)),
+        # comments_bp
+        ("posts.comments.fetch_comments", "GET", lambda: (
+            f"/posts/{f.post_id}/comments/", None)),
+        ("posts.comments.count_comments", "GET", lambda: (
+            f"/posts/{f.post_id}/comments/count", None)),
+        ("posts.comments.fetch_single_comment", "GET", lambda: (
+            f"/posts/{f.post_id}/comments/{f.comment_id}", None)),
+        ("posts.comments.create_comment", "POST", lambda: (
+            f"/posts/{f.post_id}/comments/", {"content": "Benchmark comment"})),
+        ("posts.comments.update_comment", "PUT", lambda: (
+            f"/posts/{f.own_post}/comments/{f.own_comment}",
+            {"content": "Benchmark comment updated"})),
+        ("posts.comments.delete_comment", "DELETE", lambda: (
+            f"/posts/{f.own_post}/comments/{f.new_comment(f.own_post)}", None)),
+        # likes_bp
+        ("posts.likes.fetch_all_likes_on_post", "GET", lambda: (
+            f"/posts/{f.post_id}/likes/", None)),
+        ("posts.likes.count_likes_on_post", "GET", lambda: (
+            f"/posts/{f.post_id}/likes/count", None)),
+        ("posts.likes.create_like", "POST", lambda: (
+            f"/posts/{f.new_post()}/likes/", None)),
+        ("posts.likes.create_likes_bulk", "POST", lambda: (
+            f"/posts/{f.new_post()}/likes/bulk",
+            [{"user_id": user_id} for user_id in f.user_ids])),
+        ("posts.likes.delete_like", "DELETE", lambda: (
+            (lambda post_id: f"/posts/{post_id}/likes/{f.new_like(post_id)}")(
+                f.new_post()), None)),
+        # events_bp
+        ("events.get_all_events", "GET", lambda: ("/events/", None)),
+        ("events.get_single_event", "GET", lambda: (
+            f"/events/{f.event_id}", None)),
+        ("events.get_event_stats", "GET", lambda: (
+            f"/events/{f.event_id}/stats", None)),
+        ("events.get_event_sales", "GET", lambda: (
+            f"/events/{f.event_id}/sales?bucket=week", None)),
+        ("events.get_all_sales", "GET", lambda: (
+            "/events/sales?bucket=day", None)),
+        ("events.search_event_by_name", "GET", lambda: (
+            f"/events/search/{f.search}", None)),
+        ("events.create_event", "POST", lambda: (
+            "/events/", {"title": "Benchmark event", "ticket_price": 10.0})),
+        ("events.update_event", "PUT", lambda: (
+            f"/events/{f.own_event}", {"title": "Benchmark event updated"})),
+        ("events.delete_event", "DELETE", lambda: (
+            f"/events/{f.new_event()}", None)),
+        # attending_bp
+        ("events.attending.fetch_event_attending", "GET", lambda: (
+            f"{event_path}/", None)),
+        ("events.attending.fetch_specific_attendee", "GET", lambda: (
+            f"{event_path}/{f.attending_id}", None)),
+        ("events.attending.export_event_attending", "GET", lambda: (
+            f"{event_path}/export.csv", None)),
+        ("events.attending.attending_event", "POST", lambda: (
+            f"/events/{f.new_event()}/attending/",
+            {"seat_section": "Section A", "total_tickets": 2})),
+        ("events.attending.attending_event_bulk", "POST", lambda: (
+            f"/events/{f.new_event()}/attending/bulk",
+            [{"seat_section": "General Admission", "total_tickets": 1,
+              "attending_id": user_id} for user_id in f.user_ids])),
+        ("events.attending.update_attendee", "PUT", lambda: (
+            f"/events/{f.own_event}/attending/{f.own_attending}",
+            {"seat_section": "General Admission", "total_tickets": 1})),
+        ("events.attending.delete_attending", "DELETE", lambda: (
+            (lambda event_id: f"/events/{event_id}/attending/"
+             f"{f.new_attending(event_id)}")(f.new_event()), None)),
+        # invoice_bp
+        ("events.attending.invoices.fetch_event_attending", "GET", lambda: (
+            f"{invoice_path}/", None)),
+        ("events.attending.invoices.fetch_specific_invoice", "GET", lambda: (
+            f"{invoice_path}/{f.invoice_id}", None)),
+        ("events.attending.invoices.new_invoice", "POST", lambda: (
+            f"{own_invoice_path}/", {"total_cost": 10.0})),
+        ("events.attending.invoices.new_invoice_bulk", "POST", lambda: (
+            f"{own_invoice_path}/bulk", [{"total_cost": 10.0}] * BULK_ITEMS)),
+        ("events.attending.invoices.update_invoice", "PUT", lambda: (
+            f"{own_invoice_path}/{f.own_invoice}", {"total_cost": 12.0})),
+        ("events.attending.invoices.delete_invoice", "DELETE", lambda: (
+            f"{own_invoice_path}/"
+            f"{f.new_invoice(f.own_event, f.own_attending)}", None)),
+        # user_bp
+        ("user.get_users", "GET", lambda: ("/user/", None)),
+        ("user.get_user", "GET", lambda: (f"/user/{f.admin_id}", None)),
+        ("user.search_user_by_name", "GET", lambda: (
+            f"/user/search/{f.user_search}", None)),
+        ("user.update_user", "PUT", lambda: (
+            f"/user/{f.admin_id}", {"name": "Benchmark admin"})),
+        ("user.delete_user", "DELETE", lambda: (f"/user/{f.new_user()}", None)),
+        # jobs_bp
+        ("jobs.get_job", "GET", lambda: (f"/jobs/{f.job_id}", None)),
+    ]
+
+# Define a function to list the benchmarked blueprints' routes that have no
+# case, so new routes are not silently left out
+
+
+def missing_routes(app, covered):
+    return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                  if rule.endpoint.rsplit(".", 1)[0] in BLUEPRINTS
+                  and rule.endpoint not in covered)
+
+# Define a function to summarise the measurements of one route
+
+
+def summarise(latencies, queries, sizes, statuses):
+    # Percentiles need at least two values
+    cuts = statistics.quantiles(latencies * (2 if len(latencies) == 1 else 1),
+                                n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "status": max(set(statuses), key=statuses.count),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p90_ms": round(cuts[89], 3),
+        "p99_ms": round(cuts[98], 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "max_ms": round(max(latencies), 3),
+        "queries": statistics.median(queries),
+        "bytes": statistics.median(sizes)
+    }
+
+# Define a function to benchmark every route at one size.
+# Returns a dict of endpoint: summary
+
+
+def run_size(size, repeat, warmup):
+    print(f"Seeding {size} users ...", flush=True)
+    app = build_app(size)
+    fixture = Fixture(app)
+    route_cases = cases(fixture)
+    missing = missing_routes(app, {endpoint for endpoint, _, _ in route_cases})
+    if missing:
+        print("WARNING: routes without a benchmark: " + ", ".join(missing))
+
+    # Count the SQL statements each request runs
+    statements = [0]
+    with app.app_context():
+        engine = db.engine
+
+    def count_statement(*args):
+        statements[0] += 1
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    results = {}
+    try:
+        for endpoint, method, prepare in route_cases:
+            latencies, queries, sizes, statuses = [], [], [], []
+            for attempt in range(warmup + repeat):
+                path, body = prepare()
+                statements[0] = 0
+                start = time.perf_counter()
+                response = fixture.client.open(
+                    path, method=method, json=body, headers=fixture.headers)
+                # Read the whole body, streamed responses are sent as it is read
+                length = len(response.get_data())
+                response.close()
+                elapsed = (time.perf_counter() - start) * 1000
+                if attempt < warmup:
+                    continue
+                latencies.append(elapsed)
+                queries.append(statements[0])
+                sizes.append(length)
+                statuses.append(response.status_code)
+            if max(statuses) >= 400:
+                print(f"WARNING: {method} {endpoint} answered {max(statuses)}: "
+                      f"{response.get_data(as_text=True)[:200]}")
+            results[endpoint] = {"method": method,
+                                 **summarise(latencies, queries, sizes, statuses)}
+            print(f"{size:>8} {method:<7}{endpoint:<52}"
+                  f"{results[endpoint]['p50_ms']:>9.2f}ms"
+                  f"{results[endpoint]['p99_ms']:>9.2f}ms"
+                  f"{results[endpoint]['queries']:>6} queries"
+                  f"{results[endpoint]['bytes']:>10} bytes", flush=True)
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    return results
+
+# Define a function to compare a run with a previous one. Prints the change
+# of each route and returns the regressions found, routes whose median
+# latency went up by more than 'threshold' (a fraction) and 'min_change'
+# milliseconds, or that run more queries than before
+
+
+def compare(current, previous, threshold, min_change):
+    regressions = []
+    print(f"\n{'size':>8} {'route':<52}{'p50 before':>12}{'p50 after':>12}"
+          f"{'change':>9}{'queries':>12}")
+    for size, routes in current["results"].items():
+        for endpoint, after in routes.items():
+            before = previous["results"].get(size, {}).get(endpoint)
+            if before is None:
+                continue
+            change = after["p50_ms"] / max(before["p50_ms"], 1e-9) - 1
+            flags = []
+            # Small routes vary a lot in relative terms, so the slowdown
+            # must also be more than 'min_change' milliseconds
+            if (change > threshold
+                    and after["p50_ms"] - before["p50_ms"] > min_change):
+                flags.append(f"p50 +{change:.0%}")
+            if after["queries"] > before["queries"]:
+                flags.append(f"queries {before['queries']} -> {after['queries']}")
+            if flags:
+                regressions.append((size, endpoint, flags))
+            print(f"{size:>8} {endpoint:<52}{before['p50_ms']:>10.2f}ms"
+                  f"{after['p50_ms']:>10.2f}ms{change:>+9.0%}"
+                  f"{before['queries']:>6} ->{after['queries']:>3}"
+                  + ("  REGRESSION" if flags else ""))
+    return regressions
+
+# Define the benchmark, writes the results to a JSON file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark every API route at several data sizes")
+    parser.add_argument("--sizes", default="100,1000",
+                        help="comma separated numbers of users to seed "
+                        "(default: 100,1000)")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="timed requests per route (default: 20)")
+    parser.add_argument("--warmup", type=int, default=2,
+                        help="untimed requests per route first (default: 2)")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="file to write the results to "
+                        "(default: benchmark_results.json)")
+    parser.add_argument("--compare", metavar="PREVIOUS",
+                        help="results file of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown of the median latency counted as a "
+                        "regression, 0.2 is 20%% (default: 0.2)")
+    parser.add_argument("--min-change-ms", type=float, default=1.0,
+                        help="smallest slowdown of the median latency in "
+                        "milliseconds counted as a regression (default: 1.0)")
+    args = parser.parse_args(argv)
+    # Read the previous run first so a bad path fails before the long run
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+
+    results = {}
+    for size in (int(size) for size in args.sizes.split(",")):
+        results[str(size)] = run_size(size, args.repeat, args.warmup)
+        # The app's database URL is set per size, so read it back here
+        database = os.environ["DATABASE_URL"].split(":", 1)[0]
+    current = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "database": database,
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "volumes": {str(size): volumes(int(size)) for size in results},
+        "results": results
+    }
+    with open(args.output, "w") as file:
+        json.dump(current, file, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if previous is not None:
+        regressions = compare(current, previous, args.threshold,
+                              args.min_change_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for size, endpoint, flags in regressions:
+                print(f"  {size} {endpoint}: {', '.join(flags)}")
+            return 1
+        print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
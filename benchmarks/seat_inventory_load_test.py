@@ -0,0 +1,100 @@
+# Concurrent load test for the seat inventory.
+# Many users buy tickets for one event at the same time, then the bookings
+# are checked against the section capacities and the per user limit.
+# Run from the project root with 'python -m benchmarks.seat_inventory_load_test'
+# Optional arguments: number of users and number of threads,
+# e.g. 'python -m benchmarks.seat_inventory_load_test 200 16'
+# Uses DATABASE_URL if it is set, otherwise a temporary SQLite file.
+# WARNING: the tables in the database are dropped and recreated.
+
+# Built-in Python Libraries
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+# Use a throwaway SQLite database unless one was given
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(), "seat_inventory_load_test.db"))
+os.environ.setdefault("JWT_SECRET_KEY", "load-test-secret")
+
+# External Libraries
+from flask_jwt_extended import create_access_token
+
+# Imports from local files
+from main import create_app
+from init import db
+from models.user import User
+from models.event import Event
+from models.attending import Attending, MAX_TICKETS_PER_USER
+from models.seat_inventory import SECTION_CAPACITY
+
+
+def main(users=200, threads=16):
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Users do not log in, so a placeholder password is enough
+        accounts = [User(name=f"User {i}", user_name=f"user{i}",
+                         email=f"user{i}@email.com", password="x")
+                    for i in range(users)]
+        db.session.add_all(accounts)
+        event = Event(title="Load test", date=date.today(),
+                      ticket_price=10.0, user=accounts[0])
+        db.session.add(event)
+        db.session.commit()
+        event_id = event.id
+        tokens = [create_access_token(identity=str(user.id))
+                  for user in accounts]
+
+    # Each user tries to book three times, sometimes going over their limit
+    rng = random.Random(1)
+    purchases = [(token, rng.choice(list(SECTION_CAPACITY)), rng.randint(1, 3))
+                 for token in tokens for _ in range(3)]
+    rng.shuffle(purchases)
+
+    # Define a function to make one booking, returns the response status
+    def buy(purchase):
+        token, seat_section, tickets = purchase
+        response = app.test_client().post(
+            f"/events/{event_id}/attending/",
+            json={"seat_section": seat_section, "total_tickets": tickets},
+            headers={"Authorization": f"Bearer {token}"})
+        return response.status_code
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = Counter(pool.map(buy, purchases))
+    print(f"{len(purchases)} bookings with {threads} threads: "
+          f"{dict(sorted(statuses.items()))}")
+
+    # Check the results against the database
+    with app.app_context():
+        sold = dict(db.session.execute(
+            db.select(Attending.seat_section,
+                      db.func.sum(Attending.total_tickets))
+            .filter_by(event_id=event_id)
+            .group_by(Attending.seat_section)).all())
+        held = db.session.execute(
+            db.select(Attending.attending_id,
+                      db.func.sum(Attending.total_tickets))
+            .filter_by(event_id=event_id)
+            .group_by(Attending.attending_id)).all()
+    failed = False
+    for seat_section, capacity in SECTION_CAPACITY.items():
+        count = sold.get(seat_section, 0)
+        print(f"{seat_section:<20}{count:>4} / {capacity}")
+        failed = failed or count > capacity
+    over_limit = [user for user, tickets in held
+                  if tickets > MAX_TICKETS_PER_USER]
+    print(f"Users over the {MAX_TICKETS_PER_USER} ticket limit: {len(over_limit)}")
+    if failed or over_limit:
+        raise SystemExit("Seat inventory oversold")
+    print("No overselling")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
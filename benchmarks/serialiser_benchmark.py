@@ -0,0 +1,109 @@
+# Microbenchmark comparing marshmallow's Schema.dump with the compiled
+# serialiser for the hot list schemas.
+# Run from the project root with 'python -m benchmarks.serialiser_benchmark'
+# Optional arguments: number of rows per schema and number of repeats,
+# e.g. 'python -m benchmarks.serialiser_benchmark 1000 5'
+
+# Built-in Python Libraries
+import importlib
+import json
+import os
+import pkgutil
+import sys
+import timeit
+from datetime import date, datetime
+
+# Imports from local files
+from compiled_schema import compiled_dump
+from models.user import User
+from models.post import Post, posts_schema
+from models.comment import Comment, comments_schema
+from models.like import Like, likes_schema
+from models.event import Event, events_schema
+from models.attending import Attending, attendings_schema
+from models.invoice import Invoice, invoices_schema
+import models
+
+# Import every model so their mappers are registered, the relationships
+# name other models as strings and fail to resolve if one was never loaded
+for module in pkgutil.iter_modules(models.__path__):
+    importlib.import_module(f"models.{module.name}")
+
+# Define a function to build in-memory rows shaped like the real data,
+# no database is needed because the schemas only read attributes
+
+
+def build_rows(rows):
+    users = [User(id=i, name=f"User {i}", user_name=f"user{i}",
+                  email=f"user{i}@email.com", is_admin=i == 0)
+             for i in range(1, 11)]
+    posts, comments, likes, events, attending, invoices = [], [], [], [], [], []
+    for i in range(1, rows + 1):
+        user = users[i % len(users)]
+        post = Post(id=i, title=f"post {i}", content="this is a post",
+                    date=date(2024, 1, 1 + i % 28), location="Adelaide",
+                    user=user)
+        comment = Comment(id=i, content=f"comment {i}", timestamp=date.today(),
+                          user=users[(i + 1) % len(users)], post=post)
+        like = Like(id=i, user=users[(i + 2) % len(users)], post=post)
+        event = Event(id=i, title=f"Event {i}", description="An event",
+                      date=date(2024, 2, 1 + i % 28), ticket_price=12.5,
+                      event_admin_id=user.id, user=user)
+        attendee = Attending(id=i, total_tickets=2, seat_section="Section A",
+                             timestamp=datetime.now(), event=event,
+                             event_id=event.id, attending_id=user.id, user=user)
+        invoice = Invoice(id=i, total_cost=25.0, timestamp=date.today(),
+                          event_id=event.id, attendee_id=attendee.id,
+                          event=event, attending=attendee)
+        posts.append(post)
+        comments.append(comment)
+        likes.append(like)
+        events.append(event)
+        attending.append(attendee)
+        invoices.append(invoice)
+    return {
+        "posts_schema": (posts_schema, posts),
+        "events_schema": (events_schema, events),
+        "attendings_schema": (attendings_schema, attending),
+        "invoices_schema": (invoices_schema, invoices),
+        "comments_schema": (comments_schema, comments),
+        "likes_schema": (likes_schema, likes),
+    }
+
+# Define a function to dump with plain marshmallow, the compiled serialiser
+# is switched off so nested schemas are not compiled either
+
+
+def marshmallow_dump(schema, objs):
+    previous = os.environ.get("FAST_SERIALISER")
+    os.environ["FAST_SERIALISER"] = "false"
+    try:
+        return schema.dump(objs)
+    finally:
+        if previous is None:
+            del os.environ["FAST_SERIALISER"]
+        else:
+            os.environ["FAST_SERIALISER"] = previous
+
+# Define the benchmark, prints the time per dump for each serialiser
+
+
+def main(rows=500, repeat=5):
+    print(f"{'schema':<20}{'marshmallow':>14}{'compiled':>14}{'speedup':>10}")
+    for name, (schema, objs) in build_rows(rows).items():
+        # Both serialisers must produce byte-identical JSON
+        expected = json.dumps(marshmallow_dump(schema, objs))
+        actual = json.dumps(compiled_dump(schema)(objs, True))
+        if expected != actual:
+            raise AssertionError(f"{name}: compiled output differs")
+        # Best of 'repeat' runs, in milliseconds
+        baseline = min(timeit.repeat(
+            lambda: marshmallow_dump(schema, objs), number=1, repeat=repeat)) * 1000
+        compiled = min(timeit.repeat(
+            lambda: compiled_dump(schema)(objs, True), number=1, repeat=repeat)) * 1000
+        print(f"{name:<20}{baseline:>12.2f}ms{compiled:>12.2f}ms"
+              f"{baseline / compiled:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,185 @@
+# Compiled fast-path serialiser for the hot list schemas
+# Marshmallow's Schema.dump looks up and calls every field's serialize
+# method for every row, which is where most of the CPU of the listing routes
+# goes. CompiledSchema precompiles a schema's dump fields into a list of
+# small getter functions once, then reuses them for every object it dumps.
+# Only dumping is compiled, load() and validation are still marshmallow's.
+
+# Built-in Python Libraries
+import datetime as dt
+import os
+
+# External Libraries
+from flask import current_app, has_app_context
+from marshmallow import fields
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+from marshmallow.utils import missing
+
+# Imports from local files
+from init import ma
+from server_timing import measure
+
+
+# Value types the inferred (Meta.fields only) fields can output as they are,
+# these match what marshmallow's String, Integer, Float and Boolean fields
+# return for values that are already of that type
+PASS_THROUGH_TYPES = (str, int, float, bool, type(None))
+# Value types the inferred fields output as an ISO 8601 string
+ISO_TYPES = (dt.date, dt.datetime)
+
+# Define a function to check whether the compiled serialiser is switched on.
+# It is on by default and can be turned off with FAST_SERIALISER=false
+
+
+def fast_serialiser_enabled():
+    if has_app_context():
+        return current_app.config.get("FAST_SERIALISER", True)
+    return os.environ.get("FAST_SERIALISER", "true").lower() != "false"
+
+# Define a function to compile a single field into a function that takes an
+# object and returns the serialised value, or 'missing' to leave it out
+
+
+def compile_field(name, field, schema):
+    # Attribute to read from the object
+    attribute = field.attribute or name
+
+    # Define the fallback, let marshmallow serialise this field as usual
+    def fallback(obj):
+        return field.serialize(name, obj, accessor=schema.get_attribute)
+
+    # Dotted attributes and dump defaults are rare, leave them to marshmallow
+    if "." in attribute or field.dump_default is not missing:
+        return fallback
+
+    field_type = type(field)
+
+    # Fields declared only in Meta.fields, the type is inferred from the value
+    if field_type is fields.Inferred:
+        def serialise_inferred(obj):
+            value = getattr(obj, attribute, missing)
+            if value is missing:
+                return missing
+            if type(value) in PASS_THROUGH_TYPES:
+                return value
+            if type(value) in ISO_TYPES:
+                return value.isoformat()
+            return fallback(obj)
+        return serialise_inferred
+
+    # Explicitly declared String fields, e.g. the validated title fields
+    if field_type is fields.String:
+        def serialise_string(obj):
+            value = getattr(obj, attribute, missing)
+            if value is missing or value is None:
+                return value
+            if type(value) is str:
+                return value
+            return fallback(obj)
+        return serialise_string
+
+    # Explicitly declared Float fields, e.g. ticket_price and total_cost
+    if field_type is fields.Float and not field.as_string:
+        def serialise_float(obj):
+            value = getattr(obj, attribute, missing)
+            if value is missing or value is None:
+                return value
+            return float(value)
+        return serialise_float
+
+    # A single nested object, e.g. a post's user
+    if field_type is fields.Nested:
+        def serialise_nested(obj):
+            value = getattr(obj, attribute, missing)
+            if value is missing or value is None:
+                return value
+            nested_schema = field.schema
+            # Lists dumped by a single object schema need marshmallow's rules
+            if (nested_schema.many or field.many
+                    or isinstance(value, (list, tuple, set))):
+                return fallback(obj)
+            return compiled_dump(nested_schema)(value, False)
+        return serialise_nested
+
+    # A list of nested objects, e.g. a post's comments
+    if field_type is fields.List and type(field.inner) is fields.Nested:
+        inner = field.inner
+
+        def serialise_nested_list(obj):
+            value = getattr(obj, attribute, missing)
+            if value is missing or value is None:
+                return value
+            nested_schema = inner.schema
+            if nested_schema.many or inner.many:
+                return fallback(obj)
+            dump_one = compiled_dump(nested_schema)
+            return [None if item is None else dump_one(item, False)
+                    for item in value]
+        return serialise_nested_list
+
+    # Any other field type is serialised by marshmallow
+    return fallback
+
+# Define a function to compile a schema instance into a dump function with
+# the same signature as Schema._serialize. The result is cached on the
+# schema instance so each schema is only compiled once
+
+
+def compiled_dump(schema):
+    dump = schema.__dict__.get("_compiled_dump")
+    if dump is not None:
+        return dump
+
+    # Schemas with dump hooks are not compiled, use marshmallow as usual
+    if schema._has_processors(PRE_DUMP) or schema._has_processors(POST_DUMP):
+        def dump(obj, many=False):
+            return ma.Schema.dump(schema, obj, many=many)
+        schema._compiled_dump = dump
+        return dump
+
+    # Output key and compiled getter for each dump field, in dump order
+    compiled_fields = [
+        (field.data_key if field.data_key is not None else name,
+         compile_field(name, field, schema))
+        for name, field in schema.dump_fields.items()
+    ]
+    dict_class = schema.dict_class
+
+    # Define the compiled dump function
+    def dump(obj, many=False):
+        if many and obj is not None:
+            return [dump(item, False) for item in obj]
+        # Mappings are read by key in marshmallow, leave them to it
+        if hasattr(obj, "__getitem__"):
+            return schema._serialize(obj, many=False)
+        ret = dict_class()
+        for key, serialise in compiled_fields:
+            value = serialise(obj)
+            if value is not missing:
+                ret[key] = value
+        return ret
+
+    schema._compiled_dump = dump
+    return dump
+
+# Base schema class that counts its dumps as serialisation time in the
+# Server-Timing header (see server_timing.py)
+
+
+class TimedSchema(ma.Schema):
+    def dump(self, obj, *, many=None):
+        with measure("serialise"):
+            return super().dump(obj, many=many)
+
+# Base schema class for the schemas that use the compiled serialiser
+
+
+class CompiledSchema(TimedSchema):
+    # Define the dump method, same output as Schema.dump but precompiled
+    def dump(self, obj, *, many=None):
+        # Serialiser switched off, use marshmallow
+        if not fast_serialiser_enabled():
+            return super().dump(obj, many=many)
+        many = self.many if many is None else bool(many)
+        with measure("serialise"):
+            return compiled_dump(self)(obj, many)
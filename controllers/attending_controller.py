@@ -4,14 +4,22 @@ from datetime import datetime
 # External Libraries
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
-from models.attending import Attending, attending_schema, attendings_schema
+from models.attending import Attending, attending_schema, attendings_schema, attending_loader_profile, VALID_SEAT_SECTIONS
+from models.seat_inventory import reserve_seats, reserve_seats_bulk, release_seats, change_seats
 from models.event import Event
+from models.user import User
+from models.invoice import Invoice
 from controllers.invoice_controller import invoice_bp
-from utils import authorise_as_admin
+from utils import authorise_as_admin, eager_load, select_fields, resolve_chain, conditional_get, get_bulk_items, bulk_insert, bulk_response, wants_stream, stream_rows, stream_csv
 from init import db
 
+# Columns of the attendee export, in order
+EXPORT_COLUMNS = ["attending_id", "booked_on", "user_id", "name", "email",
+                  "seat_section", "total_tickets", "invoices", "invoice_total"]
+
 # Create a Blueprint for the attending endpoints
 attending_bp = Blueprint("attending", __name__,
                          url_prefix="/<int:event_id>/attending")
@@ -27,6 +35,7 @@ attending_bp.register_blueprint(invoice_bp)
 
 @attending_bp.route("/")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Attending, attending_loader_profile)  # Answer If-None-Match with 304
 # Function to fetch all attendees for a specific event
 def fetch_event_attending(event_id):
     try:
@@ -38,17 +47,71 @@ def fetch_event_attending(event_id):
         if not event_exists:
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
 
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(
+            attendings_schema, attending_loader_profile)
         # Query to select attendees for the event, ordered by timestamp in
         # descending order
         stmt = db.select(Attending).filter_by(
-            event_id=event_id).order_by(Attending.timestamp.desc())
+            event_id=event_id).order_by(Attending.timestamp.desc()).options(
+            *eager_load(Attending, profile))
+        # Stream every attendee as NDJSON if the client asked for it
+        if wants_stream():
+            return stream_rows(stmt, schema)
         attendees = db.session.scalars(stmt).all()
 
         # If attendees are found, return them as a JSON response
         if attendees:
-            return attendings_schema.dump(attendees)
+            return schema.dump(attendees)
         else:
             return {"error": f"No attendees found for event with id '{event_id}'"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
+    except Exception as e:
+        return {"error": str(e)}, 500
+
+# GET - Download every attendee of an event with their invoice totals as a
+# CSV file, for the event's organiser
+# /<int:event_id>/attending/export.csv
+
+
+@attending_bp.route("/export.csv")
+@jwt_required() # Protect the route with JWT
+# Function to export the attendees of an event
+def export_event_attending(event_id):
+    try:
+        # Check if the event exists
+        event = db.session.get(Event, event_id)
+        if event is None:
+            return {"error": f"Event with id '{event_id}' does not exist."}, 404
+        # Only the event's creator or an admin can download its attendees
+        if not authorise_as_admin() and str(event.event_admin_id) != get_jwt_identity():
+            return {"error": "User unauthorized to perform this request"}, 403
+
+        # Number of invoices and their total for each attendee of the event
+        invoices = (db.select(
+            Invoice.attendee_id,
+            db.func.count().label("invoices"),
+            db.func.sum(Invoice.total_cost).label("invoice_total"))
+            .filter_by(event_id=event_id)
+            .group_by(Invoice.attendee_id).subquery())
+        # One query joining each attendee to their user and invoice totals,
+        # in the same order as the attendee listing
+        stmt = (db.select(
+            Attending.id, Attending.timestamp, User.id, User.name, User.email,
+            Attending.seat_section, Attending.total_tickets,
+            db.func.coalesce(invoices.c.invoices, 0),
+            # Totals in cents, a sum of floats drifts a little
+            db.cast(db.func.coalesce(invoices.c.invoice_total, 0),
+                    db.Numeric(12, 2)))
+            .outerjoin(User, User.id == Attending.attending_id)
+            .outerjoin(invoices, invoices.c.attendee_id == Attending.id)
+            .where(Attending.event_id == event_id)
+            .order_by(Attending.timestamp.desc(), Attending.id.desc()))
+        # Stream the rows as CSV, gzipped if the client accepts it
+        return stream_csv(stmt, EXPORT_COLUMNS,
+                          f"event-{event_id}-attendees.csv")
     except Exception as e:
         return {"error": str(e)}, 500
 
@@ -58,26 +121,30 @@ def fetch_event_attending(event_id):
 
 @attending_bp.route("/<int:attending_id>")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Attending, attending_loader_profile)  # Answer If-None-Match with 304
 # Function to fetch a specific attendee for an event
 def fetch_specific_attendee(event_id, attending_id):
     try: 
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(
+            attending_schema, attending_loader_profile)
+        # Fetch the event and the specific attendee for it in one query
+        event, attendee = resolve_chain(
+            (Event, event_id), (Attending, attending_id),
+            options=eager_load(Attending, profile))
 
         # If the event does not exist, return a 404 error
-        if not event_exists:
+        if event is None:
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
 
-        # Query to select a specific attendee for the event
-        stmt = db.select(Attending).filter_by(event_id=event_id, id=attending_id)
-        attendee = db.session.scalar(stmt)
-
         # If the attendee is found, return them as a JSON response
         if attendee:
-            return attending_schema.dump(attendee)
+            return schema.dump(attendee)
         else:
             return {"error": f"No attendee found with id '{attending_id}' for event with id '{event_id}'"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         return {"error": str(e)}, 500
 
@@ -99,10 +166,19 @@ def attending_event(event_id):
 
         # If the event exists, create a new Attending object
         if event:
+            # Default to one General Admission ticket
+            total_tickets = body_data.get("total_tickets") or 1
+            seat_section = body_data.get(
+                "seat_section") or VALID_SEAT_SECTIONS[0]
+            # Take the seats from the event's inventory, raises a
+            # ValidationError if they are not available
+            reserve_seats(event.id, get_jwt_identity(),
+                          seat_section, total_tickets)
+
             # Create a new Attending object
             attending = Attending(
-                total_tickets=body_data.get("total_tickets"),
-                seat_section=body_data.get("seat_section"),
+                total_tickets=total_tickets,
+                seat_section=seat_section,
                 timestamp=datetime.now(),
                 event=event,
                 attending_id=get_jwt_identity()
@@ -117,6 +193,111 @@ def attending_event(event_id):
         else:
             # Return an error message and status code
             return {"error": f"Event with id '{event_id}' not found"}, 404
+    except ValidationError as err:
+        # Undo any seats taken before the error
+        db.session.rollback()
+        # Handle invalid data, sold out sections and the ticket limit
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
+# POST - Book many attendees for an event in one request
+# /<int:event_id>/attending/bulk
+# The body is a JSON array of bookings, e.g.
+# [{"seat_section": "VIP", "total_tickets": 2}, ...]. Each booking is for
+# the logged in user, admins can book for other users with "attending_id"
+
+
+@attending_bp.route("/bulk", methods=["POST"])
+@jwt_required() # Protect the route with JWT
+# Function to book many attendees at once
+def attending_event_bulk(event_id):
+    try:
+        # Get the list of bookings from the payload
+        items = get_bulk_items()
+
+        # Check if the event exists
+        event_exists = db.session.query(Event.id).filter_by(
+            id=event_id).scalar() is not None
+        # If the event does not exist, return a 404 error
+        if not event_exists:
+            return {"error": f"Event with id '{event_id}' not found"}, 404
+
+        # One result per booking, filled in as they are checked
+        results = [None] * len(items)
+        # Bookings that passed validation, and their place in the request
+        bookings, indexes = [], []
+        # Only check if the user is an admin if a booking needs it
+        is_admin = None
+        for index, item in enumerate(items):
+            # Validate the booking against the Attending schema
+            try:
+                body_data = attending_schema.load(item, partial=True)
+            except ValidationError as err:
+                results[index] = {"status": 400, "error": err.messages}
+                continue
+            # Book for the logged in user unless another user is given
+            user_id = body_data.get("attending_id") or get_jwt_identity()
+            if not str(user_id).isdigit():
+                results[index] = {"status": 400, "error": {
+                    "attending_id": ["Not a valid integer."]}}
+                continue
+            if str(user_id) != get_jwt_identity():
+                if is_admin is None:
+                    is_admin = authorise_as_admin()
+                if not is_admin:
+                    results[index] = {
+                        "status": 403,
+                        "error": "Only an admin can book for another user"}
+                    continue
+            bookings.append((int(user_id),
+                             body_data.get("seat_section") or VALID_SEAT_SECTIONS[0],
+                             body_data.get("total_tickets") or 1))
+            indexes.append(index)
+
+        # Check every user exists in one query
+        user_ids = {user_id for user_id, _, _ in bookings}
+        found = set(db.session.scalars(
+            db.select(User.id).where(User.id.in_(user_ids))))
+        checked = []
+        for index, booking in zip(indexes, bookings):
+            if booking[0] in found:
+                checked.append((index, booking))
+            else:
+                results[index] = {"status": 404, "error": f"User with id '{booking[0]}' not found"}
+
+        # Take the seats for the whole batch, each booking that does not fit
+        # gets the same error a single booking would
+        errors = reserve_seats_bulk(
+            event_id, [booking for _, booking in checked]) if checked else []
+        rows, created = [], []
+        for (index, (user_id, seat_section, total_tickets)), error in zip(
+                checked, errors):
+            if error:
+                results[index] = {"status": 400, "error": error}
+                continue
+            rows.append({
+                "total_tickets": total_tickets,
+                "seat_section": seat_section,
+                "timestamp": datetime.now(),
+                "event_id": event_id,
+                "attending_id": user_id
+            })
+            created.append(index)
+
+        # Insert every accepted booking with one statement and commit once
+        data = bulk_insert(Attending, rows, attending_schema,
+                           attending_loader_profile)
+        for index, attending in zip(created, data):
+            results[index] = {"status": 201, "data": attending}
+        # Return the result of every booking and status code
+        return bulk_response(results)
+    except ValidationError as err:
+        # Undo any seats taken before the error
+        db.session.rollback()
+        # Handle an invalid body or seats taken by another request meanwhile
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -130,22 +311,17 @@ def attending_event(event_id):
 # Function to update an attendee record
 def update_attendee(event_id, attendee_id):
     try:
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Fetch the event and the specific attendee for it in one query
+        event, attending = resolve_chain(
+            (Event, event_id), (Attending, attendee_id))
 
         # If the event does not exist, return a 404 error
-        if not event_exists:
+        if event is None:
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
 
         # Load request data and validate against the Attending schema
         body_data = attending_schema.load(request.get_json(), partial=True)
 
-        # Query to select the specific attendee
-        stmt = db.select(Attending).filter_by(event_id=event_id, id=attendee_id)
-        # Fetch the attendee from the database
-        attending = db.session.scalar(stmt)
-
         # If the attendee exists, update their information
         if attending:
             # Ensure only the attendee can update their information
@@ -153,12 +329,21 @@ def update_attendee(event_id, attendee_id):
                 # Return an error message and status code
                 return {"error": "Only the attendee can update this information"}, 403
 
-            # Update the attendee's information or keep the old value if not included
+            # New ticket count and section, or the old ones if not included
             # in the request body
-            attending.total_tickets = body_data.get(
+            total_tickets = body_data.get(
                 "total_tickets") or attending.total_tickets
-            attending.seat_section = body_data.get(
+            seat_section = body_data.get(
                 "seat_section") or attending.seat_section
+            # Move the seats in the event's inventory before changing the
+            # record, raises a ValidationError if they are not available
+            change_seats(event_id, attending.attending_id,
+                         attending.seat_section, attending.total_tickets,
+                         seat_section, total_tickets)
+
+            # Update the attendee's information
+            attending.total_tickets = total_tickets
+            attending.seat_section = seat_section
             attending.timestamp = body_data.get(
                 "time_stamp") or attending.timestamp
 
@@ -170,6 +355,11 @@ def update_attendee(event_id, attendee_id):
         else:
             # Return an error message and status code
             return {"error": f"Attending with id '{attendee_id}' not found for event with id '{event_id}'"}, 404
+    except ValidationError as err:
+        # Undo any seats taken before the error
+        db.session.rollback()
+        # Handle invalid data, sold out sections and the ticket limit
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -183,20 +373,15 @@ def update_attendee(event_id, attendee_id):
 # Function to delete an attendee record
 def delete_attending(event_id, attendee_id):
     try:
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Fetch the event and the specific attendee for it in one query
+        event, attendee = resolve_chain(
+            (Event, event_id), (Attending, attendee_id))
 
         # If the event does not exist
-        if not event_exists:
+        if event is None:
             # Return an error message and status code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
 
-        # Query to select the specific attendee
-        stmt = db.select(Attending).filter_by(event_id=event_id, id=attendee_id)
-        # Fetch the attendee from the database
-        attendee = db.session.scalar(stmt)
-
         # If the attendee exists, proceed with deletion
         if attendee:
             # Check if the user is an admin
@@ -206,6 +391,9 @@ def delete_attending(event_id, attendee_id):
             if not is_admin and str(attendee.attending_id) != get_jwt_identity():
                 return {"error": "User unauthorized to perform this request"}, 403
 
+            # Give the seats back to the event's inventory
+            release_seats(event_id, attendee.attending_id,
+                          attendee.seat_section, attendee.total_tickets)
             # Delete the attendee record and commit the changes to the database
             db.session.delete(attendee)
             db.session.commit()
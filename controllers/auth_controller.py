@@ -8,7 +8,8 @@ from psycopg2 import errorcodes
 from flask_jwt_extended import create_access_token
 
 # Imports from local files
-from init import bcrypt, db
+from init import db
+from hashing import generate_password_hash, check_password_hash, needs_rehash, HashingBusy
 from models.user import User, user_schema, UserSchema
 
 # Define the blueprint named "auth"
@@ -45,9 +46,9 @@ def register_user():
 
             # Hash the password if the user entered a password
             if password:
-                # Add the hashed password to the user instance
-                user.password = bcrypt.generate_password_hash(
-                    password).decode("utf-8")
+                # Add the hashed password to the user instance, hashed in
+                # the hashing pool so the request thread is not blocked
+                user.password = generate_password_hash(password)
 
             # Add and commit the new user instance to the database
             db.session.add(user)
@@ -64,6 +65,9 @@ def register_user():
             if err.orig.pgcode == errorcodes.UNIQUE_VIOLATION:
                 # Handle unique violation error
                 return {"error": "Email address already in use"}, 409
+    except HashingBusy:
+        # Too many passwords being hashed, ask the client to retry shortly
+        return {"error": "Server busy, please try again"}, 503, {"Retry-After": "1"}
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -86,17 +90,34 @@ def login_user():
         user = db.session.scalar(stmt)
 
         # Check if user exists and if the password matches the email
-        if user and bcrypt.check_password_hash(user.password, body_data.get("password")):
+        password = body_data.get("password")
+        if user and check_password_hash(user.password, password):
+            # Hash the password again if the cost factor (BCRYPT_LOG_ROUNDS)
+            # changed since it was hashed, this is the only time we have it
+            if needs_rehash(user.password):
+                try:
+                    user.password = generate_password_hash(password)
+                    db.session.commit()
+                except HashingBusy:
+                    # Not needed to log in, try again on the next login
+                    db.session.rollback()
+
             # Create a JWT token
             # Identity is the id of the user, which must be converted to a string
+            # The admin status is added as a claim so authorise_as_admin can
+            # skip the DB when JWT_TRUST_ADMIN_CLAIM is on
             token = create_access_token(identity=str(
-                user.id), expires_delta=timedelta(days=1))
+                user.id), additional_claims={"is_admin": bool(user.is_admin)},
+                expires_delta=timedelta(days=1))
 
             # Respond back to the frontend with the user's email, admin status, and token
             return {"email": user.email, "is_admin": user.is_admin, "token": token}
         else:
             # If user doesn't exist or password doesn't match, respond with an error
             return {"error": "Invalid email or password"}, 401
+    except HashingBusy:
+        # Too many passwords being checked, ask the client to retry shortly
+        return {"error": "Server busy, please try again"}, 503, {"Retry-After": "1"}
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
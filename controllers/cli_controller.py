@@ -3,10 +3,13 @@
 
 # Built-in Python Libraries
 from datetime import datetime, date
+import signal
+import threading
+import time
 import click
 
 # External Libraries
-from flask import Blueprint
+from flask import Blueprint, current_app
 
 # Imports from local files
 from init import db, bcrypt
@@ -17,25 +20,86 @@ from models.like import Like
 from models.event import Event
 from models.attending import Attending
 from models.invoice import Invoice
+from models.event_stats import (EventStats, COUNTER_COLUMNS, read_stats,
+                                rebuild_stats)
+from models.event_sales import (ALL_EVENTS, BUCKETS, SALES_COLUMNS,
+                                read_sales, clear_sales)
+from search import SEARCH_COLUMNS, build_search_index
+from seed_data import seed_synthetic, DEFAULT_CHUNK_SIZE, SEED_PASSWORD
+from replicas import sync_sqlite_replicas
+from indexes import index_report
+import migrations
+import jobs
 
 # Define the blueprint named "db"
 db_commands = Blueprint("db", __name__)
+# Define the blueprint for the "jobs" commands
+job_commands = Blueprint("job_commands", __name__, cli_group="jobs")
 
-# CLI to create the tables in the db
+# CLI to create the tables in the db, or bring an existing db up to date,
+# by running the migrations it does not have yet (see migrations/)
 
 
 @db_commands.cli.command("create")
 # Define the function to create the tables
 def create_tables():
     try:
-        # Create all the tables in the db
-        db.create_all()
+        # Run the migrations the db does not have yet
+        count = migrations.upgrade(db.engine, report=lambda version, name:
+                                   print(f"Applied migration {version} {name}"))
         # Print message to confirm tables were created
-        print("Tables created")
+        if count:
+            print("Tables created")
+        else:
+            print("Tables are up to date")
     except Exception as e:
         # Print error message if tables were not created
         print(f"Error creating tables: {str(e)}")
 
+# CLI to list the migrations and whether the db has them
+# To call this CLI command please write 'flask db migrations'
+
+
+@db_commands.cli.command("migrations")
+# Define the function to list the migrations
+def list_migrations():
+    try:
+        for version, name, applied in migrations.status(db.engine):
+            print(f"{version} {name}: {'applied' if applied else 'pending'}")
+    except Exception as e:
+        # Print error message if the migrations could not be listed
+        print(f"Error listing migrations: {str(e)}")
+
+# CLI to list the columns the routes filter or sort on, and the foreign
+# keys, that no index in the db covers. Exits with status 1 if there are any
+# To call this CLI command please write 'flask db index-report'
+
+
+@db_commands.cli.command("index-report")
+# Define the function to report unindexed columns
+def report_indexes():
+    try:
+        with db.engine.connect() as connection:
+            rows, missing = index_report(connection)
+    except Exception as e:
+        # Print error message if the db could not be inspected
+        print(f"Error inspecting indexes: {str(e)}")
+        raise SystemExit(1)
+    if not rows:
+        print("No tables, run 'flask db create'")
+        raise SystemExit(1)
+    unindexed = 0
+    for table, columns, used_by, indexed in rows:
+        if not indexed:
+            unindexed += 1
+        print(f"{'ok' if indexed else 'UNINDEXED':<10}"
+              f"{table}({', '.join(columns)}) - {used_by}")
+    for name in missing:
+        print(f"Index {name} is missing, run 'flask db create'")
+    print(f"{unindexed} unindexed, {len(missing)} missing")
+    if unindexed or missing:
+        raise SystemExit(1)
+
 # CLI to drop all the tables in the db
 
 
@@ -45,12 +109,55 @@ def drop_tables():
     try:
         # Drop all the tables in the db
         db.drop_all()
+        # Forget the migrations, 'flask db create' runs them all again
+        migrations.drop_history(db.engine)
         # Print message to confirm tables were dropped
         print("Tables dropped")
     except Exception as e:
         # Print error message if tables were not dropped
         print(f"Error dropping tables: {str(e)}")
 
+# CLI to create the search indexes on a database whose tables were created
+# before search indexes were added, also rebuilds the SQLite search tables
+# To call this CLI command please write 'flask db search_index'
+
+
+@db_commands.cli.command("search_index")
+# Define the function to build the search indexes
+def create_search_indexes():
+    try:
+        for model, column in SEARCH_COLUMNS:
+            # Build the index and report which column it covers
+            if build_search_index(model.__table__, column):
+                print(f"Search index built for {model.__tablename__}.{column}")
+            else:
+                print(f"No search index for {model.__tablename__}.{column} "
+                      "on this database, searches will use LIKE")
+    except Exception as e:
+        # Print error message if the indexes could not be built
+        print(f"Error building search indexes: {str(e)}")
+
+# CLI to copy a SQLite database to its SQLite read replicas, to try out read
+# replicas locally. Real replicas are kept up to date by the database
+# To call this CLI command please write 'flask db sync_replicas'
+
+
+@db_commands.cli.command("sync_replicas")
+# Define the function to copy the database to the replicas
+def sync_replicas():
+    try:
+        replicas = [bind["url"] for bind in
+                    current_app.config["SQLALCHEMY_BINDS"].values()]
+        if not replicas:
+            print("No replicas, set DATABASE_REPLICA_URLS")
+            return
+        for path in sync_sqlite_replicas(
+                current_app.config["SQLALCHEMY_DATABASE_URI"], replicas):
+            print(f"Copied the database to {path}")
+    except Exception as e:
+        # Print error message if the replicas could not be copied
+        print(f"Error copying the database to the replicas: {str(e)}")
+
 # CLI to count all tickets sold to an event
 # To call this CLI command please write 'flask db total_count <int:event_id>'
 # For example, 'flask db total_count 2' for event with id 2
@@ -61,28 +168,139 @@ def drop_tables():
 # Define the function to count all tickets sold to an event
 def count_attending(event_id):
     try:
-        # Query to sum total_tickets for the specified event_id
-        total_tickets_sold = db.session.query(db.func.sum(
-            Attending.total_tickets)).filter_by(event_id=event_id).scalar()
-        # If total_tickets_sold is None, set it to 0
-        if total_tickets_sold is None:
-            total_tickets_sold = 0
-        # Query to get the event with the specified event_id
-        stmt = db.select(Event).filter_by(id=event_id)
-        # Fetch the event from the DB with correct id
-        event = db.session.scalar(stmt)
+        # Read the tickets sold from the event's stats
+        stats = read_stats(event_id)
+        # If the event does not exist, no tickets were sold
+        total_tickets_sold = stats.tickets_sold if stats is not None else 0
         click.echo(f"Total tickets sold for Event ID {
                    event_id}: {total_tickets_sold}")
     except Exception as e:
         # Print error message if total tickets sold could not be counted
         print(f"Error counting total tickets sold: {str(e)}")
 
+# CLI to print the stats of events as CSV, one line per event
+# To call this CLI command please write 'flask db stats <int:event_id>', or
+# 'flask db stats --all' for every event, read with a single query.
+# 'flask db stats --rebuild' counts every event's stats again from the
+# attending and invoices tables with a single GROUP BY first
+
+
+@db_commands.cli.command("stats")
+@click.argument("event_id", type=int, required=False)
+@click.option("--all", "all_events", is_flag=True,
+              help="Print the stats of every event")
+@click.option("--rebuild", is_flag=True,
+              help="Count the stats again from the attending and invoices "
+              "tables")
+# Define the function to print the stats of events
+def print_stats(event_id, all_events, rebuild):
+    if event_id is None and not all_events and not rebuild:
+        raise click.UsageError("Give an event id, --all or --rebuild")
+    try:
+        if rebuild:
+            # Replace every row with a fresh count
+            click.echo(f"Rebuilt the stats of {rebuild_stats()} events",
+                       err=True)
+        if event_id is None and not all_events:
+            return
+        if all_events:
+            # Every event with one query, events with no row yet have no
+            # bookings or invoices
+            stmt = (db.select(Event.id, *[
+                db.func.coalesce(getattr(EventStats, column), 0)
+                for column in COUNTER_COLUMNS])
+                .outerjoin(EventStats, EventStats.event_id == Event.id)
+                .order_by(Event.id))
+            rows = db.session.execute(stmt)
+        else:
+            stats = read_stats(event_id)
+            if stats is None:
+                raise click.ClickException(f"Event with id {event_id} not found")
+            rows = [[event_id] + [getattr(stats, column)
+                                  for column in COUNTER_COLUMNS]]
+        click.echo(",".join(["event_id"] + COUNTER_COLUMNS))
+        for row in rows:
+            # Revenue to the cent
+            click.echo(",".join(str(round(value, 2) if isinstance(value, float)
+                                    else value) for value in row))
+    except click.ClickException:
+        raise
+    except Exception as e:
+        # Print error message if the stats could not be read
+        print(f"Error reading event stats: {str(e)}")
+
+# CLI to print the sales of an event per day, week or month as CSV, one
+# line per bucket with sales, oldest first
+# To call this CLI command please write 'flask db sales <int:event_id>
+# --bucket week', or 'flask db sales --all' for every event together.
+# 'flask db sales --clear' deletes the cached closed buckets first, so they
+# are counted again, e.g. after changing the attending or invoices tables
+# with SQL
+
+
+@db_commands.cli.command("sales")
+@click.argument("event_id", type=int, required=False)
+@click.option("--all", "all_events", is_flag=True,
+              help="Print the sales of every event together")
+@click.option("--bucket", type=click.Choice(BUCKETS), default="day",
+              show_default=True, help="Size of the buckets")
+@click.option("--clear", is_flag=True,
+              help="Delete the cached buckets so they are counted again")
+# Define the function to print the sales of events
+def print_sales(event_id, all_events, bucket, clear):
+    if event_id is None and not all_events and not clear:
+        raise click.UsageError("Give an event id, --all or --clear")
+    try:
+        if clear:
+            click.echo(f"Cleared {clear_sales()} cached buckets", err=True)
+        if event_id is None and not all_events:
+            return
+        if not all_events and db.session.get(Event, event_id) is None:
+            raise click.ClickException(f"Event with id {event_id} not found")
+        rows = read_sales(ALL_EVENTS if all_events else event_id, bucket)
+        click.echo(",".join(["start"] + SALES_COLUMNS))
+        for row in rows:
+            # Revenue to the cent
+            click.echo(",".join([row.start.isoformat()] + [
+                str(round(row.revenue, 2) if column == "revenue"
+                    else getattr(row, column)) for column in SALES_COLUMNS]))
+    except click.ClickException:
+        raise
+    except Exception as e:
+        # Print error message if the sales could not be read
+        print(f"Error reading event sales: {str(e)}")
+
 # CLI to seed all the tables in the db
+# 'flask db seed' adds a few handwritten rows. Given any volume, e.g.
+# 'flask db seed --users 100000 --events 20000 --attending 1000000', it
+# generates that many rows instead (see seed_data.py). Each event holds
+# 135 tickets, so about one booking in 50 needs its own event
 
 
 @db_commands.cli.command("seed")
+@click.option("--users", type=click.IntRange(0), help="Users to generate")
+@click.option("--events", type=click.IntRange(0), help="Events to generate")
+@click.option("--posts", type=click.IntRange(0), help="Posts to generate")
+@click.option("--comments", type=click.IntRange(0),
+              help="Comments to generate, on random posts")
+@click.option("--likes", type=click.IntRange(0),
+              help="Likes to generate, spread over the posts")
+@click.option("--attending", type=click.IntRange(0),
+              help="Bookings to generate with an invoice each, spread over "
+              "the events until they sell out")
+@click.option("--seed", type=int, default=0, show_default=True,
+              help="Random seed, the same seed generates the same data")
+@click.option("--chunk-size", type=click.IntRange(1),
+              default=DEFAULT_CHUNK_SIZE, show_default=True,
+              help="Rows inserted per statement and commit")
 # Define the function to seed the tables
-def seed_tables():
+def seed_tables(users, events, posts, comments, likes, attending, seed,
+                chunk_size):
+    volumes = {"users": users, "events": events, "posts": posts,
+               "comments": comments, "likes": likes, "attending": attending}
+    # Generate the data if any volume was given
+    if any(volume is not None for volume in volumes.values()):
+        return seed_generated(volumes, seed, chunk_size)
     try:
         # Create a list of user instances including one admin user that
         # will be added to the users table
@@ -241,3 +459,68 @@ def seed_tables():
     except Exception as e:
         # Print error message if tables were not seeded
         print(f"Error seeding tables: {str(e)}")
+
+# Define the function to seed the tables with generated data, printing the
+# progress of each table as it goes
+
+
+def seed_generated(volumes, seed, chunk_size):
+    volumes = {table: volume or 0 for table, volume in volumes.items()}
+    # Every other row belongs to a user
+    if not volumes["users"] and any(volumes.values()):
+        raise click.UsageError("--users is needed to generate other rows")
+    start = time.perf_counter()
+    # Time each table started, for its rows per second
+    started = {}
+
+    # Define the function printing the progress after each chunk
+    def report(table, done, total):
+        now = time.perf_counter()
+        # The first chunk of a table started when the previous one finished
+        began = started.setdefault(table, started.get("last", start))
+        started["last"] = now
+        rate = done / max(now - began, 1e-9)
+        click.echo(f"{table}: {done:,}/{total:,} rows ({rate:,.0f} rows/sec)")
+
+    try:
+        counts = seed_synthetic(**volumes, seed=seed, chunk_size=chunk_size,
+                                report=report)
+        click.echo(f"Tables seeded in {time.perf_counter() - start:.1f}s: "
+                   + ", ".join(f"{count:,} {table}"
+                               for table, count in counts.items()))
+        click.echo(f"Every user's password is {SEED_PASSWORD}, "
+                   "user1@example.com is an admin")
+    except Exception as e:
+        # Print error message if tables were not seeded
+        db.session.rollback()
+        print(f"Error seeding tables: {str(e)}")
+
+# CLI to start the background job workers (see jobs.py), runs until it is
+# stopped with Ctrl+C or SIGTERM, then waits for the running jobs to finish
+# To call this CLI command please write 'flask jobs worker'
+
+
+@job_commands.cli.command("worker")
+@click.option("--workers", type=click.IntRange(1),
+              help="Worker threads, JOB_WORKERS by default")
+@click.option("--burst", is_flag=True,
+              help="Stop once no jobs are queued")
+# Define the function to run the job workers
+def run_job_workers(workers, burst):
+    app = current_app._get_current_object()
+    count = workers or app.config["JOB_WORKERS"]
+    stop = threading.Event()
+    # Stop taking new jobs when the process manager asks us to stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    threads = jobs.start_workers(app, count, stop, burst)
+    print(f"Started {count} job worker(s)")
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        print("Stopping once the running jobs finish")
+        for thread in threads:
+            thread.join()
+    print("Job workers stopped")
@@ -4,12 +4,14 @@ from datetime import datetime
 # External Libraries
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
-from models.comment import Comment, comment_schema, comments_schema
+from models.comment import Comment, comment_schema, comments_schema, comment_loader_profile
 from models.post import Post
-from utils import authorise_as_admin
+import models.post_counts  # Keeps Post.comment_count up to date
+from utils import authorise_as_admin, eager_load, select_fields, resolve_chain, conditional_get
 
 
 # Create a Blueprint for comment-related routes
@@ -26,29 +28,32 @@ comments_bp = Blueprint("comments", __name__,
 
 @comments_bp.route("/<int:comment_id>")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Comment, comment_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch a specific comment
 def fetch_single_comment(post_id, comment_id):
     try:
-        # Check if the post exists
-        post_exists = db.session.query(Post.id).filter_by(
-            id=post_id).scalar() is not None
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(comment_schema, comment_loader_profile)
+        # Fetch the post and the comment on it with id = comment_id in one query
+        post, comment = resolve_chain(
+            (Post, post_id), (Comment, comment_id),
+            options=eager_load(Comment, profile))
         # If post does not exist
-        if not post_exists:
+        if post is None:
             # Return error message to client and status code
             return {"error": f"Post with id '{post_id}' does not exist."}, 404
 
-        # Find the comment in the DB with the id = comment_id
-        stmt = db.select(Comment).filter_by(id=comment_id)
-        # Fetch the comment from the DB with correct id
-        comment = db.session.scalar(stmt)
         # If comment exists
         if comment:
             # Return the comment data and status code
-            return comment_schema.dump(comment), 200
+            return schema.dump(comment), 200
         # If comment does not exist
         else:
             # Return error message to client and status code
             return {"error": f"Comment with id {comment_id} not found"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -59,6 +64,7 @@ def fetch_single_comment(post_id, comment_id):
 
 @comments_bp.route("/")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Comment, comment_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch all comments on a post
 def fetch_comments(post_id):
     try:
@@ -70,12 +76,41 @@ def fetch_comments(post_id):
             # Return error message to client and status code
             return {"error": f"Post with id '{post_id}' does not exist."}, 404
 
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(comments_schema, comment_loader_profile)
         # Fetch all comments linked to the post
         stmt = db.select(Comment).filter_by(
-            post_id=post_id).order_by(Comment.id.asc())
+            post_id=post_id).order_by(Comment.id.asc()).options(
+            *eager_load(Comment, profile))
         comments = db.session.scalars(stmt)
         # Return the comments and status code
-        return comments_schema.dump(comments), 200
+        return schema.dump(comments), 200
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
+# GET - Fetch the number of comments on a post, without loading them
+# /<int:post_id>/comments/count
+
+
+@comments_bp.route("/count")
+@jwt_required() # Protect the route with JWT
+@conditional_get(Post, {})  # Answer If-None-Match with 304
+# Define the function to count the comments on a post
+def count_comments(post_id):
+    try:
+        # Read the post's comment count
+        comment_count = db.session.scalar(
+            db.select(Post.comment_count).filter_by(id=post_id))
+        # If post does not exist
+        if comment_count is None:
+            # Return error message to client and status code
+            return {"error": f"Post with id '{post_id}' does not exist."}, 404
+        # Return the count and status code
+        return {"post_id": post_id, "comment_count": comment_count}, 200
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -126,10 +161,13 @@ def create_comment(post_id):
 # Define the function to delete a comment
 def delete_comment(post_id, comment_id):
     try:
-        # Find the comment from the DB
-        stmt = db.select(Comment).filter_by(id=comment_id)
-        # Get the comment
-        comment = db.session.scalar(stmt)
+        # Fetch the post and the comment on it with id = comment_id in one query
+        post, comment = resolve_chain((Post, post_id), (Comment, comment_id))
+        # If post does not exist
+        if post is None:
+            # Return error message to client and status code
+            return {"error": f"Post with id '{post_id}' does not exist."}, 404
+
         # If comment exists
         if comment:
             # Check whether the user is an admin
@@ -162,10 +200,13 @@ def update_comment(post_id, comment_id):
     try:
         # Get the values from the payload
         body_data = comment_schema.load(request.get_json())
-        # Find the comment in the DB with the id = comment_id
-        stmt = db.select(Comment).filter_by(id=comment_id)
-        # Fetch the comment from the DB with correct id
-        comment = db.session.scalar(stmt)
+        # Fetch the post and the comment on it with id = comment_id in one query
+        post, comment = resolve_chain((Post, post_id), (Comment, comment_id))
+        # If post does not exist
+        if post is None:
+            # Return error message to client and status code
+            return {"error": f"Post with id '{post_id}' does not exist."}, 404
+
         # If comment exists
         if comment:
             # If the user is not the owner of the post
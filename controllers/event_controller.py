@@ -3,35 +3,88 @@
 # External Libraries
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
-from models.event import Event, event_schema, events_schema
+from models.event import Event, event_schema, events_schema, event_loader_profile
+from models.event_stats import EventStats, event_stats_schema, read_stats
+from models.attending import Attending
+from models.event_sales import ALL_EVENTS, sales_buckets_schema, get_bucket, read_sales
 from controllers.attending_controller import attending_bp
-from utils import authorise_as_admin
+from utils import authorise_as_admin, paginate, eager_load, select_fields, conditional_get, keyset_order, wants_stream, stream_rows
+from search import search_query, paginate_search
+from jobs import job, wants_job, queue_job
+from replicas import use_primary
 
 # Define the Blueprint for the events
 events_bp = Blueprint("events", __name__, url_prefix="/events")
 # Register the attending_bp blueprint to the events_bp
 events_bp.register_blueprint(attending_bp)
 
+# Define a function to fetch a page of events, or stream them all. Reads
+# on db.session unless another session is given, shared by the route and
+# the async entry point (asgi.py)
+
+
+def list_events(session=None):
+    try:
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(events_schema, event_loader_profile)
+        # Get records from the events table along with their nested data
+        stmt = db.select(Event).options(*eager_load(Event, profile))
+        # Stream every event as NDJSON if the client asked for it
+        if wants_stream():
+            return stream_rows(keyset_order(stmt, Event.id, Event.date), schema)
+        # Retrieves one page of 'Event' objects ordered by date in descending
+        # order, along with the cursor for the next page
+        events, next_cursor = paginate(stmt, Event.id, Event.date,
+                                       session=session)
+        # Serialises the list of "Event" objects into JSON so that it can be 
+        # returned to client
+        return {"data": schema.dump(events), "next_cursor": next_cursor}, 200
+    except ValidationError as err:
+        # Handle an invalid cursor, limit or field selection
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
 # GET - Fetch all events
 # /events/
 
 
 @events_bp.route("/")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Event, event_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch all events
 def get_all_events():
+    return list_events()
+
+# Define a function to fetch a single event, on db.session unless another
+# session is given, shared by the route and the async entry point
+
+
+def read_event(event_id, session=None):
     try:
-        # Get all records from the events table ordered by date in 
-        # descending order
-        stmt = db.select(Event).order_by(Event.date.desc())
-        # Retrieves the query results as individual 'Event' objects
-        events = db.session.scalars(stmt)
-        # Serialises the list of "Event" objects into JSON so that it can be 
-        # returned to client
-        return events_schema.dump(events), 200
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(event_schema, event_loader_profile)
+        # Select a single iteration of the Event Model from the DB
+        stmt = db.select(Event).filter_by(id=event_id).options(
+            *eager_load(Event, profile))
+        # Retrieve the row where the ids match
+        event = (session or db.session).scalar(stmt)
+        # If event object exists
+        if event:
+            # Serialise into JSON and return to client
+            return schema.dump(event), 200
+        # If does not exist
+        else:
+            # Return message and error status code
+            return {"error": f"Event with id {event_id} not found"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -42,18 +95,30 @@ def get_all_events():
 
 @events_bp.route("/<int:event_id>")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Event, event_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch a single event
 def get_single_event(event_id):
+    return read_event(event_id)
+
+# GET - Fetch the tickets sold, revenue and seats per section of an event
+# /events/<int:event_id>/stats
+# Reads the event's row of the event_stats table, which every booking and
+# invoice write keeps up to date (see models/event_stats.py)
+
+
+@events_bp.route("/<int:event_id>/stats")
+@jwt_required() # Protect the route with JWT
+@conditional_get(EventStats, {})  # Answer If-None-Match with 304
+# Define the function to fetch the stats of an event
+def get_event_stats(event_id):
     try:
-        # Select a single iteration of the Event Model from the DB
-        stmt = db.select(Event).filter_by(id=event_id)
-        # Retrieve the row where the ids match
-        event = db.session.scalar(stmt)
-        # If event object exists
-        if event:
+        # Get the event's stats, None if the event does not exist
+        stats = read_stats(event_id)
+        # If the stats exist
+        if stats is not None:
             # Serialise into JSON and return to client
-            return event_schema.dump(event), 200
-        # If does not exist
+            return event_stats_schema.dump(stats), 200
+        # If the event does not exist
         else:
             # Return message and error status code
             return {"error": f"Event with id {event_id} not found"}, 404
@@ -61,29 +126,90 @@ def get_single_event(event_id):
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# GET - Fetch the tickets sold and revenue of an event per day, week or
+# month, e.g. /events/<int:event_id>/sales?bucket=week
+# Closed buckets are counted once and kept (see models/event_sales.py)
+
+
+@events_bp.route("/<int:event_id>/sales")
+@jwt_required() # Protect the route with JWT
+@use_primary  # The closed buckets are kept on the primary
+@conditional_get(Attending, {"invoice": {}})  # Answer If-None-Match with 304
+# Define the function to fetch the sales of an event over time
+def get_event_sales(event_id):
+    try:
+        # Read the bucket size from the query string
+        bucket = get_bucket()
+        # Check if the event exists
+        if db.session.get(Event, event_id) is None:
+            # Return message and error status code
+            return {"error": f"Event with id {event_id} not found"}, 404
+        # Serialise the buckets, oldest first, into JSON
+        return {"event_id": event_id, "bucket": bucket,
+                "data": sales_buckets_schema.dump(
+                    read_sales(event_id, bucket))}, 200
+    except ValidationError as err:
+        # Handle an invalid bucket
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
+# GET - Fetch the tickets sold and revenue of every event together per day,
+# week or month, e.g. /events/sales?bucket=month
+
+
+@events_bp.route("/sales")
+@jwt_required() # Protect the route with JWT
+@use_primary  # The closed buckets are kept on the primary
+@conditional_get(Attending, {"invoice": {}})  # Answer If-None-Match with 304
+# Define the function to fetch the sales of every event over time
+def get_all_sales():
+    try:
+        # Only admins can see the sales of every event
+        if not authorise_as_admin():
+            return {"error": "User unauthorized to perform this request"}, 403
+        # Read the bucket size from the query string
+        bucket = get_bucket()
+        # Serialise the buckets, oldest first, into JSON
+        return {"bucket": bucket, "data": sales_buckets_schema.dump(
+            read_sales(ALL_EVENTS, bucket))}, 200
+    except ValidationError as err:
+        # Handle an invalid bucket
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
 # GET - Fetch event/s by partial event_title
 # /events/search/<string:event_title>
 
 
 @events_bp.route("/search/<string:event_title>")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Event, event_loader_profile)  # Answer If-None-Match with 304
 # Define the function to search for events by title
 def search_event_by_name(event_title):
     try:
-        # Construct the LIKE pattern for partial matching
-        like_pattern = f"%{event_title}%"
-        # Perform a case-insensitive search using ilike (case-insensitive LIKE)
-        stmt = db.select(Event).filter(Event.title.ilike(like_pattern))
-        # Retrieve all matching events
-        events = db.session.scalars(stmt).all()
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(events_schema, event_loader_profile)
+        # Search the title search index, see search.py
+        stmt, score = search_query(Event, "title", event_title)
+        stmt = stmt.options(*eager_load(Event, profile))
+        # Retrieve one page of matching events, best match first, along with
+        # the cursor for the next page
+        events, next_cursor = paginate_search(stmt, score, Event.id)
         # If events are found
         if events:
             # Return the serialised data
-            return events_schema.dump(events), 200
+            return {"data": schema.dump(events), "next_cursor": next_cursor}, 200
         # If no events are found
         else:
             # Return an error message and status code
             return {"error": f"No events found matching '{event_title}'"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -136,12 +262,11 @@ def delete_event(event_id):
             # If the user is not the owner of the post
             if not is_admin and str(event.event_admin_id) != get_jwt_identity():
                 return {"error": "User unauthorized to perform this request"}, 403
-            # Delete the event from the session
-            db.session.delete(event)
-            # Commit the session to the DB
-            db.session.commit()
-            # Return a success message
-            return {"message": f"Event '{event.title}' deleted successfully"}, 200
+            # Delete the event in a background job if the client asked to
+            if wants_job():
+                return queue_job("delete_event", event_id=event_id)
+            # Delete the event and return a success message
+            return remove_event(event_id), 200
         # If event does not exist
         else:
             # Return an error message and status code
@@ -150,6 +275,22 @@ def delete_event(event_id):
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# Define a function to delete an event with its bookings, invoices and
+# stats, run by the delete route or as a job. Returns a message
+
+
+@job("delete_event", idempotent=True)
+def remove_event(event_id):
+    event = db.session.get(Event, event_id)
+    # Deleted since the job was queued
+    if event is None:
+        return {"message": f"Event with id {event_id} was already deleted"}
+    # Delete the event from the session
+    db.session.delete(event)
+    # Commit the session to the DB
+    db.session.commit()
+    return {"message": f"Event '{event.title}' deleted successfully"}
+
 # PUT or PATCH - Update an event
 # /events/<int:event_id>
 
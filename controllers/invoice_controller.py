@@ -4,13 +4,15 @@ from datetime import datetime
 # External Libraries
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
-from models.invoice import Invoice, invoice_schema, invoices_schema
-from utils import authorise_as_admin
+from models.invoice import Invoice, invoice_schema, invoices_schema, invoice_loader_profile
+from utils import authorise_as_admin, eager_load, select_fields, resolve_chain, conditional_get, get_bulk_items, bulk_insert, bulk_response
 from models.event import Event
 from models.attending import Attending
+from jobs import job, wants_job, queue_job, report_progress
 
 # Define the Blueprint for the invoices
 invoice_bp = Blueprint("invoices", __name__,
@@ -22,36 +24,36 @@ invoice_bp = Blueprint("invoices", __name__,
 
 @invoice_bp.route("/<int:invoice_id>", methods=["GET"])
 @jwt_required() # Protect the route with JWT
+@conditional_get(Invoice, invoice_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch a specific invoice
 def fetch_specific_invoice(event_id, attending_id, invoice_id):
     try:
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(invoice_schema, invoice_loader_profile)
+        # Fetch the event, attending record and invoice in one query
+        event, attending, invoice = resolve_chain(
+            (Event, event_id), (Attending, attending_id), (Invoice, invoice_id),
+            options=eager_load(Invoice, profile))
         # If event does not exist
-        if not event_exists:
+        if event is None:
             # Return error message to client and status code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
-
-        # Check if the attending exists
-        attending_exists = db.session.query(Attending.id).filter_by(
-            id=attending_id).scalar() is not None
         # If attending does not exist
-        if not attending_exists:
+        if attending is None:
             # Return error message to client
             return {"error": f"Attending with id '{attending_id}' does not exist."}, 404
 
-        # Check if the specific invoice exists for the given event and attending ID
-        invoice = db.session.query(Invoice).filter_by(
-            event_id=event_id, attendee_id=attending_id, id=invoice_id).first()
         # If invoice exists
         if invoice:
             # Return the invoice data and status code
-            return invoice_schema.dump(invoice), 200
+            return schema.dump(invoice), 200
         # If invoice does not exist
         else:
             # Return error message to client and status code
             return {"error": f"Invoice with id '{invoice_id}' not found for event with id '{event_id}' and attending id '{attending_id}'"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -62,38 +64,41 @@ def fetch_specific_invoice(event_id, attending_id, invoice_id):
 
 @invoice_bp.route("/")
 @jwt_required() # Protect the route with JWT
+@conditional_get(Invoice, invoice_loader_profile)  # Answer If-None-Match with 304
 # Define the function to fetch all invoices for a specific event and attending ID
 def fetch_event_attending(event_id, attending_id):
     try:
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Check the event and attending record exist in one query
+        event, attending = resolve_chain(
+            (Event, event_id), (Attending, attending_id))
         # If event does not exist
-        if not event_exists:
+        if event is None:
             # Return error message to client and staus code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
-
-        # Check if the attending exists
-        attending_exists = db.session.query(Attending.id).filter_by(
-            id=attending_id).scalar() is not None
         # If attending does not exist
-        if not attending_exists:
+        if attending is None:
             # Return error message to client and status code
             return {"error": f"Attending with id '{attending_id}' does not exist."}, 404
 
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(invoices_schema, invoice_loader_profile)
         # Fetch all invoices for the given event and attending ID
         stmt = db.select(Invoice).filter_by(
-            event_id=event_id, attendee_id=attending_id).order_by(Invoice.timestamp.desc())
+            event_id=event_id, attendee_id=attending_id).order_by(Invoice.timestamp.desc()).options(
+            *eager_load(Invoice, profile))
         # Get all invoices linked to the event and attending ID
         invoices = db.session.scalars(stmt).all()
         # If invoices exist
         if invoices:
             # Return the invoices and status code
-            return invoices_schema.dump(invoices), 200
+            return schema.dump(invoices), 200
         # If invoices do not exist
         else:
             # Return error message to client and status code
             return {"error": f"No invoices found for event with id '{event_id}' and attending id '{attending_id}"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -109,19 +114,15 @@ def new_invoice(event_id, attending_id):
     try:
         # Get the request data from the payload
         body_data = request.get_json()
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Check the event and attendee exist in one query
+        event, attending = resolve_chain(
+            (Event, event_id), (Attending, attending_id))
         # If event does not exist
-        if not event_exists:
+        if event is None:
             # Return error message to client and status code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
-
-        # Check if the attendee exists
-        attending_exists = db.session.query(Attending.id).filter_by(
-            id=attending_id, event_id=event_id).scalar() is not None
         # If attendee does not exist
-        if not attending_exists:
+        if attending is None:
             # Return error message to client and status code
             return {"error": f"Attendee with id '{attending_id}' does not exist for event with id '{event_id}'"}, 404
 
@@ -142,6 +143,85 @@ def new_invoice(event_id, attending_id):
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# POST route to create many invoices for a specific event and attending ID
+# in one request, the body is a JSON array of invoices
+# /events/<int:event_id>/attending/<int:attending_id>/invoice/bulk
+
+
+@invoice_bp.route("/bulk", methods=["POST"])
+@jwt_required() # Protect the route with JWT
+# Define the function to create many invoices at once
+def new_invoice_bulk(event_id, attending_id):
+    try:
+        # Get the list of invoices from the payload
+        items = get_bulk_items()
+        # Check the event and attendee exist in one query
+        event, attending = resolve_chain(
+            (Event, event_id), (Attending, attending_id))
+        # If event does not exist
+        if event is None:
+            # Return error message to client and status code
+            return {"error": f"Event with id '{event_id}' does not exist."}, 404
+        # If attendee does not exist
+        if attending is None:
+            # Return error message to client and status code
+            return {"error": f"Attendee with id '{attending_id}' does not exist for event with id '{event_id}'"}, 404
+
+        # Create the invoices in a background job if the client asked to
+        if wants_job():
+            return queue_job("create_invoices", event_id=event_id,
+                             attending_id=attending_id, items=items)
+        # Return the result of every invoice and status code
+        return bulk_response(create_invoice_results(
+            event_id, attending_id, items))
+    except ValidationError as err:
+        # Handle an invalid body
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
+# Define a function to check and create many invoices for an attendee,
+# inserted with one statement. Returns the result of every invoice, in order
+
+
+def create_invoice_results(event_id, attending_id, items):
+    # One result per invoice, filled in as they are checked
+    results = [None] * len(items)
+    rows, created = [], []
+    for index, item in enumerate(items):
+        # Validate the invoice against the Invoice schema
+        try:
+            body_data = invoice_schema.load(item, partial=True)
+        except ValidationError as err:
+            results[index] = {"status": 400, "error": err.messages}
+            continue
+        rows.append({
+            "total_cost": body_data.get("total_cost"),
+            "timestamp": datetime.now(),
+            "event_id": event_id,
+            "attendee_id": attending_id
+        })
+        created.append(index)
+    # Checked, when run as a job
+    report_progress(50)
+
+    # Insert every invoice with one statement and commit once
+    data = bulk_insert(Invoice, rows, invoice_schema, invoice_loader_profile)
+    for index, invoice in zip(created, data):
+        results[index] = {"status": 201, "data": invoice}
+    return results
+
+# Define a job to create many invoices for an attendee, its result is the
+# body the bulk route returns
+
+
+@job("create_invoices")
+def create_invoices(event_id, attending_id, items):
+    body, _ = bulk_response(create_invoice_results(
+        event_id, attending_id, items))
+    return body
+
 # DELETE route to delete a specific invoice, only Admins can delete invoices
 # /events/<int:event_id>/attending/<int:attending_id>/invoice/<int:invoice_id>
 
@@ -151,28 +231,18 @@ def new_invoice(event_id, attending_id):
 # Define the function to delete an invoice
 def delete_invoice(event_id, attending_id, invoice_id):
     try:
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Fetch the event, attendee and invoice in one query
+        event, attending, invoice = resolve_chain(
+            (Event, event_id), (Attending, attending_id), (Invoice, invoice_id))
         # If event does not exist
-        if not event_exists:
+        if event is None:
             # Return error message to client and status code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
-
-        # Check if the attendee exists
-        attending_exists = db.session.query(Attending.id).filter_by(
-            id=attending_id, event_id=event_id).scalar() is not None
         # If attendee does not exist
-        if not attending_exists:
+        if attending is None:
             # Return error message to client and status code
             return {"error": f"Attendee with id '{attending_id}' does not exist for event with id '{event_id}'"}, 404
 
-        # Fetch the invoice
-        stmt = db.select(Invoice).filter_by(
-            id=invoice_id, event_id=event_id, attendee_id=attending_id)
-        # Get the invoice
-        invoice = db.session.scalar(stmt)
-
         # If invoice exists
         if invoice:
             # check whether the user is an admin
@@ -207,28 +277,18 @@ def update_invoice(invoice_id, event_id, attending_id):
         # Get the request data from the payload
         body_data = invoice_schema.load(request.get_json())
 
-        # Check if the event exists
-        event_exists = db.session.query(Event.id).filter_by(
-            id=event_id).scalar() is not None
+        # Fetch the event, attendee and invoice in one query
+        event, attendee, invoice = resolve_chain(
+            (Event, event_id), (Attending, attending_id), (Invoice, invoice_id))
         # If event does not exist
-        if not event_exists:
+        if event is None:
             # Return error message to client and status code
             return {"error": f"Event with id '{event_id}' does not exist."}, 404
-
-        # Check if the attendee exists
-        attendee_exists = db.session.query(Attending.id).filter_by(
-            id=attending_id, event_id=event_id).scalar() is not None
-
         # If attendee does not exist
-        if not attendee_exists:
+        if attendee is None:
             # Return error message to client and status code
             return {"error": f"Attendee with id '{attending_id}' does not exist for event with id '{event_id}'"}, 404
 
-        # Fetch the invoice
-        stmt = db.select(Invoice).filter_by(
-            id=invoice_id, event_id=event_id, attendee_id=attending_id)
-        # Get the invoice
-        invoice = db.session.scalar(stmt)
         # If invoice exists
         if invoice:
             # Check whether the user is an admin
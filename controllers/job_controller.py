@@ -0,0 +1,38 @@
+# External Libraries
+from flask import Blueprint
+from flask_jwt_extended import jwt_required, get_jwt_identity
+
+# Imports from local files
+from init import db
+from models.job import Job, job_schema
+from replicas import use_primary
+from utils import authorise_as_admin
+
+# Create a Blueprint for the background job routes
+jobs_bp = Blueprint("jobs", __name__, url_prefix="/jobs")
+
+# Route to fetch the status, progress and result of a job
+# /jobs/<int:job_id>
+
+
+@jobs_bp.route("/<int:job_id>", methods=["GET"])
+@jwt_required()  # Protect the route with JWT authentication
+@use_primary  # The workers write to the primary, replicas may lag behind
+def get_job(job_id):
+    try:
+        """
+        Fetch a job queued by a route (see jobs.py). Only the user who queued
+        it and admins can see it.
+        """
+        job = db.session.get(Job, job_id)
+        if job is None:
+            # Return error if job not found
+            return {"error": f"Job with id {job_id} not found"}, 404
+        # Ensure the user is authorized to see the job
+        if not authorise_as_admin() and str(job.user_id) != get_jwt_identity():
+            return {"error": "User unauthorized to perform this request"}, 403
+        # Return the job with status code
+        return job_schema.dump(job), 200
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
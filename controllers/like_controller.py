@@ -4,12 +4,15 @@ from datetime import datetime
 # External Libraries
 from flask import Blueprint
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
-from models.like import Like, like_schema, likes_schema
+from models.like import Like, like_schema, likes_schema, like_loader_profile
 from models.post import Post
-from utils import authorise_as_admin
+import models.post_counts  # Keeps Post.like_count up to date
+from models.user import User
+from utils import authorise_as_admin, eager_load, select_fields, conditional_get, get_bulk_items, bulk_insert, bulk_response
 
 # Blueprint for like-related routes, registered under the posts blueprint
 likes_bp = Blueprint("likes", __name__, url_prefix="/<int:post_id>/likes")
@@ -20,17 +23,47 @@ likes_bp = Blueprint("likes", __name__, url_prefix="/<int:post_id>/likes")
 
 @likes_bp.route("/", methods=["GET"])
 @jwt_required()  # Protect the route with JWT authentication
+@conditional_get(Like, like_loader_profile)  # Answer If-None-Match with 304
 def fetch_all_likes_on_post(post_id):
     try:
         """
         Fetch all likes associated with a specific post.
         """
-        stmt = db.select(Like).filter_by(
-            post_id=post_id)  # Prepare SQL query to fetch likes by post ID
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(likes_schema, like_loader_profile)
+        stmt = db.select(Like).filter_by(post_id=post_id).options(
+            *eager_load(Like, profile))  # Prepare SQL query to fetch likes by post ID
         likes = db.session.scalars(stmt)  # Execute the query
         if likes:
             # Return the likes with status code 
-            return likes_schema.dump(likes), 200
+            return schema.dump(likes), 200
+        else:
+            # Return error if post not found
+            return {"error": f"Post with id {post_id} not found"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
+# Route to fetch the number of likes on a post, without loading them
+# /<int:post_id>/likes/count
+
+
+@likes_bp.route("/count", methods=["GET"])
+@jwt_required()  # Protect the route with JWT authentication
+@conditional_get(Post, {})  # Answer If-None-Match with 304
+def count_likes_on_post(post_id):
+    try:
+        """
+        Fetch the number of likes on a specific post.
+        """
+        like_count = db.session.scalar(
+            db.select(Post.like_count).filter_by(id=post_id))  # Read the count
+        if like_count is not None:
+            # Return the count with status code
+            return {"post_id": post_id, "like_count": like_count}, 200
         else:
             # Return error if post not found
             return {"error": f"Post with id {post_id} not found"}, 404
@@ -68,6 +101,71 @@ def create_like(post_id):
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# Route to create many likes on a post in one request
+# /<int:post_id>/likes/bulk
+# The body is a JSON array of likes. Each like is from the logged in user,
+# admins can add likes from other users with "user_id", e.g. [{"user_id": 2}]
+
+
+@likes_bp.route("/bulk", methods=["POST"])
+@jwt_required()  # Protect the route with JWT authentication
+def create_likes_bulk(post_id):
+    try:
+        """
+        Create many likes associated with a specific post at once.
+        """
+        items = get_bulk_items()  # Get the list of likes from the payload
+        post_exists = db.session.query(Post.id).filter_by(
+            id=post_id).scalar() is not None  # Check the post exists
+        if not post_exists:
+            # Return error if post not found
+            return {"error": f"Post with id {post_id} not found"}, 404
+
+        results = [None] * len(items)  # One result per like
+        pending = []  # Likes that passed validation, with their index
+        is_admin = None  # Only checked if a like needs it
+        for index, item in enumerate(items):
+            # Like as the logged in user unless another user is given
+            user_id = item.get("user_id") or get_jwt_identity()
+            if isinstance(user_id, bool) or not str(user_id).isdigit():
+                results[index] = {"status": 400, "error": {
+                    "user_id": ["Not a valid integer."]}}
+                continue
+            if str(user_id) != get_jwt_identity():
+                if is_admin is None:
+                    is_admin = authorise_as_admin()
+                if not is_admin:
+                    results[index] = {
+                        "status": 403,
+                        "error": "Only an admin can like as another user"}
+                    continue
+            pending.append((index, int(user_id)))
+
+        # Check every user exists in one query
+        found = set(db.session.scalars(db.select(User.id).where(
+            User.id.in_({user_id for _, user_id in pending}))))
+        rows, created = [], []
+        for index, user_id in pending:
+            if user_id not in found:
+                results[index] = {"status": 404,
+                                  "error": f"User with id '{user_id}' not found"}
+                continue
+            rows.append({"post_id": post_id, "user_id": user_id})
+            created.append(index)
+
+        # Insert every like with one statement and commit once
+        data = bulk_insert(Like, rows, like_schema, like_loader_profile)
+        for index, like in zip(created, data):
+            results[index] = {"status": 201, "data": like}
+        # Return the result of every like with status code
+        return bulk_response(results)
+    except ValidationError as err:
+        # Handle an invalid body
+        return {"error": err.messages}, 400
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
+
 # Route to delete a like by like_id
 # /<int:post_id>/likes/<int:like_id>
 
@@ -0,0 +1,32 @@
+# Built-in Python Libraries
+import hmac
+
+# External Libraries
+from flask import Blueprint, current_app, request
+
+# Imports from local files
+import metrics
+
+# Blueprint for the app's own metrics, at the top level of the app
+metrics_bp = Blueprint("metrics", __name__)
+
+# Route to fetch the metrics in the Prometheus text format
+# /metrics
+
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    try:
+        """
+        Return request, error and connection pool metrics for Prometheus.
+        """
+        # If METRICS_TOKEN is set, only a scraper sending it may read them
+        token = current_app.config.get("METRICS_TOKEN")
+        if token and not hmac.compare_digest(
+                request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return {"error": "Invalid metrics token"}, 401
+        return current_app.response_class(
+            metrics.render(), mimetype="text/plain; version=0.0.4")
+    except Exception as e:
+        # Handle unexpected errors
+        return {"error": str(e)}, 500
@@ -4,13 +4,14 @@ from datetime import datetime
 # External Libraries
 from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
 from controllers.comment_controller import comments_bp
 from controllers.like_controller import likes_bp
-from models.post import Post, post_schema, posts_schema
-from utils import authorise_as_admin
+from models.post import Post, post_schema, posts_schema, post_loader_profile
+from utils import authorise_as_admin, paginate, eager_load, select_fields, conditional_get, keyset_order, wants_stream, stream_rows
 
 # Create a Blueprint for post-related routes
 posts_bp = Blueprint("posts", __name__, url_prefix="/posts")
@@ -19,50 +20,83 @@ posts_bp = Blueprint("posts", __name__, url_prefix="/posts")
 posts_bp.register_blueprint(comments_bp)
 posts_bp.register_blueprint(likes_bp)
 
-# Route to fetch all posts
-# /posts/
+# Define a function to fetch a page of posts, or stream them all. Reads on
+# db.session unless another session is given, shared by the route and the
+# async entry point (asgi.py)
 
 
-@posts_bp.route("/", methods=["GET"])
-@jwt_required()  # Protect the route with JWT authentication
-def get_all_posts():
+def list_posts(session=None):
     try:
         """
-        Fetch all posts from the database, ordered by date in descending order.
+        Fetch a page of posts from the database, ordered by date in descending
+        order. Pass the returned 'next_cursor' as '?cursor=' to get the next page.
         """
-        stmt = db.select(Post).order_by(
-            Post.date.desc())  # Prepare SQL query to fetch all posts
-        posts = db.session.scalars(stmt)  # Execute the query
-        # Return the posts with status code 
-        return posts_schema.dump(posts), 200
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(posts_schema, post_loader_profile)
+        # Prepare SQL query to fetch all posts with their nested data
+        stmt = db.select(Post).options(*eager_load(Post, profile))
+        # Stream every post as NDJSON if the client asked for it
+        if wants_stream():
+            return stream_rows(keyset_order(stmt, Post.id, Post.date), schema)
+        # Execute the query for one page, newest posts first
+        posts, next_cursor = paginate(stmt, Post.id, Post.date,
+                                      session=session)
+        # Return the posts and next page cursor with status code
+        return {"data": schema.dump(posts), "next_cursor": next_cursor}, 200
+    except ValidationError as err:
+        # Handle an invalid cursor, limit or field selection
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
-# Route to fetch a single post by post_id
-# /posts/<int:post_id>
+# Route to fetch all posts
+# /posts/
 
 
-@posts_bp.route("/<int:post_id>", methods=["GET"])
+@posts_bp.route("/", methods=["GET"])
 @jwt_required()  # Protect the route with JWT authentication
-def get_single_post(post_id):
+@conditional_get(Post, post_loader_profile)  # Answer If-None-Match with 304
+def get_all_posts():
+    return list_posts()
+
+# Define a function to fetch a single post, on db.session unless another
+# session is given, shared by the route and the async entry point
+
+
+def read_post(post_id, session=None):
     try:
         """
         Fetch a single post by post_id from the database.
         """
-        stmt = db.select(Post).filter_by(
-            id=post_id)  # Prepare SQL query to fetch post by ID
-        post = db.session.scalar(stmt)  # Execute the query
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(post_schema, post_loader_profile)
+        stmt = db.select(Post).filter_by(id=post_id).options(
+            *eager_load(Post, profile))  # Prepare SQL query to fetch post by ID
+        post = (session or db.session).scalar(stmt)  # Execute the query
         if post:
             # Return the post with status code 
-            return post_schema.dump(post), 200
+            return schema.dump(post), 200
         else:
             # Return error if post not found
             return {"error": f"Post with id {post_id} not found"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# Route to fetch a single post by post_id
+# /posts/<int:post_id>
+
+
+@posts_bp.route("/<int:post_id>", methods=["GET"])
+@jwt_required()  # Protect the route with JWT authentication
+@conditional_get(Post, post_loader_profile)  # Answer If-None-Match with 304
+def get_single_post(post_id):
+    return read_post(post_id)
+
 # Route to create a new post
 # /posts/
 
@@ -6,82 +6,127 @@ from flask import Blueprint, request
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from psycopg2 import errorcodes
 from flask_jwt_extended import create_access_token
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
-from init import bcrypt, db
-from models.user import User, user_schema, users_schema, UserSchema
-from utils import authorise_as_admin
+from init import db
+from models.user import User, user_schema, users_schema, UserSchema, user_loader_profile
+from models.seat_inventory import release_seats
+from utils import authorise_as_admin, paginate, eager_load, select_fields, conditional_get, keyset_order, wants_stream, stream_rows
+from search import search_query, paginate_search
+from hashing import generate_password_hash, HashingBusy
+from jobs import job, wants_job, queue_job
 
 # Create a Blueprint for user-related routes
 user_bp = Blueprint("user", __name__, url_prefix="/user")
 
-# Route to fetch all users
-# /user/
+# Define a function to fetch a page of users, or stream them all. Reads on
+# db.session unless another session is given, shared by the route and the
+# async entry point (asgi.py)
 
 
-@user_bp.route("/", methods=["GET"])
-@jwt_required()  # Protect the route with JWT authentication
-def get_users():
+def list_users(session=None):
     try:
         """
-        Fetch all users from the database.
+        Fetch a page of users from the database, ordered by id. Pass the
+        returned 'next_cursor' as '?cursor=' to get the next page.
         """
-        stmt = db.select(User).order_by(
-            User.id.asc())  # Prepare SQL query to fetch all users
-        users = db.session.scalars(stmt)  # Execute the query
-        # Return the users with status code 200
-        return users_schema.dump(users), 200
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(users_schema, user_loader_profile)
+        # Prepare SQL query to fetch all users with their nested data
+        stmt = db.select(User).options(*eager_load(User, profile))
+        # Stream every user as NDJSON if the client asked for it
+        if wants_stream():
+            return stream_rows(
+                keyset_order(stmt, User.id, descending=False), schema)
+        # Execute the query for one page in ascending id order
+        users, next_cursor = paginate(stmt, User.id, descending=False,
+                                      session=session)
+        # Return the users and next page cursor with status code 200
+        return {"data": schema.dump(users), "next_cursor": next_cursor}, 200
+    except ValidationError as err:
+        # Handle an invalid cursor, limit or field selection
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
-# Route to fetch a single user by user_id
-# /user/<int:user_id>
+# Route to fetch all users
+# /user/
 
 
-@user_bp.route("/<int:user_id>", methods=["GET"])
+@user_bp.route("/", methods=["GET"])
 @jwt_required()  # Protect the route with JWT authentication
-def get_user(user_id):
+@conditional_get(User, user_loader_profile)  # Answer If-None-Match with 304
+def get_users():
+    return list_users()
+
+# Define a function to fetch a single user, on db.session unless another
+# session is given, shared by the route and the async entry point
+
+
+def read_user(user_id, session=None):
     try:
         """
         Fetch a single user by user_id from the database.
         """
-        stmt = db.select(User).filter_by(
-            id=user_id)  # Prepare SQL query to fetch user by ID
-        user = db.session.scalar(stmt)  # Execute the query
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(user_schema, user_loader_profile)
+        stmt = db.select(User).filter_by(id=user_id).options(
+            *eager_load(User, profile))  # Prepare SQL query to fetch user by ID
+        user = (session or db.session).scalar(stmt)  # Execute the query
         if user:
             # Return the user with status code
-            return user_schema.dump(user), 200
+            return schema.dump(user), 200
         else:
             # Return error if user not found
             return {"error": f"User with id {user_id} not found"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
 
+# Route to fetch a single user by user_id
+# /user/<int:user_id>
+
+
+@user_bp.route("/<int:user_id>", methods=["GET"])
+@jwt_required()  # Protect the route with JWT authentication
+@conditional_get(User, user_loader_profile)  # Answer If-None-Match with 304
+def get_user(user_id):
+    return read_user(user_id)
+
 # Route to search users by partial user_name
 # /user/search/<string:user_name>
 
 
 @user_bp.route("/search/<string:user_name>", methods=["GET"])
 @jwt_required()  # Protect the route with JWT authentication
+@conditional_get(User, user_loader_profile)  # Answer If-None-Match with 304
 def search_user_by_name(user_name):
     try:
         """
         Search for users by partial user_name.
         """
-        like_pattern = f"%{
-            user_name}%"  # Construct LIKE pattern for partial matching
-        # Prepare SQL query with case-insensitive LIKE
-        stmt = db.select(User).filter(User.user_name.ilike(like_pattern))
-        # Execute the query and fetch all matching users
-        users = db.session.scalars(stmt).all()
+        # Apply any ?fields= and ?expand= selection
+        schema, profile = select_fields(users_schema, user_loader_profile)
+        # Prepare the query on the user_name search index, see search.py
+        stmt, score = search_query(User, "user_name", user_name)
+        stmt = stmt.options(*eager_load(User, profile))
+        # Execute the query and fetch one page of matching users, best
+        # match first, along with the cursor for the next page
+        users, next_cursor = paginate_search(stmt, score, User.id)
         if users:
             # Return the users with status code
-            return users_schema.dump(users), 200
+            return {"data": schema.dump(users), "next_cursor": next_cursor}, 200
         else:
             # Return error if no users found
             return {"error": f"No users found matching '{user_name}'"}, 404
+    except ValidationError as err:
+        # Handle invalid query string parameters
+        return {"error": err.messages}, 400
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -113,14 +158,17 @@ def update_user(user_id):
             user.name = body_data.get("name") or user.name
             user.user_name = body_data.get("user_name") or user.user_name
             if password:
-                user.password = bcrypt.generate_password_hash(
-                    password).decode("utf-8")  # Hash and update password
+                # Hash and update password, in the hashing pool
+                user.password = generate_password_hash(password)
             db.session.commit()  # Commit changes to the database
             # Return updated user with status code
             return user_schema.dump(user), 200
         else:
             # Return error if user does not exist
             return {"error": "User does not exist"}, 404
+    except HashingBusy:
+        # Too many passwords being hashed, ask the client to retry shortly
+        return {"error": "Server busy, please try again"}, 503, {"Retry-After": "1"}
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
@@ -145,13 +193,33 @@ def delete_user(user_id):
             if not is_admin and str(user.id) != get_jwt_identity():
                 # Return forbidden error if unauthorized
                 return {"error": "User unauthorized to perform this request"}, 403
-            db.session.delete(user)  # Delete the user
-            db.session.commit()  # Commit changes to the database
-            # Return success message with status code 
-            return {"message": f"User '{user.name}' deleted successfully"}, 200
+            # Delete the user in a background job if the client asked to
+            if wants_job():
+                return queue_job("delete_user", user_id=user_id)
+            # Delete the user and return success message with status code
+            return remove_user(user_id), 200
         else:
             # Return error if user not found
             return {"error": f"User with id '{user_id}' not found"}, 404
     except Exception as e:
         # Handle unexpected errors
         return {"error": str(e)}, 500
+
+# Define a function to delete a user with everything that belongs to them,
+# run by the delete route or as a job. Returns a message
+
+
+@job("delete_user", idempotent=True)
+def remove_user(user_id):
+    user = db.session.get(User, user_id)
+    # Deleted since the job was queued
+    if user is None:
+        return {"message": f"User with id '{user_id}' was already deleted"}
+    # Give the seats of every event the user is attending back to the
+    # event's inventory, their bookings are deleted with them
+    for attending in user.attending:
+        release_seats(attending.event_id, user.id,
+                      attending.seat_section, attending.total_tickets)
+    db.session.delete(user)  # Delete the user
+    db.session.commit()  # Commit changes to the database
+    return {"message": f"User '{user.name}' deleted successfully"}
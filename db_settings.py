@@ -0,0 +1,132 @@
+# Database engine and connection pool settings
+# Builds SQLALCHEMY_ENGINE_OPTIONS from environment variables, see the
+# "Database Connections" section of the readme for what each one trades off:
+# - DB_POOL_SIZE, DB_MAX_OVERFLOW: connections each server process keeps
+#   open, and how many more it may open under load
+# - DB_POOL_TIMEOUT: seconds a request waits for a free connection
+# - DB_POOL_RECYCLE: seconds after which a connection is replaced
+# - DB_POOL_PRE_PING: test each connection before using it
+# - DB_STATEMENT_TIMEOUT: milliseconds a single SQL statement may run for
+#   (PostgreSQL), 0 for no limit
+# - DB_ENDPOINT_TIMEOUTS: statement timeouts for particular routes, e.g.
+#   "events.get_all_events=60000,user.search_user_by_name=2000"
+
+# Built-in Python Libraries
+import os
+
+# External Libraries
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+# Constants
+# Defaults for a server process with a handful of threads. Several processes
+# share the database's connection limit (100 by default on PostgreSQL), so
+# processes x (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below it
+DEFAULTS = {
+    "DB_POOL_SIZE": 5,
+    "DB_MAX_OVERFLOW": 5,
+    "DB_POOL_TIMEOUT": 10,
+    "DB_POOL_RECYCLE": 1800,
+    "DB_POOL_PRE_PING": True,
+    "DB_STATEMENT_TIMEOUT": 30000
+}
+# Async driver used for each database by the async entry point
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}
+
+# Define a function to read a setting from the environment, falling back to
+# its default when it is not set or empty
+
+
+def setting(name, environ=os.environ):
+    value = environ.get(name)
+    default = DEFAULTS[name]
+    if value is None or value.strip() == "":
+        return default
+    if isinstance(default, bool):
+        return value.strip().lower() == "true"
+    return int(value)
+
+# Define a function to read the per-route statement timeouts, returns a dict
+# of endpoint: milliseconds
+
+
+def endpoint_timeouts(environ=os.environ):
+    timeouts = {}
+    for entry in environ.get("DB_ENDPOINT_TIMEOUTS", "").split(","):
+        if entry.strip():
+            endpoint, _, milliseconds = entry.partition("=")
+            timeouts[endpoint.strip()] = int(milliseconds)
+    return timeouts
+
+# Define a function to build the engine options for a database URL
+
+
+def engine_options(uri, environ=os.environ):
+    options = {
+        # A connection the database closed (restart, failover, idle timeout)
+        # is replaced instead of failing the request that gets it
+        "pool_pre_ping": setting("DB_POOL_PRE_PING", environ),
+        "pool_recycle": setting("DB_POOL_RECYCLE", environ)
+    }
+    if not uri:
+        return options
+    url = make_url(uri)
+    # An in-memory SQLite database lives in one connection, its pool has
+    # no size to set
+    if not (url.get_backend_name() == "sqlite"
+            and url.database in (None, "", ":memory:")):
+        options.update({
+            "pool_size": setting("DB_POOL_SIZE", environ),
+            "max_overflow": setting("DB_MAX_OVERFLOW", environ),
+            "pool_timeout": setting("DB_POOL_TIMEOUT", environ)
+        })
+    # Set the statement timeout when each connection is opened
+    timeout = setting("DB_STATEMENT_TIMEOUT", environ)
+    if url.get_backend_name() == "postgresql" and timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+# Define a function to turn a database URL into the same database through
+# its async driver, for the async entry point (see asgi.py)
+
+
+def async_database_url(uri):
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for {backend} databases")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+# Define a function to build the engine options for the async engine of a
+# database URL, the same settings as engine_options
+
+
+def async_engine_options(uri, environ=os.environ):
+    options = engine_options(uri, environ)
+    url = make_url(uri)
+    # aiosqlite picks its own pool, which may not have a size to set
+    if url.get_backend_name() == "sqlite":
+        for name in ("pool_size", "max_overflow", "pool_timeout"):
+            options.pop(name, None)
+    # asyncpg takes the statement timeout as a server setting
+    timeout = setting("DB_STATEMENT_TIMEOUT", environ)
+    if url.get_backend_name() == "postgresql" and timeout:
+        options["connect_args"] = {
+            "server_settings": {"statement_timeout": str(timeout)}}
+    return options
+
+# Change the statement timeout for the rest of a transaction started by a
+# route that has its own, SET LOCAL ends with the transaction
+
+
+@event.listens_for(Session, "after_begin")
+def set_endpoint_timeout(session, transaction, connection):
+    if not has_request_context() or connection.dialect.name != "postgresql":
+        return
+    timeout = current_app.config.get(
+        "DB_ENDPOINT_TIMEOUTS", {}).get(request.endpoint)
+    if timeout is not None:
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {int(timeout)}")
@@ -0,0 +1,136 @@
+# Password hashing off the request threads
+# bcrypt is slow on purpose, a single hash or check takes a few hundred
+# milliseconds of CPU. Run on the request thread, a burst of logins pins the
+# server worker and every other request waits behind them. The functions
+# below run bcrypt in a pool of processes instead, one per CPU core by
+# default. At most HASH_QUEUE_SIZE hashes can be running or waiting at once,
+# when the queue is full HashingBusy is raised and the route answers with a
+# 503 so the client can try again, instead of piling up more work.
+# The hashes are the same as Flask-Bcrypt's, using the same app config
+# (BCRYPT_LOG_ROUNDS is the cost factor)
+
+# Built-in Python Libraries
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+
+# External Libraries
+from flask import current_app
+from flask_bcrypt import Bcrypt
+
+# App config keys read by Flask-Bcrypt, passed on to the worker processes
+BCRYPT_SETTINGS = ("BCRYPT_LOG_ROUNDS", "BCRYPT_HASH_PREFIX",
+                   "BCRYPT_HANDLE_LONG_PASSWORDS")
+
+# The pool of the current process, with the number of free places in its
+# queue. Created on first use so each server worker process gets its own
+_pool = {"pid": None, "executor": None, "slots": None}
+_pool_lock = threading.Lock()
+
+# Exception raised when the hashing queue is full or a hash took too long
+
+
+class HashingBusy(Exception):
+    pass
+
+# Define a function to build a Flask-Bcrypt hasher with the app's settings,
+# runs in the worker processes where there is no app
+
+
+def make_hasher(settings):
+    hasher = Bcrypt()
+    hasher.init_app(SimpleNamespace(config=settings))
+    return hasher
+
+# Define the functions the worker processes run
+
+
+def hash_in_worker(settings, password):
+    return make_hasher(settings).generate_password_hash(password).decode("utf-8")
+
+
+def check_in_worker(settings, pw_hash, password):
+    return make_hasher(settings).check_password_hash(pw_hash, password)
+
+# Define a function to get the pool of the current process, creating it the
+# first time. Returns None if HASH_WORKERS is 0, to hash on the request thread
+
+
+def get_pool():
+    workers = current_app.config.get("HASH_WORKERS", os.cpu_count() or 1)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool["pid"] != os.getpid():
+            # Fresh processes, not forked copies of a threaded server
+            _pool["executor"] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"))
+            _pool["slots"] = threading.BoundedSemaphore(
+                current_app.config.get("HASH_QUEUE_SIZE", workers * 4))
+            _pool["pid"] = os.getpid()
+    return _pool
+
+# Define a function to run a hashing function in the pool and wait for the
+# result, raising HashingBusy if the queue is full or it takes too long
+
+
+def run_in_pool(function, *args):
+    settings = {key: current_app.config[key]
+                for key in BCRYPT_SETTINGS if key in current_app.config}
+    pool = get_pool()
+    # No pool, hash on the request thread
+    if pool is None:
+        return function(settings, *args)
+    executor, slots = pool["executor"], pool["slots"]
+    # Take a place in the queue without waiting for one
+    if not slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = executor.submit(function, settings, *args)
+    except BaseException as err:
+        slots.release()
+        if not isinstance(err, BrokenProcessPool):
+            raise
+    else:
+        # Give the place back when the hash is done, even if nobody waits
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(
+                timeout=current_app.config.get("HASH_TIMEOUT", 10))
+        except TimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            pass
+    # A worker died or could not start, start a new pool on the next call
+    # and hash this one on the request thread
+    with _pool_lock:
+        if _pool["executor"] is executor:
+            _pool["pid"] = None
+    return function(settings, *args)
+
+# Define a function to hash a password, returns the hash as a string
+
+
+def generate_password_hash(password):
+    return run_in_pool(hash_in_worker, password)
+
+# Define a function to check a password against a hash
+
+
+def check_password_hash(pw_hash, password):
+    return run_in_pool(check_in_worker, pw_hash, password)
+
+# Define a function to check whether a hash was made with a different cost
+# factor than the one configured now, e.g. '$2b$12$...' has a cost of 12
+
+
+def needs_rehash(pw_hash):
+    try:
+        cost = int(pw_hash.split("$")[2])
+    except (AttributeError, IndexError, ValueError):
+        return False
+    return cost != current_app.config.get("BCRYPT_LOG_ROUNDS", 12)
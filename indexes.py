@@ -0,0 +1,103 @@
+# Indexes
+# The models declare an index for every foreign key and for the filter and
+# sort columns of the hot routes, e.g. (event_id, timestamp desc) on
+# attending for GET /events/<id>/attending. The migrations in migrations/
+# create the same indexes on existing databases.
+# 'flask db index-report' compares the database with QUERY_KEYS and the
+# foreign keys and lists the columns that no index starts with.
+
+# External Libraries
+from sqlalchemy import inspect
+
+# Imports from local files
+from init import db
+
+# Constants
+# Columns the routes filter on, then sort on, for each table. An index
+# helps a query when its first columns are these, in this order
+QUERY_KEYS = [
+    ("posts", ("date", "id"), "GET /posts, newest first"),
+    ("posts", ("user_id",), "posts of a user, deleting a user"),
+    ("comments", ("post_id", "id"), "GET /posts/<id>/comments"),
+    ("likes", ("post_id", "user_id"), "GET /posts/<id>/likes, bulk likes"),
+    ("events", ("date", "id"), "GET /events, newest first"),
+    ("events", ("event_admin_id",), "events of a user, deleting a user"),
+    ("attending", ("event_id", "timestamp"), "GET /events/<id>/attending"),
+    ("attending", ("attending_id",), "bookings of a user, deleting a user"),
+    ("invoices", ("attendee_id", "timestamp"),
+     "GET /events/<id>/attending/<id>/invoice"),
+    ("invoices", ("event_id",), "invoices of an event, deleting an event"),
+    ("attending", ("timestamp",), "GET /events/sales"),
+    ("invoices", ("timestamp",), "GET /events/sales"),
+    ("seat_inventory", ("event_id", "seat_section"), "buying tickets"),
+    ("ticket_ledger", ("event_id", "user_id"), "buying tickets"),
+    ("ticket_ledger", ("user_id",), "deleting a user"),
+    ("users", ("email",), "POST /auth/login"),
+    ("jobs", ("status", "id"), "flask jobs worker, oldest queued job"),
+    ("jobs", ("user_id",), "jobs of a user")
+]
+
+# Define a function to declare the index of a listing sorted newest first,
+# e.g. GET /posts, which orders by (sort_column desc nulls last, id desc).
+# SQLite already sorts nulls last in descending order and cannot say so in
+# an index, so it gets the index without NULLS LAST
+
+
+def listing_index(name, sort_column, id_column):
+    db.Index(name, sort_column.desc().nulls_last(),
+             id_column.desc()).ddl_if(dialect="postgresql")
+    db.Index(name, sort_column.desc(), id_column.desc()).ddl_if(
+        callable_=lambda ddl, target, bind, dialect=None, **kwargs:
+        dialect is not None and dialect.name != "postgresql")
+
+# Define a function to list the column names each index, primary key and
+# unique constraint of a table starts with, from the database itself
+
+
+def table_keys(inspector, table):
+    keys = [inspector.get_pk_constraint(table)["constrained_columns"]]
+    keys += [index["column_names"] for index in inspector.get_indexes(table)]
+    keys += [constraint["column_names"]
+             for constraint in inspector.get_unique_constraints(table)]
+    return [key for key in keys if key]
+
+# Define a function to check whether one of the keys starts with columns
+
+
+def is_indexed(keys, columns):
+    return any(tuple(key[:len(columns)]) == tuple(columns) for key in keys)
+
+# Define a function to check the database for unindexed filter and sort
+# columns. Returns a list of (table, columns, used by, indexed) rows for
+# QUERY_KEYS and every foreign key, and the names of the indexes the models
+# declare that the database does not have
+
+
+def index_report(connection):
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    keys = {table: table_keys(inspector, table) for table in tables}
+
+    checks = [(table, columns, used_by) for table, columns, used_by
+              in QUERY_KEYS if table in tables]
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        for key in table.foreign_key_constraints:
+            checks.append((table.name, tuple(key.column_keys),
+                           f"foreign key to {key.referred_table.name}"))
+
+    rows, seen = [], set()
+    for table, columns, used_by in checks:
+        if (table, columns) in seen:
+            continue
+        seen.add((table, columns))
+        rows.append((table, columns, used_by,
+                     is_indexed(keys[table], columns)))
+
+    existing = {index["name"] for table in tables
+                for index in inspector.get_indexes(table)}
+    missing = sorted({index.name for table in db.metadata.sorted_tables
+                      for index in table.indexes
+                      if table.name in tables and index.name not in existing})
+    return rows, missing
@@ -7,8 +7,12 @@ from flask_marshmallow import Marshmallow
 from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 
+# Imports from local files
+from replicas import RoutingSession
+
 # Create instances of the libraries
-db = SQLAlchemy()
+# The session sends GET requests' reads to a read replica, if there are any
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 ma = Marshmallow()
 bcrypt = Bcrypt()
 jwt = JWTManager()
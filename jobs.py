@@ -0,0 +1,237 @@
+# Background jobs
+# Slow work, such as deleting an event or a user with everything that
+# belongs to them, or creating many invoices, can run in a job worker
+# instead of during the request. The route queues a job, a row in the jobs
+# table (see models/job.py), and answers straight away with a 202 and the
+# job's id. The client then polls GET /jobs/<id> for its progress and result.
+# Workers are started with 'flask jobs worker' and take the oldest queued
+# job from the table, so only the database is needed, no message broker.
+# A job function is registered with @job("name"). It is called with the
+# job's args as keyword arguments inside an app context, may call
+# report_progress, and returns what GET /jobs/<id> shows as the result.
+# A worker sends a heartbeat every JOB_HEARTBEAT seconds while it runs a
+# job. A job whose worker stopped (killed, crashed or cut off from the
+# database) has no heartbeat for JOB_TIMEOUT seconds. If it was registered
+# with @job("name", idempotent=True), i.e. running it again does no harm,
+# it is queued again until it has been started JOB_MAX_ATTEMPTS times.
+# Any other job may already have committed its work, e.g. created invoices,
+# so it fails instead of running twice.
+
+# Built-in Python Libraries
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+# External Libraries
+from flask import current_app, g, make_response, request, url_for
+from flask_jwt_extended import get_jwt_identity
+
+# Imports from local files
+from init import db
+from models.job import Job
+
+# Job functions by name, filled in by @job
+JOBS = {}
+# Names of the jobs that are safe to run again when their worker stopped
+IDEMPOTENT_JOBS = set()
+
+# Define a decorator to register a function as a job, e.g.
+# @job("delete_event", idempotent=True) on def remove_event(event_id)
+
+
+def job(name, idempotent=False):
+    def decorator(function):
+        JOBS[name] = function
+        if idempotent:
+            IDEMPOTENT_JOBS.add(name)
+        return function
+    return decorator
+
+# Define a function to get the current time in UTC, as stored in the table
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# Define a function to queue a job, the args must be JSON serialisable.
+# 'queued_by' is the id of the user who queued it, if any. Returns the job
+
+
+def enqueue(name, queued_by=None, **args):
+    if name not in JOBS:
+        raise ValueError(f"Unknown job '{name}'")
+    queued = Job(name=name, args=args, user_id=queued_by,
+                 created_at=utc_now())
+    db.session.add(queued)
+    db.session.commit()
+    return queued
+
+# Define a function to check whether the client asked for a route's work to
+# run as a job, with '?async=1' or a 'Prefer: respond-async' header
+
+
+def wants_job():
+    if request.args.get("async", "").lower() in ("1", "true"):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "").lower()
+
+# Define a function to queue a job for the logged in user and answer the
+# request with a 202, pointing the client at the job's status route
+
+
+def queue_job(name, **args):
+    queued = enqueue(name, queued_by=int(get_jwt_identity()), **args)
+    location = url_for("jobs.get_job", job_id=queued.id)
+    response = make_response(
+        {"job_id": queued.id, "status": queued.status, "location": location},
+        202)
+    response.headers["Location"] = location
+    return response
+
+# Define a function for a job function to report how far it got, as a
+# percent. Written in its own transaction so GET /jobs/<id> sees it while
+# the job is still running. Does nothing outside a job
+
+
+def report_progress(percent):
+    job_id = g.get("job_id")
+    if job_id is None:
+        return
+    table = Job.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            db.update(table).where(table.c.id == job_id)
+            .values(progress=max(0, min(100, int(percent))),
+                    heartbeat_at=utc_now()))
+
+# Define a function to queue the idempotent jobs of stopped workers again,
+# or fail them if they have been started JOB_MAX_ATTEMPTS times. Other jobs
+# of stopped workers fail straight away, they may have done part of their
+# work already
+
+
+def requeue_lost_jobs():
+    table = Job.__table__
+    now = utc_now()
+    lost = db.and_(table.c.status == "running", table.c.heartbeat_at < now
+                   - timedelta(seconds=current_app.config["JOB_TIMEOUT"]))
+    db.session.execute(
+        db.update(table)
+        .where(lost, db.or_(
+            table.c.attempts >= current_app.config["JOB_MAX_ATTEMPTS"],
+            table.c.name.not_in(sorted(IDEMPOTENT_JOBS))))
+        .values(status="failed", finished_at=now,
+                error="The worker running the job stopped"))
+    db.session.execute(db.update(table).where(lost).values(
+        status="queued", worker=None))
+    db.session.commit()
+
+# Define a function to take the oldest queued job for a worker, with one
+# UPDATE so two workers never take the same job. On PostgreSQL jobs other
+# workers are taking are skipped instead of waited for.
+# Returns the job, or None if no job is queued
+
+
+def claim_job(worker):
+    requeue_lost_jobs()
+    table = Job.__table__
+    queued = table.alias("queued")
+    oldest = (db.select(queued.c.id).where(queued.c.status == "queued")
+              .order_by(queued.c.id).limit(1))
+    if db.session.get_bind().dialect.name == "postgresql":
+        oldest = oldest.with_for_update(skip_locked=True)
+    now = utc_now()
+    job_id = db.session.execute(
+        db.update(table)
+        .where(table.c.id == oldest.scalar_subquery(),
+               table.c.status == "queued")
+        .values(status="running", worker=worker, progress=0,
+                attempts=table.c.attempts + 1, started_at=now,
+                heartbeat_at=now)
+        .returning(table.c.id)).scalar()
+    db.session.commit()
+    if job_id is None:
+        return None
+    return db.session.get(Job, job_id)
+
+# Define a function to keep a job's heartbeat going until 'stop' is set,
+# runs on its own thread next to the job
+
+
+def send_heartbeats(app, job_id, stop):
+    table = Job.__table__
+    while not stop.wait(app.config["JOB_HEARTBEAT"]):
+        try:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(db.update(table).where(
+                    table.c.id == job_id).values(heartbeat_at=utc_now()))
+        except Exception as e:
+            # Try again on the next beat
+            app.logger.warning(f"Heartbeat of job {job_id} failed: {e}")
+
+# Define a function to run a claimed job and record how it ended
+
+
+def run_job(claimed):
+    app = current_app._get_current_object()
+    function = JOBS.get(claimed.name)
+    # The attempt this worker started, a lost job may be started again
+    attempt = claimed.attempts
+    g.job_id = claimed.id
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=send_heartbeats,
+                                 args=(app, claimed.id, stop), daemon=True)
+    heartbeat.start()
+    try:
+        if function is None:
+            raise ValueError(f"Unknown job '{claimed.name}'")
+        values = {"status": "succeeded", "progress": 100,
+                  "result": function(**claimed.args)}
+    except Exception as e:
+        db.session.rollback()
+        values = {"status": "failed", "error": str(e)}
+    finally:
+        stop.set()
+        heartbeat.join()
+    table = Job.__table__
+    db.session.execute(
+        db.update(table)
+        .where(table.c.id == claimed.id, table.c.attempts == attempt)
+        .values(finished_at=utc_now(), **values))
+    db.session.commit()
+    return values["status"]
+
+# Define a function for a worker thread, runs jobs until 'stop' is set.
+# With burst=True it stops as soon as no job is queued
+
+
+def work(app, worker, stop, burst=False):
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                claimed = claim_job(worker)
+            except Exception as e:
+                # E.g. the database is down, try again after a while
+                db.session.rollback()
+                app.logger.warning(f"Worker {worker} could not take a job: {e}")
+                claimed = None
+            if claimed is None:
+                if burst:
+                    return
+                stop.wait(app.config["JOB_POLL_INTERVAL"])
+                continue
+            status = run_job(claimed)
+            app.logger.info(f"Job {claimed.id} ({claimed.name}) {status}")
+
+# Define a function to start 'count' worker threads. Returns the threads
+
+
+def start_workers(app, count, stop, burst=False):
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [threading.Thread(target=work, name=f"job-worker-{number}",
+                                args=(app, f"{name}:{number}", stop, burst))
+               for number in range(1, count + 1)]
+    for thread in threads:
+        thread.start()
+    return threads
@@ -9,6 +9,10 @@ from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db, ma, bcrypt, jwt
+import server_timing
+import db_settings
+import replicas
+import metrics
 
 # Application factories, can create multiple instances of the app
 # for reasons such as testing or running multiple versions of the app
@@ -23,15 +27,88 @@ def create_app():
     # Connection string or DB URI - Universal Resource Indicator
     # Get private DB URI and JWT strings from .env file using os
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    # Connection pool size, recycling, pre-ping and statement timeout, from
+    # the DB_* environment variables (see db_settings.py)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = db_settings.engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"])
+    # Statement timeouts for particular routes, e.g. for slow reports
+    app.config["DB_ENDPOINT_TIMEOUTS"] = db_settings.endpoint_timeouts()
+    # Read replicas, comma separated URLs. GET requests read from one of
+    # them, everything else uses the primary (see replicas.py)
+    replica_urls = [url.strip() for url in os.environ.get(
+        "DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    app.config["SQLALCHEMY_BINDS"] = replicas.replica_binds(
+        replica_urls, db_settings.engine_options)
+    app.config["REPLICA_BIND_KEYS"] = list(app.config["SQLALCHEMY_BINDS"])
+    # Seconds a client reads from the primary after its own write, so it
+    # sees the change before the replicas catch up
+    app.config["REPLICA_PIN_SECONDS"] = float(
+        os.environ.get("REPLICA_PIN_SECONDS") or 5)
 
     # Secret key, JWT token
     app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY")
 
+    # Trust the is_admin claim in access tokens instead of checking the DB on
+    # admin only routes. Faster, but admin rights removed from a user only
+    # apply once their token expires, so it is off by default
+    app.config["JWT_TRUST_ADMIN_CLAIM"] = os.environ.get(
+        "JWT_TRUST_ADMIN_CLAIM", "false").lower() == "true"
+
+    # Use the compiled serialiser for the hot schemas, on unless
+    # FAST_SERIALISER is set to "false"
+    app.config["FAST_SERIALISER"] = os.environ.get(
+        "FAST_SERIALISER", "true").lower() != "false"
+
+    # Password hashing (see hashing.py)
+    # bcrypt cost factor, each step up doubles the time a hash takes.
+    # Passwords hashed with another cost are hashed again when the user logs in
+    app.config["BCRYPT_LOG_ROUNDS"] = int(
+        os.environ.get("BCRYPT_LOG_ROUNDS") or 12)
+    # Number of processes hashing passwords, defaults to one per CPU core.
+    # 0 hashes on the request thread instead
+    app.config["HASH_WORKERS"] = int(
+        os.environ.get("HASH_WORKERS") or os.cpu_count() or 1)
+    # Number of hashes that can be running or waiting at once, requests over
+    # that get a 503 instead of waiting
+    app.config["HASH_QUEUE_SIZE"] = int(os.environ.get(
+        "HASH_QUEUE_SIZE") or app.config["HASH_WORKERS"] * 4 or 1)
+    # Seconds a request waits for its hash before giving up with a 503
+    app.config["HASH_TIMEOUT"] = float(os.environ.get("HASH_TIMEOUT") or 10)
+
+    # Add a Server-Timing header with the database, serialisation and total
+    # time to every response, on unless SERVER_TIMING is set to "false"
+    app.config["SERVER_TIMING"] = os.environ.get(
+        "SERVER_TIMING", "true").lower() != "false"
+    # Log the same timings for every request when set to "true"
+    app.config["LOG_REQUEST_TIMING"] = os.environ.get(
+        "LOG_REQUEST_TIMING", "false").lower() == "true"
+
+    # Token a Prometheus scraper must send to read /metrics, if set
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+    # Background jobs (see jobs.py)
+    # Worker threads started by 'flask jobs worker'
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS") or 2)
+    # Seconds an idle worker waits before looking for a queued job again
+    app.config["JOB_POLL_INTERVAL"] = float(
+        os.environ.get("JOB_POLL_INTERVAL") or 1)
+    # Seconds between the heartbeats of a running job
+    app.config["JOB_HEARTBEAT"] = float(os.environ.get("JOB_HEARTBEAT") or 10)
+    # Seconds without a heartbeat before a running job counts as lost and
+    # is queued again
+    app.config["JOB_TIMEOUT"] = float(os.environ.get("JOB_TIMEOUT") or 60)
+    # Times a lost job is started before it fails
+    app.config["JOB_MAX_ATTEMPTS"] = int(
+        os.environ.get("JOB_MAX_ATTEMPTS") or 3)
+
     # Initialise with this instance of application
     db.init_app(app)
     ma.init_app(app)
     bcrypt.init_app(app)
     jwt.init_app(app)
+    server_timing.init_app(app)
+    metrics.init_app(app)
+    replicas.init_app(app)
 
     # Error handling
     # If a validation error occurs, return the error message and status code
@@ -41,8 +118,9 @@ def create_app():
 
     # Register blueprints into the main app instance so we can use their
     # different entities using the 'register_blueprint' method
-    from controllers.cli_controller import db_commands
+    from controllers.cli_controller import db_commands, job_commands
     app.register_blueprint(db_commands)
+    app.register_blueprint(job_commands)
     # Import the blueprints
     from controllers.auth_controller import auth_bp
     app.register_blueprint(auth_bp)
@@ -56,5 +134,11 @@ def create_app():
     from controllers.user_controller import user_bp
     app.register_blueprint(user_bp)
 
+    from controllers.metrics_controller import metrics_bp
+    app.register_blueprint(metrics_bp)
+
+    from controllers.job_controller import jobs_bp
+    app.register_blueprint(jobs_bp)
+
     # Return the instance of the flask app
     return app
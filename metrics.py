@@ -0,0 +1,208 @@
+# Prometheus metrics
+# Counts requests and their latency per blueprint and route, the 500s the
+# routes return from their generic 'except Exception' handlers, and how the
+# SQLAlchemy connection pools are doing, and the table version bumps that
+# failed (see models/resource_version.py). Served in the Prometheus text
+# format by GET /metrics (see controllers/metrics_controller.py).
+# Requests are recorded from the request_timed signal (see server_timing.py)
+# with one lock and a few dict updates, a few microseconds per request.
+# The numbers are per process, with several server worker processes each
+# one reports its own, as Prometheus expects without a push gateway.
+
+# Built-in Python Libraries
+import threading
+import time
+from bisect import bisect_left
+
+# Imports from local files
+from init import db
+from server_timing import request_timed
+from models.resource_version import bump_failures
+
+# Constants
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the pool wait histogram buckets, in seconds
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Recorded values, guarded by _lock
+# (blueprint, endpoint, method): [bucket counts, sum of seconds, {status: count}]
+_requests = {}
+# engine name: [bucket counts, sum of seconds]
+_pool_waits = {}
+_lock = threading.Lock()
+
+# Define a function to record one request, connected to request_timed
+
+
+def record_request(app, timing, **extra):
+    endpoint = timing["endpoint"] or "unmatched"
+    key = (endpoint.rpartition(".")[0], endpoint, timing["method"])
+    seconds = timing["total_ms"] / 1000
+    bucket = bisect_left(LATENCY_BUCKETS, seconds)
+    with _lock:
+        stats = _requests.get(key)
+        if stats is None:
+            stats = _requests[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, {}]
+        stats[0][bucket] += 1
+        stats[1] += seconds
+        stats[2][timing["status"]] = stats[2].get(timing["status"], 0) + 1
+
+# Define a function to record how long getting a connection from a pool took
+
+
+def record_pool_wait(name, seconds):
+    bucket = bisect_left(POOL_WAIT_BUCKETS, seconds)
+    with _lock:
+        stats = _pool_waits.get(name)
+        if stats is None:
+            stats = _pool_waits[name] = [[0] * (len(POOL_WAIT_BUCKETS) + 1), 0.0]
+        stats[0][bucket] += 1
+        stats[1] += seconds
+
+# Define a function to time every connection taken from an engine's pool.
+# SQLAlchemy has no event for the start of a checkout, so the pool's connect
+# method is wrapped
+
+
+def watch_pool(name, engine):
+    pool = engine.pool
+    if getattr(pool, "metrics_watched", False):
+        return
+    connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            record_pool_wait(name, time.perf_counter() - start)
+
+    pool.connect = timed_connect
+    pool.metrics_watched = True
+
+# Define a function to name an engine, the default engine has no bind key
+
+
+def engine_name(key):
+    return key or "default"
+
+# Define a function to escape a label value for the text format
+
+
+def label_value(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+# Define a function to format a set of labels, e.g. {a="1",b="2"}
+
+
+def labels(**values):
+    return "{" + ",".join(f'{name}="{label_value(value)}"'
+                          for name, value in values.items()) + "}"
+
+# Define a function to format the lines of a histogram
+
+
+def histogram_lines(name, buckets, counts, total, **label_values):
+    lines, cumulative = [], 0
+    for bound, count in zip(buckets + (float("inf"),), counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{name}_bucket{labels(**label_values, le=le)} {cumulative}")
+    lines.append(f"{name}_sum{labels(**label_values)} {total}")
+    lines.append(f"{name}_count{labels(**label_values)} {cumulative}")
+    return lines
+
+# Define a function to render every metric in the Prometheus text format
+
+
+def render():
+    with _lock:
+        requests = {key: (list(counts), total, dict(statuses))
+                    for key, (counts, total, statuses) in _requests.items()}
+        waits = {name: (list(counts), total)
+                 for name, (counts, total) in _pool_waits.items()}
+
+    lines = [
+        "# HELP http_requests_total Requests handled, by route and status.",
+        "# TYPE http_requests_total counter"
+    ]
+    for (blueprint, endpoint, method), (_, _, statuses) in sorted(requests.items()):
+        for status, count in sorted(statuses.items()):
+            lines.append("http_requests_total" + labels(
+                blueprint=blueprint, endpoint=endpoint, method=method,
+                status=status) + f" {count}")
+
+    lines += [
+        "# HELP http_request_errors_total Requests answered with a 5xx "
+        "status, e.g. by a route's generic exception handler.",
+        "# TYPE http_request_errors_total counter"
+    ]
+    for (blueprint, endpoint, method), (_, _, statuses) in sorted(requests.items()):
+        lines.append("http_request_errors_total" + labels(
+            blueprint=blueprint, endpoint=endpoint, method=method) + " " + str(
+            sum(count for status, count in statuses.items() if status >= 500)))
+
+    lines += [
+        "# HELP http_request_duration_seconds Time to handle a request.",
+        "# TYPE http_request_duration_seconds histogram"
+    ]
+    for (blueprint, endpoint, method), (counts, total, _) in sorted(requests.items()):
+        lines += histogram_lines(
+            "http_request_duration_seconds", LATENCY_BUCKETS, counts, total,
+            blueprint=blueprint, endpoint=endpoint, method=method)
+
+    # Pool gauges, read now. Pools without a fixed size (e.g. SQLite in
+    # memory) do not have all of them
+    gauges = [
+        ("db_pool_size", "size", "Connections the pool keeps open."),
+        ("db_pool_checked_out", "checkedout",
+         "Connections in use right now."),
+        ("db_pool_checked_in", "checkedin",
+         "Idle connections in the pool right now."),
+        ("db_pool_overflow", "overflow",
+         "Connections open beyond the pool size right now, negative while "
+         "the pool is not full yet.")
+    ]
+    engines = {engine_name(key): engine for key, engine in db.engines.items()}
+    for metric, method, description in gauges:
+        values = [(name, getattr(engine.pool, method)())
+                  for name, engine in sorted(engines.items())
+                  if callable(getattr(engine.pool, method, None))]
+        if values:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+            lines += [f"{metric}{labels(engine=name)} {value}"
+                      for name, value in values]
+
+    lines += [
+        "# HELP db_pool_wait_seconds Time to get a connection from the pool.",
+        "# TYPE db_pool_wait_seconds histogram"
+    ]
+    for name, (counts, total) in sorted(waits.items()):
+        lines += histogram_lines("db_pool_wait_seconds", POOL_WAIT_BUCKETS,
+                                 counts, total, engine=name)
+
+    # Table version bumps that failed after their write committed, the
+    # tables keep their old ETags until the retry succeeds
+    failures, pending = bump_failures()
+    lines += [
+        "# HELP resource_version_bump_failures_total Table version bumps "
+        "that failed after their write committed.",
+        "# TYPE resource_version_bump_failures_total counter",
+        f"resource_version_bump_failures_total {failures}",
+        "# HELP resource_version_pending_bumps Tables whose version bump "
+        "failed and waits for the next commit.",
+        "# TYPE resource_version_pending_bumps gauge",
+        f"resource_version_pending_bumps {pending}"
+    ]
+    return "\n".join(lines) + "\n"
+
+# Define a function to start collecting metrics for an app
+
+
+def init_app(app):
+    request_timed.connect(record_request, app)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            watch_pool(engine_name(key), engine)
@@ -0,0 +1,129 @@
+# The tables as 'flask db create' used to create them with db.create_all(),
+# and the search indexes. Tables that already exist are left as they are,
+# so a database created before migrations were added is taken over as is
+
+# External Libraries
+import sqlalchemy as sa
+
+# Imports from local files
+from search import index_names, index_statements
+
+# Define a function to describe the tables
+
+
+def tables(metadata):
+    users = sa.Table(
+        "users", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("name", sa.String, nullable=False),
+        sa.Column("user_name", sa.String, nullable=False),
+        sa.Column("password", sa.String, nullable=False),
+        sa.Column("email", sa.String, nullable=False, unique=True),
+        sa.Column("dob", sa.Date),
+        sa.Column("is_admin", sa.Boolean)
+    )
+    posts = sa.Table(
+        "posts", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("title", sa.String, nullable=False),
+        sa.Column("content", sa.String),
+        sa.Column("date", sa.Date),
+        sa.Column("location", sa.String),
+        sa.Column("image_url", sa.String),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False)
+    )
+    comments = sa.Table(
+        "comments", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("content", sa.String, nullable=False),
+        sa.Column("timestamp", sa.Date),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False),
+        sa.Column("post_id", sa.Integer, sa.ForeignKey("posts.id"),
+                  nullable=False)
+    )
+    sa.Table(
+        "likes", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False),
+        sa.Column("post_id", sa.Integer, sa.ForeignKey("posts.id"),
+                  nullable=False)
+    )
+    events = sa.Table(
+        "events", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("title", sa.String),
+        sa.Column("description", sa.String),
+        sa.Column("date", sa.Date),
+        sa.Column("ticket_price", sa.Float),
+        sa.Column("event_admin_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False)
+    )
+    sa.Table(
+        "attending", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("total_tickets", sa.Integer),
+        sa.Column("seat_section", sa.String),
+        sa.Column("timestamp", sa.Date),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id"),
+                  nullable=False),
+        sa.Column("attending_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False)
+    )
+    sa.Table(
+        "invoices", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("total_cost", sa.Float),
+        sa.Column("timestamp", sa.Date),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id"),
+                  nullable=False),
+        sa.Column("attendee_id", sa.Integer, sa.ForeignKey("attending.id"),
+                  nullable=False)
+    )
+    sa.Table(
+        "seat_inventory", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("seat_section", sa.String, nullable=False),
+        sa.Column("capacity", sa.Integer, nullable=False),
+        sa.Column("remaining", sa.Integer, nullable=False),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id"),
+                  nullable=False),
+        sa.UniqueConstraint("event_id", "seat_section")
+    )
+    sa.Table(
+        "ticket_ledger", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("tickets", sa.Integer, nullable=False),
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id"),
+                  nullable=False),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("users.id"),
+                  nullable=False),
+        sa.UniqueConstraint("event_id", "user_id")
+    )
+    sa.Table(
+        "resource_versions", metadata,
+        sa.Column("name", sa.String, primary_key=True),
+        sa.Column("version", sa.Integer, nullable=False),
+        sa.Column("updated_at", sa.DateTime, nullable=False)
+    )
+    # Searchable columns
+    return [(events, "title"), (users, "user_name")]
+
+# Define a function to create the tables and search indexes
+
+
+def upgrade(connection):
+    metadata = sa.MetaData()
+    searchable = tables(metadata)
+    metadata.create_all(connection, checkfirst=True)
+    dialect = connection.dialect.name
+    for table, column in searchable:
+        names = index_names(table, column)
+        for statement in index_statements(dialect, table, column):
+            connection.exec_driver_sql(statement.format(**names))
+        # Index the rows of a database taken over with rows in it
+        if dialect == "sqlite":
+            connection.exec_driver_sql(
+                "INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(**names))
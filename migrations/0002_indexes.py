@@ -0,0 +1,52 @@
+# Indexes for the foreign keys and for the filter and sort columns of the
+# hot routes, see indexes.py. Built CONCURRENTLY on PostgreSQL so a live
+# database keeps taking writes while they build
+
+# External Libraries
+import sqlalchemy as sa
+
+# Imports from local files
+from migrations import create_index
+
+# Build the indexes outside a transaction
+TRANSACTIONAL = False
+
+# Define a function to create the indexes
+
+
+def upgrade(connection):
+    metadata = sa.MetaData()
+    table = {name: sa.Table(name, metadata, autoload_with=connection)
+             for name in ("posts", "comments", "likes", "events", "attending",
+                          "invoices", "ticket_ledger")}
+    posts, events = table["posts"].c, table["events"].c
+    attending, invoices = table["attending"].c, table["invoices"].c
+    comments, likes = table["comments"].c, table["likes"].c
+
+    # The listings sort newest first with rows without a date last. SQLite
+    # already sorts them last and cannot say NULLS LAST in an index
+    if connection.dialect.name == "postgresql":
+        posts_date = posts.date.desc().nulls_last()
+        events_date = events.date.desc().nulls_last()
+    else:
+        posts_date, events_date = posts.date.desc(), events.date.desc()
+
+    indexes = [
+        sa.Index("ix_posts_date_id", posts_date, posts.id.desc()),
+        sa.Index("ix_posts_user_id", posts.user_id),
+        sa.Index("ix_comments_post_id_id", comments.post_id, comments.id),
+        sa.Index("ix_comments_user_id", comments.user_id),
+        sa.Index("ix_likes_post_id_user_id", likes.post_id, likes.user_id),
+        sa.Index("ix_likes_user_id", likes.user_id),
+        sa.Index("ix_events_date_id", events_date, events.id.desc()),
+        sa.Index("ix_events_event_admin_id", events.event_admin_id),
+        sa.Index("ix_attending_event_id_timestamp",
+                 attending.event_id, attending.timestamp.desc()),
+        sa.Index("ix_attending_attending_id", attending.attending_id),
+        sa.Index("ix_invoices_attendee_id_timestamp",
+                 invoices.attendee_id, invoices.timestamp.desc()),
+        sa.Index("ix_invoices_event_id", invoices.event_id),
+        sa.Index("ix_ticket_ledger_user_id", table["ticket_ledger"].c.user_id)
+    ]
+    for index in indexes:
+        create_index(connection, index)
@@ -0,0 +1,59 @@
+# The event_stats table, with a row for every event counted from the
+# attending and invoices tables, see models/event_stats.py
+
+# External Libraries
+import sqlalchemy as sa
+
+# Constants
+# Seat sections and the column counting each one's tickets
+SECTION_COLUMNS = {
+    "General Admission": "general_admission_tickets",
+    "Section A": "section_a_tickets",
+    "Section B": "section_b_tickets",
+    "Section C": "section_c_tickets",
+    "VIP": "vip_tickets"
+}
+
+# Define a function to create and fill the table
+
+
+def upgrade(connection):
+    metadata = sa.MetaData()
+    events = sa.Table("events", metadata, autoload_with=connection)
+    attending = sa.Table("attending", metadata, autoload_with=connection)
+    invoices = sa.Table("invoices", metadata, autoload_with=connection)
+    counters = (["bookings", "tickets_sold"] + list(SECTION_COLUMNS.values())
+                + ["invoices"])
+    stats = sa.Table(
+        "event_stats", metadata,
+        sa.Column("event_id", sa.Integer, sa.ForeignKey("events.id"),
+                  primary_key=True),
+        *[sa.Column(name, sa.Integer, nullable=False) for name in counters],
+        sa.Column("revenue", sa.Float, nullable=False)
+    )
+    stats.create(connection, checkfirst=True)
+
+    # Count every event with one GROUP BY over each table
+    bookings = sa.select(
+        attending.c.event_id,
+        sa.func.count().label("bookings"),
+        sa.func.sum(attending.c.total_tickets).label("tickets_sold"),
+        *[sa.func.sum(sa.case(
+            (attending.c.seat_section == section, attending.c.total_tickets),
+            else_=0)).label(column)
+          for section, column in SECTION_COLUMNS.items()]
+    ).group_by(attending.c.event_id).subquery()
+    totals = sa.select(
+        invoices.c.event_id,
+        sa.func.count().label("invoices"),
+        sa.func.sum(invoices.c.total_cost).label("revenue")
+    ).group_by(invoices.c.event_id).subquery()
+    columns = [bookings.c[name] if name in bookings.c else totals.c[name]
+               for name in counters + ["revenue"]]
+    counted = (sa.select(events.c.id, *[sa.func.coalesce(column, 0)
+                                        for column in columns])
+               .outerjoin(bookings, bookings.c.event_id == events.c.id)
+               .outerjoin(totals, totals.c.event_id == events.c.id)
+               .where(~sa.exists().where(stats.c.event_id == events.c.id)))
+    connection.execute(stats.insert().from_select(
+        ["event_id"] + counters + ["revenue"], counted))
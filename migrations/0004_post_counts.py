@@ -0,0 +1,28 @@
+# The like_count and comment_count columns of posts, counted from the likes
+# and comments tables, see models/post_counts.py
+
+# External Libraries
+import sqlalchemy as sa
+
+# Constants
+# Column of posts counting the rows of each table
+COUNT_COLUMNS = {"likes": "like_count", "comments": "comment_count"}
+
+# Define a function to add and fill the columns
+
+
+def upgrade(connection):
+    existing = {column["name"] for column
+                in sa.inspect(connection).get_columns("posts")}
+    for column in COUNT_COLUMNS.values():
+        if column not in existing:
+            connection.exec_driver_sql(
+                f"ALTER TABLE posts ADD COLUMN {column} INTEGER NOT NULL "
+                "DEFAULT 0")
+    metadata = sa.MetaData()
+    posts = sa.Table("posts", metadata, autoload_with=connection)
+    for name, column in COUNT_COLUMNS.items():
+        table = sa.Table(name, metadata, autoload_with=connection)
+        connection.execute(sa.update(posts).values({
+            column: sa.select(sa.func.count())
+            .where(table.c.post_id == posts.c.id).scalar_subquery()}))
@@ -0,0 +1,30 @@
+# The jobs table of the background job workers, see jobs.py
+
+# External Libraries
+import sqlalchemy as sa
+
+# Define a function to create the table
+
+
+def upgrade(connection):
+    metadata = sa.MetaData()
+    jobs = sa.Table(
+        "jobs", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("name", sa.String, nullable=False),
+        sa.Column("args", sa.JSON, nullable=False),
+        sa.Column("status", sa.String, nullable=False),
+        sa.Column("progress", sa.Integer, nullable=False),
+        sa.Column("result", sa.JSON),
+        sa.Column("error", sa.Text),
+        sa.Column("attempts", sa.Integer, nullable=False),
+        sa.Column("user_id", sa.Integer),
+        sa.Column("worker", sa.String),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+        sa.Column("started_at", sa.DateTime),
+        sa.Column("finished_at", sa.DateTime),
+        sa.Column("heartbeat_at", sa.DateTime)
+    )
+    sa.Index("ix_jobs_status_id", jobs.c.status, jobs.c.id)
+    sa.Index("ix_jobs_user_id", jobs.c.user_id)
+    jobs.create(connection, checkfirst=True)
@@ -0,0 +1,42 @@
+# The sales_buckets and sales_cached tables of the sales routes, and the
+# indexes for counting the sales of every event from a day on, see
+# models/event_sales.py. Built CONCURRENTLY on PostgreSQL so a live
+# database keeps taking bookings while they build
+
+# External Libraries
+import sqlalchemy as sa
+
+# Imports from local files
+from migrations import create_index
+
+# Build the indexes outside a transaction
+TRANSACTIONAL = False
+
+# Define a function to create the tables and indexes
+
+
+def upgrade(connection):
+    metadata = sa.MetaData()
+    sa.Table(
+        "sales_buckets", metadata,
+        sa.Column("event_id", sa.Integer, primary_key=True),
+        sa.Column("bucket", sa.String, primary_key=True),
+        sa.Column("start", sa.Date, primary_key=True),
+        sa.Column("bookings", sa.Integer, nullable=False),
+        sa.Column("tickets_sold", sa.Integer, nullable=False),
+        sa.Column("invoices", sa.Integer, nullable=False),
+        sa.Column("revenue", sa.Float, nullable=False)
+    )
+    sa.Table(
+        "sales_cached", metadata,
+        sa.Column("event_id", sa.Integer, primary_key=True),
+        sa.Column("bucket", sa.String, primary_key=True),
+        sa.Column("until", sa.Date, nullable=False)
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+    attending = sa.Table("attending", metadata, autoload_with=connection)
+    invoices = sa.Table("invoices", metadata, autoload_with=connection)
+    for index in (sa.Index("ix_attending_timestamp", attending.c.timestamp),
+                  sa.Index("ix_invoices_timestamp", invoices.c.timestamp)):
+        create_index(connection, index)
@@ -0,0 +1,147 @@
+# Schema migrations
+# Each module in this package named NNNN_description.py is one migration,
+# with an upgrade(connection) function that changes the schema. They run in
+# order and each one only once: the schema_migrations table records the ones
+# a database already has. 'flask db create' runs the ones that have not run.
+# A migration runs in a transaction unless its module sets
+# TRANSACTIONAL = False, e.g. to build PostgreSQL indexes CONCURRENTLY,
+# which cannot run in a transaction. Migrations describe the tables as they
+# were when the migration was written, never with the models, so they give
+# the same schema however far the models have moved on since.
+
+# Built-in Python Libraries
+import importlib
+import pkgutil
+import re
+from datetime import datetime, timezone
+
+# External Libraries
+import sqlalchemy as sa
+
+# Constants
+# Name of a migration module, e.g. 0002_indexes
+MODULE_NAME = re.compile(r"^(\d{4})_(\w+)$")
+# Key of the PostgreSQL advisory lock held while migrating, so two servers
+# starting at once do not both run the same migration
+LOCK_KEY = 7300419
+
+# Table recording the migrations a database has
+history = sa.Table(
+    "schema_migrations", sa.MetaData(),
+    sa.Column("version", sa.String, primary_key=True),
+    sa.Column("name", sa.String, nullable=False),
+    sa.Column("applied_at", sa.DateTime, nullable=False)
+)
+
+# Define a function to list the migrations, as (version, name, module) in
+# the order they run
+
+
+def available():
+    found = []
+    for module in pkgutil.iter_modules(__path__):
+        match = MODULE_NAME.match(module.name)
+        if match:
+            found.append((match[1], match[2],
+                          importlib.import_module(f"{__name__}.{module.name}")))
+    return sorted(found, key=lambda migration: migration[0])
+
+# Define a function to get the versions of the migrations a database has
+
+
+def applied(connection):
+    if not sa.inspect(connection).has_table(history.name):
+        return set()
+    return set(connection.scalars(sa.select(history.c.version)))
+
+# Define a function to list every migration and whether it has run, as
+# (version, name, applied) rows
+
+
+def status(engine):
+    with engine.connect() as connection:
+        done = applied(connection)
+    return [(version, name, version in done)
+            for version, name, _ in available()]
+
+# Define a function to run a migration and record it
+
+
+def run(engine, version, name, module):
+    if getattr(module, "TRANSACTIONAL", True):
+        with engine.begin() as connection:
+            module.upgrade(connection)
+            record(connection, version, name)
+        return
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as connection:
+        module.upgrade(connection)
+    with engine.begin() as connection:
+        record(connection, version, name)
+
+# Define a function to record that a migration has run
+
+
+def record(connection, version, name):
+    connection.execute(sa.insert(history).values(
+        version=version, name=name,
+        applied_at=datetime.now(timezone.utc).replace(tzinfo=None)))
+
+# Define a function to run the migrations a database does not have yet.
+# Calls report(version, name) after each one, returns the number run
+
+
+def upgrade(engine, report=lambda version, name: None):
+    postgresql = engine.dialect.name == "postgresql"
+    with engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT") as lock:
+        if postgresql:
+            lock.execute(sa.select(sa.func.pg_advisory_lock(LOCK_KEY)))
+        try:
+            with engine.begin() as connection:
+                history.create(connection, checkfirst=True)
+                done = applied(connection)
+            count = 0
+            for version, name, module in available():
+                if version not in done:
+                    run(engine, version, name, module)
+                    report(version, name)
+                    count += 1
+            return count
+        finally:
+            if postgresql:
+                lock.execute(sa.select(sa.func.pg_advisory_unlock(LOCK_KEY)))
+
+# Define a function to forget every migration, used when the tables are
+# dropped
+
+
+def drop_history(engine):
+    with engine.begin() as connection:
+        history.drop(connection, checkfirst=True)
+
+# Define a function for migrations to create an index if the database does
+# not have it yet. On PostgreSQL the index is built CONCURRENTLY when the
+# migration runs outside a transaction, so the table can still be written
+# to while it builds. An index left invalid by a failed build is dropped
+# and built again
+
+
+def create_index(connection, index):
+    if connection.dialect.name == "postgresql":
+        valid = connection.scalar(sa.text(
+            "SELECT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name"), {"name": index.name})
+        if valid:
+            return
+        autocommit = connection.get_execution_options().get(
+            "isolation_level") == "AUTOCOMMIT"
+        concurrently = " CONCURRENTLY" if autocommit else ""
+        if valid is not None:
+            connection.exec_driver_sql(
+                f"DROP INDEX{concurrently} IF EXISTS {index.name}")
+        index.dialect_options["postgresql"]["concurrently"] = bool(concurrently)
+        index.create(connection)
+        return
+    index.create(connection, checkfirst=True)
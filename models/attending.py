@@ -4,7 +4,8 @@ from marshmallow.validate import OneOf
 from marshmallow.exceptions import ValidationError
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
 
 
 # Constants
@@ -42,7 +43,7 @@ class Attending(db.Model):
     # Foreign key to the 'users' table, indicating which user this record is 
     # associated with
     attending_id = db.Column(
-        db.Integer, db.ForeignKey("users.id"), nullable=False)
+        db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
 
     # Relationships
     # Establish a relationship to the User model, allowing access to the user 
@@ -56,10 +57,19 @@ class Attending(db.Model):
     invoice = db.relationship(
         "Invoice", back_populates="attending", cascade="all, delete")
 
+
+# Index for GET /events/<id>/attending, which lists an event's bookings
+# newest first
+db.Index("ix_attending_event_id_timestamp",
+         Attending.event_id, Attending.timestamp.desc())
+# Index for GET /events/sales, which counts the bookings of every event
+# from a day on
+db.Index("ix_attending_timestamp", Attending.timestamp)
+
 # Schema for serializing and deserializing Attending objects
 
 
-class AttendingSchema(ma.Schema):
+class AttendingSchema(CompiledSchema):
     try:
         # Nested schema for User model, including limited fields
         user = fields.Nested("UserSchema", only=["name", "email", "is_admin"])
@@ -92,81 +102,9 @@ class AttendingSchema(ma.Schema):
                 # Ensure the number of tickets is at least 1
                 raise ValidationError("Please enter a valid number of tickets")
 
-        # Function to validate the number of tickets per seat section
-        @validates("seat_section")
-        def limit_general_admission(self, value):
-            # Validate the number of General Admission tickets to ensure the limit 
-            # is not exceeded.
-            if value == VALID_SEAT_SECTIONS[0]:
-                count = db.session.scalar(
-                    db.select(db.func.count()).select_from(Attending).filter_by(
-                        seat_section=VALID_SEAT_SECTIONS[0])
-                )
-                # Ensure the number of General Admission tickets does not exceed the limit
-                if count > 5:
-                    raise ValidationError(
-                        "No more General Admission tickets available, please select a different seat section"
-                    )
-
-        @validates("seat_section")
-        def limit_section_A(self, value):
-            # Validate the number of Section A tickets to ensure the limit 
-            # is not exceeded.
-            if value == VALID_SEAT_SECTIONS[1]:
-                count = db.session.scalar(
-                    db.select(db.func.count()).select_from(Attending).filter_by(
-                        seat_section=VALID_SEAT_SECTIONS[1])
-                )
-                # Ensure the number of Section A tickets does not exceed the limit
-                if count > 5:
-                    raise ValidationError(
-                        "No more Section A tickets available, please select a different seat section"
-                    )
-
-        @validates("seat_section")
-        def limit_section_B(self, value):
-            # Validate the number of Section B tickets to ensure the limit is not
-            # exceeded.
-            if value == VALID_SEAT_SECTIONS[2]:
-                count = db.session.scalar(
-                    db.select(db.func.count()).select_from(Attending).filter_by(
-                        seat_section=VALID_SEAT_SECTIONS[2])
-                )
-                # Ensure the number of Section B tickets does not exceed the limit
-                if count > 5:
-                    raise ValidationError(
-                        "No more Section B tickets available, please select a different seat section"
-                    )
-
-        @validates("seat_section")
-        def limit_section_C(self, value):
-            # Validate the number of Section C tickets to ensure the limit is 
-            # not exceeded.
-            if value == VALID_SEAT_SECTIONS[3]:
-                count = db.session.scalar(
-                    db.select(db.func.count()).select_from(Attending).filter_by(
-                        seat_section=VALID_SEAT_SECTIONS[3])
-                )
-                # Ensure the number of Section C tickets does not exceed the limit
-                if count > 5:
-                    raise ValidationError(
-                        "No more Section C tickets available, please select a different seat section"
-                    )
-
-        @validates("seat_section")
-        def limit_vip(self, value):
-            # Validate the number of VIP tickets to ensure the limit is 
-            # not exceeded.
-            if value == VALID_SEAT_SECTIONS[4]:
-                count = db.session.scalar(
-                    db.select(db.func.count()).select_from(Attending).filter_by(
-                        seat_section=VALID_SEAT_SECTIONS[4])
-                )
-                # Ensure the number of VIP tickets does not exceed the limit
-                if count > 2:
-                    raise ValidationError(
-                        "No more VIP tickets available, please select a different seat section"
-                    )
+        # Seat availability per section and the per user per event ticket
+        # limit are checked when the booking is saved, see
+        # models/seat_inventory.py
 
         # Meta class to specify which fields to include in the serialized output
         class Meta:
@@ -190,3 +128,11 @@ class AttendingSchema(ma.Schema):
 attending_schema = AttendingSchema()
 # Instantiate a schema for multiple Attending objects
 attendings_schema = AttendingSchema(many=True)
+
+# Loader profile - the relationships AttendingSchema serialises, eager
+# loaded by the attending routes
+attending_loader_profile = {
+    "user": {},
+    "event": {},
+    "invoice": {}
+}
@@ -3,7 +3,8 @@ from marshmallow import fields
 from marshmallow.validate import Regexp, Length, And
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
 
 # Comment model class
 
@@ -24,7 +25,8 @@ class Comment(db.Model):
         # Foreign Keys
         # User ID column - Foreign key referencing the ID attribute from the users table
         # Cannot be null because a comment must be associated with a user
-        user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+        user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False,
+                            index=True)
         # Post ID column - Foreign key referencing the ID attribute from the posts table
         # Cannot be null because a comment must be associated with a post
         post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False)
@@ -38,10 +40,14 @@ class Comment(db.Model):
         # Handle unexpected errors
         print(str(e)), 500
 
+
+# Index for GET /posts/<id>/comments, which lists a post's comments in order
+db.Index("ix_comments_post_id_id", Comment.post_id, Comment.id)
+
 # Create a schema for the Comment model
 
 
-class CommentSchema(ma.Schema):
+class CommentSchema(CompiledSchema):
     try:   
         # A comment is associated with a single user (nested object)
         user = fields.Nested("UserSchema", only=["name", "email"])
@@ -72,3 +78,10 @@ class CommentSchema(ma.Schema):
 comment_schema = CommentSchema()
 # Schema instance for a list of comment objects
 comments_schema = CommentSchema(many=True)
+
+# Loader profile - the relationships CommentSchema serialises (and the ones
+# they serialise in turn), eager loaded by the comment routes
+comment_loader_profile = {
+    "user": {},
+    "post": {"user": {}, "likes": {"user": {}}}
+}
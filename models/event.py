@@ -3,7 +3,9 @@ from marshmallow import fields,validate
 from marshmallow.validate import Regexp, Length, And
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
+from indexes import listing_index
 
 # Table model class for the events table in the DB
 
@@ -30,7 +32,7 @@ class Event(db.Model):
         # from the users table
         # Cannot be null because an event must be associated with a user
         event_admin_id = db.Column(
-            db.Integer, db.ForeignKey("users.id"), nullable=False)
+            db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
 
         # Relationships
         # Link to the User model - An event is associated with a single user
@@ -42,15 +44,29 @@ class Event(db.Model):
         # Link to the Invoice model - An event can have multiple invoices
         invoice = db.relationship(
             "Invoice", back_populates="event", cascade="all, delete")
+        # Link to the SeatInventory model - One seat counter per section
+        seat_inventory = db.relationship(
+            "SeatInventory", back_populates="event", cascade="all, delete")
+        # Link to the TicketLedger model - Tickets held by each user
+        ticket_ledger = db.relationship(
+            "TicketLedger", back_populates="event", cascade="all, delete")
+        # Link to the EventStats model - Tickets sold and revenue
+        stats = db.relationship(
+            "EventStats", back_populates="event", cascade="all, delete",
+            uselist=False)
     except Exception as e:
         # Handle unexpected errors
         print(str(e)), 500
 
+
+# Index for GET /events, which lists events newest first
+listing_index("ix_events_date_id", Event.date, Event.id)
+
 # Schema instance from Marshmallow - Convert DB objects to
 # Python objects and vice versa
 
 
-class EventSchema(ma.Schema):
+class EventSchema(CompiledSchema):
     try:
         # Relationships
         # An event is associated with a single user (nested object)
@@ -105,3 +121,11 @@ class EventSchema(ma.Schema):
 event_schema = EventSchema()
 # Schema for a list of event objects
 events_schema = EventSchema(many=True)
+
+# Loader profile - the relationships EventSchema serialises (and the ones
+# they serialise in turn), eager loaded by the event routes
+event_loader_profile = {
+    "user": {},
+    "attending": {"user": {}},
+    "invoice": {}
+}
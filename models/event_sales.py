@@ -0,0 +1,382 @@
+# Event sales over time
+# Tickets booked and revenue invoiced per day, week or month, for one event
+# or for every event, added up in SQL from the attending and invoices tables
+# with one GROUP BY each. Tickets are counted on the day they were booked
+# (attending.timestamp) and revenue on the day it was invoiced
+# (invoices.timestamp).
+# A bucket is closed once today is past its end. Closed buckets are counted
+# once and kept in the sales_buckets table, so they are read instead of
+# counted again, and only the open buckets are counted on every request.
+# The sales_cached table records, per event and bucket size, the date
+# before which the closed buckets are in sales_buckets (buckets without
+# sales have no row). A booking or invoice dated before today that is
+# inserted, updated or deleted through the session, or with an INSERT of a
+# list of rows, moves that date back to its bucket in the same transaction,
+# so the buckets from there on are counted again on the next request.
+# Anything else that writes to attending or invoices directly should run
+# 'flask db sales --clear'.
+
+# Built-in Python Libraries
+from datetime import date, datetime, timedelta
+
+# External Libraries
+from flask import request
+from marshmallow import fields
+from marshmallow.exceptions import ValidationError
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+
+# Imports from local files
+from init import db
+from compiled_schema import TimedSchema
+from models.attending import Attending
+from models.invoice import Invoice
+from models.event import Event
+
+# Constants
+# Bucket sizes, weeks start on Monday
+BUCKETS = ("day", "week", "month")
+# Event id of the buckets of every event together
+ALL_EVENTS = 0
+# Counted columns of a bucket, in the order they are exported
+SALES_COLUMNS = ["bookings", "tickets_sold", "invoices", "revenue"]
+
+# Sales bucket model class, one row per closed bucket with sales
+
+
+class SalesBucket(db.Model):
+    # Define the table name
+    __tablename__ = "sales_buckets"
+
+    # Table Attributes
+    # The event the sales are of, or ALL_EVENTS. Not a foreign key, the
+    # rows of a deleted event are deleted with it (see event_deleted)
+    event_id = db.Column(db.Integer, primary_key=True)
+    # One of BUCKETS
+    bucket = db.Column(db.String, primary_key=True)
+    # First day of the bucket
+    start = db.Column(db.Date, primary_key=True)
+    # Number of bookings and tickets booked in the bucket
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    tickets_sold = db.Column(db.Integer, nullable=False, default=0)
+    # Number of invoices and the sum of their totals in the bucket
+    invoices = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+# Sales cached model class, one row per event and bucket size that has
+# been read
+
+
+class SalesCached(db.Model):
+    # Define the table name
+    __tablename__ = "sales_cached"
+
+    # Table Attributes
+    # The event, or ALL_EVENTS
+    event_id = db.Column(db.Integer, primary_key=True)
+    # One of BUCKETS
+    bucket = db.Column(db.String, primary_key=True)
+    # The closed buckets starting before this day are in sales_buckets
+    until = db.Column(db.Date, nullable=False)
+
+# Schema for the sales routes
+
+
+class SalesBucketSchema(TimedSchema):
+    # Day after the last day of the bucket
+    end = fields.Method("get_end")
+    # Revenue rounded to cents, the sum of many floats drifts a little
+    revenue = fields.Method("get_revenue")
+
+    def get_end(self, sales):
+        return bucket_end(sales.start, sales.bucket).isoformat()
+
+    def get_revenue(self, sales):
+        return round(sales.revenue, 2)
+
+    # Meta class to define the fields to be included in the schema
+    class Meta:
+        fields = ("start", "end", "bookings", "tickets_sold", "invoices",
+                  "revenue")
+
+
+# Schema for a list of sales buckets
+sales_buckets_schema = SalesBucketSchema(many=True)
+
+# Define a function to read the '?bucket=' query string parameter, day if
+# it is not given
+
+
+def get_bucket():
+    bucket = request.args.get("bucket", "day")
+    if bucket not in BUCKETS:
+        raise ValidationError(
+            {"bucket": [f"Bucket must be one of: {', '.join(BUCKETS)}"]})
+    return bucket
+
+# Define a function to get the first day of the bucket a day is in
+
+
+def bucket_start(day, bucket):
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+# Define a function to get the first day of the bucket after the one
+# starting on 'start'
+
+
+def bucket_end(start, bucket):
+    if bucket == "week":
+        return start + timedelta(days=7)
+    if bucket == "month":
+        return (start + timedelta(days=31)).replace(day=1)
+    return start + timedelta(days=1)
+
+# Define a function to build the SQL expression of the first day of the
+# bucket a date column is in. The bucket is written into the SQL, not
+# bound, so PostgreSQL sees the same expression in SELECT and GROUP BY
+
+
+def bucket_column(column, bucket, dialect):
+    if dialect == "postgresql":
+        if bucket == "day":
+            return db.cast(column, db.Date)
+        return db.cast(db.func.date_trunc(db.literal_column(f"'{bucket}'"),
+                                          column), db.Date)
+    # SQLite date modifiers, Monday is weekday 1
+    modifiers = {"day": [], "week": ["-6 days", "weekday 1"],
+                 "month": ["start of month"]}[bucket]
+    return db.func.date(column, *[db.literal_column(f"'{modifier}'")
+                                  for modifier in modifiers], type_=db.Date)
+
+# Define a function to count the sales of an event (or ALL_EVENTS) per
+# bucket from the attending and invoices tables, with one GROUP BY each.
+# Only counts the days from 'start' and before 'end' when they are given.
+# Returns a list of rows for sales_buckets, oldest first
+
+
+def count_sales(event_id, bucket, start=None, end=None):
+    dialect = db.session.get_bind().dialect.name
+    counted = {}
+    for model, columns in (
+            (Attending, [db.func.count().label("bookings"),
+                         db.func.coalesce(db.func.sum(Attending.total_tickets),
+                                          0).label("tickets_sold")]),
+            (Invoice, [db.func.count().label("invoices"),
+                       db.func.coalesce(db.func.sum(Invoice.total_cost),
+                                        0).label("revenue")])):
+        day = bucket_column(model.timestamp, bucket, dialect)
+        stmt = (db.select(day.label("start"), *columns)
+                .where(model.timestamp.is_not(None)).group_by(day))
+        if event_id != ALL_EVENTS:
+            stmt = stmt.where(model.event_id == event_id)
+        if start is not None:
+            stmt = stmt.where(model.timestamp >= start)
+        if end is not None:
+            stmt = stmt.where(model.timestamp < end)
+        for row in db.session.execute(stmt).mappings():
+            counts = counted.setdefault(row["start"],
+                                        dict.fromkeys(SALES_COLUMNS, 0))
+            counts.update({name: row[name] for name in row if name != "start"})
+    return [{"event_id": event_id, "bucket": bucket, "start": start_day,
+             **counts} for start_day, counts in sorted(counted.items())]
+
+# Define a function to count the closed buckets not in sales_buckets yet
+# and keep them there, in one transaction. Taking the range first (the
+# update of 'until') waits for any booking being written to it, so it is
+# counted. Returns False if another request took it first
+
+
+def cache_closed(event_id, bucket, until, current):
+    table = SalesCached.__table__
+    try:
+        if until is None:
+            db.session.execute(db.insert(table).values(
+                event_id=event_id, bucket=bucket, until=current))
+        elif not db.session.execute(
+                db.update(table)
+                .where(table.c.event_id == event_id, table.c.bucket == bucket,
+                       table.c.until == until)
+                .values(until=current)).rowcount:
+            db.session.rollback()
+            return False
+        buckets = SalesBucket.__table__
+        stale = db.delete(buckets).where(
+            buckets.c.event_id == event_id, buckets.c.bucket == bucket,
+            buckets.c.start < current)
+        if until is not None:
+            stale = stale.where(buckets.c.start >= until)
+        db.session.execute(stale)
+        rows = count_sales(event_id, bucket, until, current)
+        if rows:
+            db.session.execute(db.insert(buckets), rows)
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Another request cached them at the same time
+        db.session.rollback()
+        return False
+
+# Define a function to get the sales of an event (or ALL_EVENTS) per
+# bucket, oldest first. Closed buckets are read from sales_buckets, after
+# counting any that are not there yet, and the open ones are counted
+
+
+def read_sales(event_id, bucket):
+    current = bucket_start(date.today(), bucket)
+    until = db.session.scalar(db.select(SalesCached.until).filter_by(
+        event_id=event_id, bucket=bucket))
+    if (until is None or until < current) and not cache_closed(
+            event_id, bucket, until, current):
+        # Count every bucket rather than wait for the other request
+        return [SalesBucket(**row) for row in count_sales(event_id, bucket)]
+    closed = db.session.scalars(
+        db.select(SalesBucket)
+        .filter_by(event_id=event_id, bucket=bucket)
+        .where(SalesBucket.start < current)
+        .order_by(SalesBucket.start)).all()
+    # Not added to the session, only read
+    return closed + [SalesBucket(**row)
+                     for row in count_sales(event_id, bucket, current)]
+
+# Define a function to uncount the closed buckets from 'days' ({event_id:
+# earliest day written}) on, for those events and ALL_EVENTS, on the
+# connection of the transaction that wrote them
+
+
+def uncache_days(connection, days):
+    days = {event_id: day.date() if isinstance(day, datetime) else day
+            for event_id, day in days.items()
+            if event_id is not None and day is not None}
+    if not days:
+        return
+    today = date.today()
+    days[ALL_EVENTS] = min(days.values())
+    marks = []
+    for bucket in BUCKETS:
+        current = bucket_start(today, bucket)
+        for event_id, day in days.items():
+            start = bucket_start(day, bucket)
+            # Open buckets are never cached
+            if start < current:
+                marks.append({"mark_event_id": event_id, "mark_bucket": bucket,
+                              "mark_start": start})
+    if not marks:
+        return
+    cached, buckets = SalesCached.__table__, SalesBucket.__table__
+    # Always written, even when 'until' does not move, so a request caching
+    # the same buckets waits for this transaction
+    connection.execute(
+        db.update(cached)
+        .where(cached.c.event_id == db.bindparam("mark_event_id"),
+               cached.c.bucket == db.bindparam("mark_bucket"))
+        .values(until=db.case(
+            (cached.c.until > db.bindparam("mark_start"),
+             db.bindparam("mark_start")), else_=cached.c.until)), marks)
+    connection.execute(
+        db.delete(buckets)
+        .where(buckets.c.event_id == db.bindparam("mark_event_id"),
+               buckets.c.bucket == db.bindparam("mark_bucket"),
+               buckets.c.start >= db.bindparam("mark_start")), marks)
+
+# Define a function to note a day of an event written to
+
+
+def note_day(days, event_id, day):
+    if event_id is None or day is None:
+        return
+    if isinstance(day, datetime):
+        day = day.date()
+    if event_id not in days or day < days[event_id]:
+        days[event_id] = day
+
+# Define a function to get the days the session is collecting
+
+
+def session_days(target):
+    session = object_session(target)
+    if session is None:
+        return {}
+    return session.info.setdefault("event_sales", {})
+
+# Define a function to get the value an attribute had before this flush
+
+
+def old_value(target, name):
+    history = db.inspect(target).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, name)
+
+# Note the day of every booking and invoice the session inserts, updates
+# or deletes
+
+
+@event.listens_for(Attending, "after_insert")
+@event.listens_for(Invoice, "after_insert")
+def sale_inserted(mapper, connection, target):
+    note_day(session_days(target), target.event_id, target.timestamp)
+
+
+@event.listens_for(Attending, "after_update")
+@event.listens_for(Invoice, "after_update")
+@event.listens_for(Attending, "after_delete")
+@event.listens_for(Invoice, "after_delete")
+def sale_changed(mapper, connection, target):
+    days = session_days(target)
+    note_day(days, old_value(target, "event_id"),
+             old_value(target, "timestamp"))
+    note_day(days, target.event_id, target.timestamp)
+
+# Uncount the buckets written to by the flush, in the same transaction
+
+
+@event.listens_for(Session, "after_flush")
+def uncache_flushed_sales(session, flush_context):
+    days = session.info.pop("event_sales", None)
+    if days:
+        uncache_days(session.connection(), days)
+
+# Uncount the buckets of an INSERT of bookings or invoices run on the
+# session with a list of rows, e.g. db.session.execute(db.insert(Invoice),
+# rows). Rows without a timestamp are not counted in any bucket
+
+
+@event.listens_for(Session, "do_orm_execute")
+def uncache_executed_sales(orm_execute_state):
+    if not orm_execute_state.is_insert:
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is None or table.name not in ("attending", "invoices"):
+        return
+    rows = orm_execute_state.parameters
+    if isinstance(rows, dict):
+        rows = [rows]
+    days = {}
+    for row in rows or []:
+        note_day(days, row.get("event_id"), row.get("timestamp"))
+    uncache_days(orm_execute_state.session.connection(
+        bind_arguments={"clause": orm_execute_state.statement}), days)
+
+# Delete the buckets of a deleted event
+
+
+@event.listens_for(Event, "after_delete")
+def event_deleted(mapper, connection, target):
+    for table in (SalesBucket.__table__, SalesCached.__table__):
+        connection.execute(db.delete(table).where(
+            table.c.event_id == target.id))
+
+# Define a function to delete every cached bucket, so they are all counted
+# again. Returns the number of buckets deleted
+
+
+def clear_sales():
+    deleted = db.session.execute(db.delete(SalesBucket)).rowcount
+    db.session.execute(db.delete(SalesCached))
+    db.session.commit()
+    return deleted
@@ -0,0 +1,327 @@
+# Event statistics
+# Keeps a row per event with its bookings, tickets sold (in total and per
+# seat section), invoices and revenue, so the stats route and dashboards
+# read one row instead of adding up the attending and invoices tables.
+# Every insert, update and delete of a booking or an invoice changes the
+# row in the same transaction, as an UPDATE that adds the difference
+# ("tickets_sold = tickets_sold + 2"), so concurrent bookings never
+# overwrite each other's counts. That covers the session's flushes,
+# cascades included, and INSERT statements run on the session with a list
+# of rows (the bulk routes and the seed command). Anything else that writes
+# to attending or invoices directly should run 'flask db stats --rebuild'.
+
+# Built-in Python Libraries
+from collections import Counter
+
+# External Libraries
+from marshmallow import fields
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# Imports from local files
+from init import db
+from compiled_schema import TimedSchema
+from models.attending import Attending, VALID_SEAT_SECTIONS
+from models.invoice import Invoice
+from models.event import Event
+from models.seat_inventory import SECTION_CAPACITY, insert_if_missing
+from models.resource_version import mark_changed
+
+# Constants
+# Column holding the tickets sold in each seat section
+SECTION_COLUMNS = {
+    "General Admission": "general_admission_tickets",
+    "Section A": "section_a_tickets",
+    "Section B": "section_b_tickets",
+    "Section C": "section_c_tickets",
+    "VIP": "vip_tickets"
+}
+# Every counter column, in the order they are exported
+COUNTER_COLUMNS = (["bookings", "tickets_sold"]
+                   + [SECTION_COLUMNS[section] for section in VALID_SEAT_SECTIONS]
+                   + ["invoices", "revenue"])
+
+# Event stats model class, one row per event
+
+
+class EventStats(db.Model):
+    # Define the table name
+    __tablename__ = "event_stats"
+
+    # Table Attributes
+    # The event these are the stats of, serves as the primary key
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"),
+                         primary_key=True)
+    # Number of bookings (attending records)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    # Number of tickets booked
+    tickets_sold = db.Column(db.Integer, nullable=False, default=0)
+    # Number of tickets booked in each seat section
+    general_admission_tickets = db.Column(db.Integer, nullable=False, default=0)
+    section_a_tickets = db.Column(db.Integer, nullable=False, default=0)
+    section_b_tickets = db.Column(db.Integer, nullable=False, default=0)
+    section_c_tickets = db.Column(db.Integer, nullable=False, default=0)
+    vip_tickets = db.Column(db.Integer, nullable=False, default=0)
+    # Number of invoices and the sum of their totals
+    invoices = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+
+    # Relationships
+    # Link to the Event model, the stats are deleted with the event
+    event = db.relationship("Event", back_populates="stats")
+
+# Schema for the stats route
+
+
+class EventStatsSchema(TimedSchema):
+    # Revenue rounded to cents, the sum of many floats drifts a little
+    revenue = fields.Method("get_revenue")
+    # Tickets sold, capacity and seats left per seat section
+    sections = fields.Method("get_sections")
+
+    def get_revenue(self, stats):
+        return round(stats.revenue, 2)
+
+    def get_sections(self, stats):
+        return {section: {
+            "tickets_sold": getattr(stats, column),
+            "capacity": SECTION_CAPACITY[section],
+            "available": SECTION_CAPACITY[section] - getattr(stats, column)
+        } for section, column in SECTION_COLUMNS.items()}
+
+    # Meta class to define the fields to be included in the schema
+    class Meta:
+        fields = ("event_id", "bookings", "tickets_sold", "invoices",
+                  "revenue", "sections")
+
+
+# Schema for a single event's stats
+event_stats_schema = EventStatsSchema()
+
+# Define a function to build a query that adds up the stats of events from
+# the attending and invoices tables, with one GROUP BY each. Gives one row
+# per event, with event_id first and then COUNTER_COLUMNS. Pass event_ids to
+# only count those events
+
+
+def stats_query(event_ids=None):
+    section_sums = [
+        db.func.coalesce(db.func.sum(db.case(
+            (Attending.seat_section == section, Attending.total_tickets),
+            else_=0)), 0).label(column)
+        for section, column in SECTION_COLUMNS.items()]
+    bookings = db.select(
+        Attending.event_id,
+        db.func.count().label("bookings"),
+        db.func.coalesce(db.func.sum(Attending.total_tickets),
+                         0).label("tickets_sold"),
+        *section_sums).group_by(Attending.event_id)
+    invoices = db.select(
+        Invoice.event_id,
+        db.func.count().label("invoices"),
+        db.func.coalesce(db.func.sum(Invoice.total_cost),
+                         0).label("revenue")).group_by(Invoice.event_id)
+    if event_ids is not None:
+        bookings = bookings.where(Attending.event_id.in_(event_ids))
+        invoices = invoices.where(Invoice.event_id.in_(event_ids))
+    bookings, invoices = bookings.subquery(), invoices.subquery()
+    columns = [bookings.c[name] if name in bookings.c else invoices.c[name]
+               for name in COUNTER_COLUMNS]
+    stmt = (db.select(Event.id, *[db.func.coalesce(column, 0).label(column.name)
+                                  for column in columns])
+            .outerjoin(bookings, bookings.c.event_id == Event.id)
+            .outerjoin(invoices, invoices.c.event_id == Event.id)
+            .order_by(Event.id))
+    if event_ids is not None:
+        stmt = stmt.where(Event.id.in_(event_ids))
+    return stmt
+
+# Define a function to get an event's stats. Reads its row, or adds up the
+# attending and invoices tables if it has none yet. Returns None if the
+# event does not exist
+
+
+def read_stats(event_id):
+    stats = db.session.get(EventStats, event_id)
+    if stats is not None:
+        return stats
+    row = db.session.execute(stats_query([event_id])).first()
+    if row is None:
+        return None
+    # Not added to the session, only read
+    return EventStats(event_id=event_id, **dict(zip(COUNTER_COLUMNS, row[1:])))
+
+# Define a function to add the changes in 'deltas' ({event_id: Counter of
+# column: change}) to the stats rows, on the connection of the transaction
+# that made them. The changes must already be in the attending and invoices
+# tables. An event without a row yet gets one counted from those tables,
+# minus the changes, which are then added like for every other event, so a
+# row created by another transaction at the same time still gets them
+
+
+def apply_deltas(session, connection, deltas):
+    deltas = {event_id: changes for event_id, changes in deltas.items()
+              if event_id is not None and any(changes.values())}
+    if not deltas:
+        return
+    table = EventStats.__table__
+    event_ids = sorted(deltas)
+    existing = set(connection.scalars(
+        db.select(table.c.event_id).where(table.c.event_id.in_(event_ids))))
+    missing = [event_id for event_id in event_ids if event_id not in existing]
+    if missing:
+        # Events deleted in this transaction have no row to create
+        counted = connection.execute(stats_query(missing)).all()
+        insert_if_missing(EventStats, [{
+            "event_id": row[0],
+            **{column: value - deltas[row[0]].get(column, 0)
+               for column, value in zip(COUNTER_COLUMNS, row[1:])}
+        } for row in counted], ["event_id"], connection=connection)
+    # One statement for every event, always in the same order so two
+    # writers never deadlock
+    connection.execute(
+        db.update(table)
+        .where(table.c.event_id == db.bindparam("stats_event_id"))
+        .values({column: table.c[column] + db.bindparam(f"add_{column}")
+                 for column in COUNTER_COLUMNS}),
+        [{"stats_event_id": event_id,
+          **{f"add_{column}": deltas[event_id].get(column, 0)
+             for column in COUNTER_COLUMNS}}
+         for event_id in event_ids])
+    mark_changed(session, connection, [table.name])
+
+# Define a function to count a booking (sign 1) or take it off (sign -1)
+
+
+def count_booking(deltas, event_id, seat_section, tickets, sign):
+    changes = deltas.setdefault(event_id, Counter())
+    tickets = (tickets or 0) * sign
+    changes["bookings"] += sign
+    changes["tickets_sold"] += tickets
+    if seat_section in SECTION_COLUMNS:
+        changes[SECTION_COLUMNS[seat_section]] += tickets
+
+# Define a function to count an invoice (sign 1) or take it off (sign -1)
+
+
+def count_invoice(deltas, event_id, total_cost, sign):
+    changes = deltas.setdefault(event_id, Counter())
+    changes["invoices"] += sign
+    changes["revenue"] += (total_cost or 0) * sign
+
+# Define a function to get the value an attribute had before this flush
+
+
+def old_value(target, name):
+    history = db.inspect(target).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(target, name)
+
+# Define a function to get the changes the session is collecting
+
+
+def session_deltas(target):
+    session = object_session(target)
+    if session is None:
+        return {}
+    return session.info.setdefault("event_stats", {})
+
+# Count every booking and invoice the session inserts, updates or deletes
+
+
+@event.listens_for(Attending, "after_insert")
+def booking_inserted(mapper, connection, target):
+    count_booking(session_deltas(target), target.event_id,
+                  target.seat_section, target.total_tickets, 1)
+
+
+@event.listens_for(Attending, "after_delete")
+def booking_deleted(mapper, connection, target):
+    count_booking(session_deltas(target), old_value(target, "event_id"),
+                  old_value(target, "seat_section"),
+                  old_value(target, "total_tickets"), -1)
+
+
+@event.listens_for(Attending, "after_update")
+def booking_updated(mapper, connection, target):
+    deltas = session_deltas(target)
+    count_booking(deltas, old_value(target, "event_id"),
+                  old_value(target, "seat_section"),
+                  old_value(target, "total_tickets"), -1)
+    count_booking(deltas, target.event_id, target.seat_section,
+                  target.total_tickets, 1)
+
+
+@event.listens_for(Invoice, "after_insert")
+def invoice_inserted(mapper, connection, target):
+    count_invoice(session_deltas(target), target.event_id,
+                  target.total_cost, 1)
+
+
+@event.listens_for(Invoice, "after_delete")
+def invoice_deleted(mapper, connection, target):
+    count_invoice(session_deltas(target), old_value(target, "event_id"),
+                  old_value(target, "total_cost"), -1)
+
+
+@event.listens_for(Invoice, "after_update")
+def invoice_updated(mapper, connection, target):
+    deltas = session_deltas(target)
+    count_invoice(deltas, old_value(target, "event_id"),
+                  old_value(target, "total_cost"), -1)
+    count_invoice(deltas, target.event_id, target.total_cost, 1)
+
+# Add up the changes of the flush in the same transaction
+
+
+@event.listens_for(Session, "after_flush")
+def apply_flushed_stats(session, flush_context):
+    deltas = session.info.pop("event_stats", None)
+    if deltas:
+        apply_deltas(session, session.connection(), deltas)
+
+# Count the rows of an INSERT of bookings or invoices run on the session
+# with a list of rows, e.g. db.session.execute(db.insert(Attending), rows)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def apply_executed_stats(orm_execute_state):
+    if not orm_execute_state.is_insert:
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is None or table.name not in ("attending", "invoices"):
+        return
+    rows = orm_execute_state.parameters
+    if isinstance(rows, dict):
+        rows = [rows]
+    deltas = {}
+    for row in rows or []:
+        if table.name == "attending":
+            count_booking(deltas, row.get("event_id"),
+                          row.get("seat_section", VALID_SEAT_SECTIONS[0]),
+                          row.get("total_tickets", 1), 1)
+        else:
+            count_invoice(deltas, row.get("event_id"),
+                          row.get("total_cost", 0.0), 1)
+    # Run the INSERT first, the changes are added once they are in the table
+    result = orm_execute_state.invoke_statement()
+    session = orm_execute_state.session
+    apply_deltas(session, session.connection(
+        bind_arguments={"clause": orm_execute_state.statement}), deltas)
+    return result
+
+# Define a function to count every event's stats again from the attending
+# and invoices tables with one query, and replace the rows with them.
+# Returns the number of events
+
+
+def rebuild_stats():
+    rows = db.session.execute(stats_query()).all()
+    db.session.execute(db.delete(EventStats))
+    if rows:
+        db.session.execute(db.insert(EventStats), [
+            {"event_id": row[0], **dict(zip(COUNTER_COLUMNS, row[1:]))}
+            for row in rows])
+    db.session.commit()
+    return len(rows)
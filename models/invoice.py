@@ -2,7 +2,8 @@
 from marshmallow import fields, validate
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
 
 # Table model class for the invoices table in the DB
 
@@ -25,7 +26,7 @@ class Invoice(db.Model):
         # events table
         # Cannot be null because an invoice must be associated with an event
         event_id = db.Column(db.Integer, db.ForeignKey(
-            "events.id"), nullable=False)
+            "events.id"), nullable=False, index=True)
         # Attendee ID column - Foreign key referencing the ID attribute 
         # from the attending table
         # Cannot be null because an invoice must be associated with an attendee
@@ -42,11 +43,19 @@ class Invoice(db.Model):
         # Handle unexpected errors
         print(str(e)), 500
 
+
+# Index for the invoice routes, which find a booking's invoices newest first
+db.Index("ix_invoices_attendee_id_timestamp",
+         Invoice.attendee_id, Invoice.timestamp.desc())
+# Index for GET /events/sales, which counts the invoices of every event
+# from a day on
+db.Index("ix_invoices_timestamp", Invoice.timestamp)
+
 # Schema instance from Marshmallow - Convert DB objects to 
 # Python objects and vice versa
 
 
-class InvoiceSchema(ma.Schema):
+class InvoiceSchema(CompiledSchema):
     try:
         # An invoice is associated with a single event (nested object)
         event = fields.Nested("EventSchema", only=["title", "ticket_price"])
@@ -72,3 +81,10 @@ class InvoiceSchema(ma.Schema):
 invoice_schema = InvoiceSchema()
 # Schema for a list of invoice objects
 invoices_schema = InvoiceSchema(many=True)
+
+# Loader profile - the relationships InvoiceSchema serialises (and the ones
+# they serialise in turn), eager loaded by the invoice routes
+invoice_loader_profile = {
+    "event": {},
+    "attending": {"user": {}}
+}
@@ -0,0 +1,65 @@
+# Background jobs
+# A row per piece of slow work a route handed to the job workers instead of
+# doing it during the request (see jobs.py). The workers take queued jobs
+# from this table, so jobs wait in the database until a worker is free and
+# are not lost when the server restarts.
+
+# Imports from local files
+from init import db
+from compiled_schema import TimedSchema
+
+# Constants
+# Statuses a job goes through, in order. A job ends succeeded or failed
+JOB_STATUSES = ("queued", "running", "succeeded", "failed")
+
+# Job model class, one row per job
+
+
+class Job(db.Model):
+    # Define the table name
+    __tablename__ = "jobs"
+
+    # Table Attributes
+    id = db.Column(db.Integer, primary_key=True)
+    # Name of the job function that does the work, see jobs.py
+    name = db.Column(db.String, nullable=False)
+    # Keyword arguments the job function is called with
+    args = db.Column(db.JSON, nullable=False, default=dict)
+    # One of JOB_STATUSES
+    status = db.Column(db.String, nullable=False, default="queued")
+    # Percent of the work done, reported by the job function
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    # What the job function returned, once it succeeded
+    result = db.Column(db.JSON)
+    # Why the job failed
+    error = db.Column(db.Text)
+    # Number of times a worker has started the job
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Id of the user who queued the job, kept after the user is deleted
+    # (deleting a user is a job itself)
+    user_id = db.Column(db.Integer, index=True)
+    # Name of the worker running the job
+    worker = db.Column(db.String)
+    # Times the job was queued, last started and finished, in UTC
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Last time the worker running the job showed it was still alive
+    heartbeat_at = db.Column(db.DateTime)
+
+
+# Index for the workers, which take the oldest queued job first
+db.Index("ix_jobs_status_id", Job.status, Job.id)
+
+# Schema for the job status route
+
+
+class JobSchema(TimedSchema):
+    # Meta class to define the fields to be included in the schema
+    class Meta:
+        fields = ("id", "name", "status", "progress", "result", "error",
+                  "attempts", "created_at", "started_at", "finished_at")
+
+
+# Schema for a single job
+job_schema = JobSchema()
@@ -2,7 +2,8 @@
 from marshmallow import fields
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
 
 # Table model for the likes table in the DB
 
@@ -19,7 +20,8 @@ class Like(db.Model):
         # Foreign Keys
         # User ID column - Foreign key referencing the ID attribute from the users table
         # Cannot be null because a like must be associated with a user
-        user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+        user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False,
+                            index=True)
         # Post ID column - Foreign key referencing the ID attribute from the posts table
         # Cannot be null because a like must be associated with a post
         post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), nullable=False)
@@ -38,11 +40,15 @@ class Like(db.Model):
         # Handle unexpected errors
         print(str(e)), 500
 
+
+# Index for GET /posts/<id>/likes, also finds whether a user liked a post
+db.Index("ix_likes_post_id_user_id", Like.post_id, Like.user_id)
+
 # Schema instance from Marshmallow - Convert DB objects to 
 # Python objects and vice versa
 
 
-class LikeSchema(ma.Schema):
+class LikeSchema(CompiledSchema):
     try:
         # A like is associated with a single user (nested object)
         user = fields.Nested("UserSchema", only=["name", "email"])
@@ -62,3 +68,10 @@ class LikeSchema(ma.Schema):
 like_schema = LikeSchema()
 # Schema for a list of like objects
 likes_schema = LikeSchema(many=True)
+
+# Loader profile - the relationships LikeSchema serialises, eager loaded by
+# the like routes
+like_loader_profile = {
+    "user": {},
+    "post": {}
+}
@@ -3,7 +3,9 @@ from marshmallow import fields
 from marshmallow.validate import Length, And, Regexp
 
 # Imports from local files
-from init import db, ma
+from init import db
+from compiled_schema import CompiledSchema
+from indexes import listing_index
 
 # Table model for the posts table in the DB
 
@@ -26,12 +28,18 @@ class Post(db.Model):
         location = db.Column(db.String)
         # Image URL column - String data type
         image_url = db.Column(db.String)
+        # Number of likes and comments on the post, kept up to date as they
+        # are added and deleted (see models/post_counts.py)
+        like_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default="0")
+        comment_count = db.Column(db.Integer, nullable=False, default=0,
+                                  server_default="0")
 
         # Foreign Keys
         # Foreign key referencing the ID value from the users table in the DB
         # It cannot be null because a post must be created by a user
         user_id = db.Column(db.Integer, db.ForeignKey(
-            "users.id"), nullable=False)
+            "users.id"), nullable=False, index=True)
 
         # Relationships
         # Link to the User model - A user can have multiple posts
@@ -47,11 +55,15 @@ class Post(db.Model):
         # Handle unexpected errors
         print(str(e)), 500
 
+
+# Index for GET /posts, which lists posts newest first
+listing_index("ix_posts_date_id", Post.date, Post.id)
+
 # Schema instance from Marshmallow - Convert DB objects to Python
 # objects and vice versa
 
 
-class PostSchema(ma.Schema):
+class PostSchema(CompiledSchema):
     try:
         # Relationships
         # A post can have only one user (nested object)
@@ -105,9 +117,12 @@ class PostSchema(ma.Schema):
         class Meta:
             # Fields to be included in the schema
             fields = ("id", "title", "content", "image_url", "date",
-                      "location", "user", "comments", "likes")
+                      "location", "like_count", "comment_count", "user",
+                      "comments", "likes")
             # Marshmallow keeps the order when .dump
             ordered = True
+            # The counts are kept by the database, not set by clients
+            dump_only = ("like_count", "comment_count")
     except Exception as e:
         # Handle unexpected errors
         print(str(e)), 500
@@ -117,3 +132,13 @@ class PostSchema(ma.Schema):
 post_schema = PostSchema()
 # Schema for a list of post objects
 posts_schema = PostSchema(many=True)
+
+# Loader profile - the relationships PostSchema serialises (and the ones
+# they serialise in turn), eager loaded by the post routes with
+# utils.eager_load so a page of posts costs the same number of queries
+# as a single post
+post_loader_profile = {
+    "user": {},
+    "comments": {"user": {}},
+    "likes": {"user": {}}
+}
@@ -0,0 +1,133 @@
+# Post like and comment counts
+# Each post keeps its number of likes and comments in its like_count and
+# comment_count columns, so feeds and the count routes show them without
+# loading every like and comment. Every like and comment the session
+# inserts or deletes changes them in the same transaction, as an UPDATE
+# that adds the difference ("like_count = like_count + 1"), so concurrent
+# likes never overwrite each other's counts. That covers the session's
+# flushes, cascades included, and INSERT statements run on the session with
+# a list of rows (the bulk like route and the seed command), the same way
+# as the event stats (see models/event_stats.py).
+
+# Built-in Python Libraries
+from collections import Counter
+
+# External Libraries
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# Imports from local files
+from init import db
+from models.post import Post
+from models.like import Like
+from models.comment import Comment
+from models.resource_version import mark_changed
+
+# Constants
+# Column of posts counting the rows of each table
+COUNT_COLUMNS = {"likes": "like_count", "comments": "comment_count"}
+
+# Define a function to add the changes in 'deltas' ({post_id: Counter of
+# column: change}) to the posts, on the connection of the transaction that
+# made them. Posts deleted in the same transaction are skipped by the UPDATE
+
+
+def apply_deltas(session, connection, deltas):
+    deltas = {post_id: changes for post_id, changes in deltas.items()
+              if post_id is not None and any(changes.values())}
+    if not deltas:
+        return
+    table = Post.__table__
+    columns = sorted({column for changes in deltas.values()
+                      for column in changes})
+    # One statement for every post, always in the same order so two writers
+    # never deadlock
+    connection.execute(
+        db.update(table)
+        .where(table.c.id == db.bindparam("count_post_id"))
+        .values({column: table.c[column] + db.bindparam(f"add_{column}")
+                 for column in columns}),
+        [{"count_post_id": post_id,
+          **{f"add_{column}": deltas[post_id].get(column, 0)
+             for column in columns}}
+         for post_id in sorted(deltas)])
+    # The counts are part of every post response
+    mark_changed(session, connection, [table.name])
+
+# Define a function to get the changes the session is collecting
+
+
+def session_deltas(target):
+    session = object_session(target)
+    if session is None:
+        return {}
+    return session.info.setdefault("post_counts", {})
+
+# Define a function to count a like or comment (sign 1) or take it off
+# (sign -1)
+
+
+def count_row(mapper, target, sign):
+    column = COUNT_COLUMNS[mapper.local_table.name]
+    session_deltas(target).setdefault(
+        target.post_id, Counter())[column] += sign
+
+# Count every like and comment the session inserts or deletes
+
+
+@event.listens_for(Like, "after_insert")
+@event.listens_for(Comment, "after_insert")
+def row_inserted(mapper, connection, target):
+    count_row(mapper, target, 1)
+
+
+@event.listens_for(Like, "after_delete")
+@event.listens_for(Comment, "after_delete")
+def row_deleted(mapper, connection, target):
+    count_row(mapper, target, -1)
+
+# Move the count when a like or comment is moved to another post
+
+
+@event.listens_for(Like, "after_update")
+@event.listens_for(Comment, "after_update")
+def row_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.post_id.history
+    if history.deleted and history.deleted[0] != target.post_id:
+        column = COUNT_COLUMNS[mapper.local_table.name]
+        deltas = session_deltas(target)
+        deltas.setdefault(history.deleted[0], Counter())[column] -= 1
+        deltas.setdefault(target.post_id, Counter())[column] += 1
+
+# Add up the changes of the flush in the same transaction
+
+
+@event.listens_for(Session, "after_flush")
+def apply_flushed_counts(session, flush_context):
+    deltas = session.info.pop("post_counts", None)
+    if deltas:
+        apply_deltas(session, session.connection(), deltas)
+
+# Count the rows of an INSERT of likes or comments run on the session with
+# a list of rows, e.g. db.session.execute(db.insert(Like), rows)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def apply_executed_counts(orm_execute_state):
+    if not orm_execute_state.is_insert:
+        return
+    table = getattr(orm_execute_state.statement, "table", None)
+    if table is None or table.name not in COUNT_COLUMNS:
+        return
+    rows = orm_execute_state.parameters
+    if isinstance(rows, dict):
+        rows = [rows]
+    column = COUNT_COLUMNS[table.name]
+    deltas = {}
+    for row in rows or []:
+        deltas.setdefault(row.get("post_id"), Counter())[column] += 1
+    result = orm_execute_state.invoke_statement()
+    session = orm_execute_state.session
+    apply_deltas(session, session.connection(
+        bind_arguments={"clause": orm_execute_state.statement}), deltas)
+    return result
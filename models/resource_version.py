@@ -0,0 +1,176 @@
+# Resource versions
+# Keeps a version number per table that goes up every time rows in that
+# table are inserted, updated or deleted. The GET routes build their ETag
+# from the versions of the tables their response is read from, so a client
+# that already has the latest response gets a 304 without the route loading
+# or serialising anything (see conditional_get in utils.py).
+# The versions are bumped once the transaction that changed the tables has
+# committed, in a short transaction of their own on the same connection, so
+# writers to a table never hold its version row locked while they work and
+# a write never needs a second connection from the pool. Until the bump
+# commits a reader may see the new rows under the old version, so a client
+# can get a 304 for a moment after a write. A bump that fails is logged,
+# counted in /metrics and tried again with the next commit on the same
+# database. If the process stops before then the bump is lost and the old
+# ETag is served until the table's next write.
+
+# Built-in Python Libraries
+import threading
+from datetime import datetime, timezone
+
+# External Libraries
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# Imports from local files
+from init import db
+from models.seat_inventory import insert_if_missing
+
+# Names of the tables whose versions are kept, filled in by the GET routes
+# that use them so writes to other tables cost nothing extra
+VERSIONED_TABLES = set()
+
+# Bumps that failed, retried with the next commit, guarded by _failed_lock
+# engine: set of table names
+_failed_bumps = {}
+# Number of bumps that failed since the process started
+_failure_count = 0
+_failed_lock = threading.Lock()
+
+# Resource version model class, one row per table
+
+
+class ResourceVersion(db.Model):
+    # Define the table name
+    __tablename__ = "resource_versions"
+
+    # Table Attributes
+    # Name of the table the version belongs to, serves as the primary key
+    name = db.Column(db.String, primary_key=True)
+    # Number of times the table has been written to
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # Time of the last write to the table, in UTC
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+# Define a function to start keeping versions for some tables
+
+
+def track_versions(names):
+    VERSIONED_TABLES.update(names)
+
+# Define a function to remember that a session's transaction changed some
+# tables, bumped on the session's 'connection' once it commits
+
+
+def mark_changed(session, connection, names):
+    changed = session.info.setdefault("changed_tables", {})
+    changed.setdefault(connection, set()).update(names)
+
+# Define a function to add one to the versions of some tables, in a new
+# transaction on 'connection', which must not be in one already
+
+
+def bump_versions(connection, names):
+    # Always the same order so two bumps never deadlock
+    names = sorted(set(names) & VERSIONED_TABLES)
+    if not names:
+        return
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    stmt = (db.update(ResourceVersion)
+            .where(ResourceVersion.name.in_(names))
+            .values(version=ResourceVersion.version + 1, updated_at=now))
+    with connection.begin():
+        # Tables written to for the first time have no row yet, create them
+        # at version 0 and bump them again
+        if connection.execute(stmt).rowcount < len(names):
+            for name in names:
+                insert_if_missing(ResourceVersion, {
+                    "name": name,
+                    "version": 0,
+                    "updated_at": now
+                }, ["name"], connection=connection)
+            connection.execute(stmt)
+
+# Define a function to read the current versions of some tables, on
+# db.session unless another session is given.
+# Returns a dict of name: (version, updated_at), tables that were never
+# written to are left out
+
+
+def read_versions(names, session=None):
+    rows = (session or db.session).execute(
+        db.select(ResourceVersion.name, ResourceVersion.version,
+                  ResourceVersion.updated_at)
+        .where(ResourceVersion.name.in_(names)))
+    return {name: (version, updated_at) for name, version, updated_at in rows}
+
+# Define a function to remember that a row of a table changed, called for
+# every row the session inserts, updates or deletes, including cascades
+
+
+def record_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        mark_changed(session, connection, [mapper.local_table.name])
+
+
+for change in ("after_insert", "after_update", "after_delete"):
+    event.listen(db.Model, change, record_change, propagate=True)
+
+# Remember the table changed by an insert, update or delete statement run
+# on the session, e.g. db.session.execute(db.update(...))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def record_executed_change(orm_execute_state):
+    if (orm_execute_state.is_insert or orm_execute_state.is_update
+            or orm_execute_state.is_delete):
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None and getattr(table, "name", None):
+            # Same connection as the statement, on the primary database
+            mark_changed(orm_execute_state.session,
+                         orm_execute_state.session.connection(
+                             bind_arguments={
+                                 "clause": orm_execute_state.statement}),
+                         [table.name])
+
+# Define a function to read how many bumps failed and how many tables wait
+# for a retry, for /metrics
+
+
+def bump_failures():
+    with _failed_lock:
+        return _failure_count, sum(len(names) for names in _failed_bumps.values())
+
+# Bump the versions of every table the transaction changed, now that the
+# changes can be read, along with any earlier bumps on the same database
+# that failed. The session still holds its connections until after this
+# hook, so the bump reuses them. The changes are committed already, so a
+# failed bump is kept for the next commit rather than failing the request
+
+
+@event.listens_for(Session, "after_commit")
+def bump_committed_versions(session):
+    global _failure_count
+    changed = session.info.pop("changed_tables", None)
+    for connection, names in (changed or {}).items():
+        engine = connection.engine
+        with _failed_lock:
+            names = names | _failed_bumps.pop(engine, set())
+        try:
+            bump_versions(connection, names)
+        except Exception as e:
+            with _failed_lock:
+                _failed_bumps.setdefault(engine, set()).update(names)
+                _failure_count += 1
+            current_app.logger.error(
+                f"Could not bump the versions of {', '.join(sorted(names))}, "
+                f"retrying with the next commit: {e}")
+
+# Forget the changes of a transaction that was rolled back
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back_versions(session):
+    session.info.pop("changed_tables", None)
@@ -0,0 +1,339 @@
+# Seat inventory
+# Keeps a counter row per event and seat section with the number of tickets
+# still available, and a ledger row per event and user with the number of
+# tickets that user holds. Buying tickets is a conditional UPDATE on each row
+# ("take n tickets if at least n are left"), which the database applies
+# atomically under a row lock, so concurrent purchases can never oversell a
+# section or push a user over MAX_TICKETS_PER_USER for an event.
+
+# Built-in Python Libraries
+from collections import Counter
+
+# External Libraries
+from marshmallow.exceptions import ValidationError
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Imports from local files
+from init import db
+from models.attending import Attending, MAX_TICKETS_PER_USER
+
+
+# Constants
+# Number of tickets available in each seat section of an event. The old
+# per-section validators allowed 6 bookings (3 for VIP) of up to
+# MAX_TICKETS_PER_USER tickets each, these are the same limits in tickets
+SECTION_CAPACITY = {
+    "General Admission": 30,
+    "Section A": 30,
+    "Section B": 30,
+    "Section C": 30,
+    "VIP": 15
+}
+
+# Seat inventory model class, one row per event and seat section
+
+
+class SeatInventory(db.Model):
+    # Define the table name
+    __tablename__ = "seat_inventory"
+    # One counter per event and section
+    __table_args__ = (db.UniqueConstraint("event_id", "seat_section"),)
+
+    # Table Attributes
+    # Unique identifier for each inventory row, serves as the primary key
+    id = db.Column(db.Integer, primary_key=True)
+    # Section this counter belongs to
+    seat_section = db.Column(db.String, nullable=False)
+    # Total number of tickets in the section
+    capacity = db.Column(db.Integer, nullable=False)
+    # Number of tickets still available in the section
+    remaining = db.Column(db.Integer, nullable=False)
+
+    # Foreign Keys
+    # Foreign key to the 'events' table
+    event_id = db.Column(db.Integer, db.ForeignKey(
+        "events.id"), nullable=False)
+
+    # Relationships
+    # Link to the Event model, the inventory is deleted with the event
+    event = db.relationship("Event", back_populates="seat_inventory")
+
+# Ticket ledger model class, one row per event and user
+
+
+class TicketLedger(db.Model):
+    # Define the table name
+    __tablename__ = "ticket_ledger"
+    # One row per event and user, the unique constraint is also the index
+    # used to find it
+    __table_args__ = (db.UniqueConstraint("event_id", "user_id"),)
+
+    # Table Attributes
+    # Unique identifier for each ledger row, serves as the primary key
+    id = db.Column(db.Integer, primary_key=True)
+    # Total number of tickets the user holds for the event
+    tickets = db.Column(db.Integer, nullable=False, default=0)
+
+    # Foreign Keys
+    # Foreign key to the 'events' table
+    event_id = db.Column(db.Integer, db.ForeignKey(
+        "events.id"), nullable=False)
+    # Foreign key to the 'users' table, indexed for deleting a user
+    user_id = db.Column(db.Integer, db.ForeignKey(
+        "users.id"), nullable=False, index=True)
+
+    # Relationships
+    # Link to the Event and User models, rows are deleted with either
+    event = db.relationship("Event", back_populates="ticket_ledger")
+    user = db.relationship("User", back_populates="ticket_ledger")
+
+# Define a function to build an INSERT that does nothing if the row already
+# exists, so two requests creating the same row at once do not fail.
+# 'values' is one row or a list of rows.
+# Runs on the session unless a connection is given
+
+
+def insert_if_missing(model, values, index_elements, connection=None):
+    executor = db.session if connection is None else connection
+    dialect = (db.session.get_bind() if connection is None
+               else connection).dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(model).on_conflict_do_nothing(
+            index_elements=index_elements)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(model).on_conflict_do_nothing(
+            index_elements=index_elements)
+    else:
+        stmt = db.insert(model)
+    rows = values if isinstance(values, list) else [values]
+    if rows:
+        executor.execute(stmt, rows)
+
+# Define a function to create the counter row for an event and section the
+# first time it is used. Tickets booked before the row existed are counted
+# once here so older events keep the right number of seats
+
+
+def ensure_inventory(event_id, seat_section):
+    capacity = SECTION_CAPACITY[seat_section]
+    sold = db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(Attending.total_tickets), 0))
+        .filter_by(event_id=event_id, seat_section=seat_section))
+    insert_if_missing(SeatInventory, {
+        "event_id": event_id,
+        "seat_section": seat_section,
+        "capacity": capacity,
+        "remaining": capacity - sold
+    }, ["event_id", "seat_section"])
+
+# Define a function to create the ledger row for an event and user the first
+# time it is used, counting any tickets booked before the row existed
+
+
+def ensure_ledger(event_id, user_id):
+    held = db.session.scalar(
+        db.select(db.func.coalesce(db.func.sum(Attending.total_tickets), 0))
+        .filter_by(event_id=event_id, attending_id=user_id))
+    insert_if_missing(TicketLedger, {
+        "event_id": event_id,
+        "user_id": user_id,
+        "tickets": held
+    }, ["event_id", "user_id"])
+
+# Define a function to move 'tickets' seats out of (or, when negative, back
+# into) a section. Returns False if there are not enough seats left
+
+
+def adjust_inventory(event_id, seat_section, tickets):
+    for attempt in range(2):
+        result = db.session.execute(
+            db.update(SeatInventory)
+            .where(SeatInventory.event_id == event_id,
+                   SeatInventory.seat_section == seat_section,
+                   SeatInventory.remaining >= tickets)
+            .values(remaining=SeatInventory.remaining - tickets)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 1:
+            return True
+        # No row was updated, either the section is sold out or the counter
+        # row does not exist yet
+        exists = db.session.scalar(
+            db.select(SeatInventory.id).filter_by(
+                event_id=event_id, seat_section=seat_section))
+        if exists is not None:
+            return False
+        ensure_inventory(event_id, seat_section)
+    return False
+
+# Define a function to add 'tickets' to (or, when negative, remove them from)
+# a user's ledger row. Returns False if the user would go over the limit
+
+
+def adjust_ledger(event_id, user_id, tickets):
+    for attempt in range(2):
+        result = db.session.execute(
+            db.update(TicketLedger)
+            .where(TicketLedger.event_id == event_id,
+                   TicketLedger.user_id == user_id,
+                   TicketLedger.tickets + tickets <= MAX_TICKETS_PER_USER)
+            .values(tickets=TicketLedger.tickets + tickets)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 1:
+            return True
+        # Either the user is at the limit or the ledger row does not exist yet
+        exists = db.session.scalar(
+            db.select(TicketLedger.id).filter_by(
+                event_id=event_id, user_id=user_id))
+        if exists is not None:
+            return False
+        ensure_ledger(event_id, user_id)
+    return False
+
+# Define a function to book seats for a user, raising a ValidationError if
+# the section is sold out or the user would hold too many tickets. The
+# caller must roll back the session when an error is raised
+
+
+def reserve_seats(event_id, user_id, seat_section, tickets):
+    change_seats(event_id, user_id, None, 0, seat_section, tickets)
+
+# Define a function to give a user's seats back to the event
+
+
+def release_seats(event_id, user_id, seat_section, tickets):
+    change_seats(event_id, user_id, seat_section, tickets, None, 0)
+
+# Define a function to move a booking from one section and ticket count to
+# another. Counter rows are always updated in the same order (by section
+# name, then the ledger) so two bookings can never wait on each other
+
+
+def change_seats(event_id, user_id, old_section, old_tickets,
+                 new_section, new_tickets):
+    user_id = int(user_id)
+    # Net change per section, positive means seats are taken
+    changes = {}
+    if old_section is not None and old_tickets:
+        changes[old_section] = changes.get(old_section, 0) - old_tickets
+    if new_section is not None and new_tickets:
+        changes[new_section] = changes.get(new_section, 0) + new_tickets
+
+    for seat_section in sorted(changes):
+        if changes[seat_section] and not adjust_inventory(
+                event_id, seat_section, changes[seat_section]):
+            raise ValidationError({"seat_section": [
+                f"No more {seat_section} tickets available, please select a different seat section"
+            ]})
+
+    if new_tickets != old_tickets and not adjust_ledger(
+            event_id, user_id, new_tickets - old_tickets):
+        raise ValidationError({"total_tickets": [
+            f"Maximum {MAX_TICKETS_PER_USER} tickets allowed per user per event"
+        ]})
+
+# Define a function to book seats for many bookings of one event at once.
+# 'bookings' is a list of (user_id, seat_section, tickets). The counter rows
+# are created and locked once for the whole batch, each booking is checked
+# in order against them in memory, then every accepted booking is written
+# with one UPDATE per section and one batched UPDATE of the ledger.
+# Returns one entry per booking, None if it was booked or the error messages
+# if it was not. The caller must roll back the session when an error is raised
+
+
+def reserve_seats_bulk(event_id, bookings):
+    bookings = [(int(user_id), seat_section, tickets)
+                for user_id, seat_section, tickets in bookings]
+    sections = sorted({seat_section for _, seat_section, _ in bookings})
+    user_ids = sorted({user_id for user_id, _, _ in bookings})
+
+    # Create the counter rows that do not exist yet, counting the tickets
+    # booked before they existed, like ensure_inventory and ensure_ledger
+    existing = set(db.session.scalars(
+        db.select(SeatInventory.seat_section)
+        .filter_by(event_id=event_id)
+        .where(SeatInventory.seat_section.in_(sections))))
+    missing = [section for section in sections if section not in existing]
+    if missing:
+        sold = dict(db.session.execute(
+            db.select(Attending.seat_section, db.func.sum(Attending.total_tickets))
+            .filter_by(event_id=event_id)
+            .where(Attending.seat_section.in_(missing))
+            .group_by(Attending.seat_section)).all())
+        insert_if_missing(SeatInventory, [{
+            "event_id": event_id,
+            "seat_section": section,
+            "capacity": SECTION_CAPACITY[section],
+            "remaining": SECTION_CAPACITY[section] - (sold.get(section) or 0)
+        } for section in missing], ["event_id", "seat_section"])
+    existing = set(db.session.scalars(
+        db.select(TicketLedger.user_id)
+        .filter_by(event_id=event_id)
+        .where(TicketLedger.user_id.in_(user_ids))))
+    missing = [user_id for user_id in user_ids if user_id not in existing]
+    if missing:
+        held = dict(db.session.execute(
+            db.select(Attending.attending_id, db.func.sum(Attending.total_tickets))
+            .filter_by(event_id=event_id)
+            .where(Attending.attending_id.in_(missing))
+            .group_by(Attending.attending_id)).all())
+        insert_if_missing(TicketLedger, [{
+            "event_id": event_id,
+            "user_id": user_id,
+            "tickets": held.get(user_id) or 0
+        } for user_id in missing], ["event_id", "user_id"])
+
+    # Read and lock the counters, always in the same order
+    remaining = dict(db.session.execute(
+        db.select(SeatInventory.seat_section, SeatInventory.remaining)
+        .filter_by(event_id=event_id)
+        .where(SeatInventory.seat_section.in_(sections))
+        .order_by(SeatInventory.seat_section).with_for_update()).all())
+    held = dict(db.session.execute(
+        db.select(TicketLedger.user_id, TicketLedger.tickets)
+        .filter_by(event_id=event_id)
+        .where(TicketLedger.user_id.in_(user_ids))
+        .order_by(TicketLedger.user_id).with_for_update()).all())
+
+    # Check each booking in order
+    taken, added, results = Counter(), Counter(), []
+    for user_id, seat_section, tickets in bookings:
+        if remaining[seat_section] < tickets:
+            results.append({"seat_section": [
+                f"No more {seat_section} tickets available, please select a different seat section"
+            ]})
+        elif held[user_id] + tickets > MAX_TICKETS_PER_USER:
+            results.append({"total_tickets": [
+                f"Maximum {MAX_TICKETS_PER_USER} tickets allowed per user per event"
+            ]})
+        else:
+            remaining[seat_section] -= tickets
+            held[user_id] += tickets
+            taken[seat_section] += tickets
+            added[user_id] += tickets
+            results.append(None)
+
+    # Write the accepted bookings, still conditional in case the database
+    # could not lock the rows (SQLite)
+    for seat_section in sorted(taken):
+        if not adjust_inventory(event_id, seat_section, taken[seat_section]):
+            raise ValidationError({"seat_section": [
+                f"No more {seat_section} tickets available, please select a different seat section"
+            ]})
+    if added:
+        ledger = TicketLedger.__table__
+        result = db.session.execute(
+            db.update(ledger)
+            .where(ledger.c.event_id == event_id,
+                   ledger.c.user_id == db.bindparam("ledger_user_id"),
+                   ledger.c.tickets + db.bindparam("added")
+                   <= MAX_TICKETS_PER_USER)
+            .values(tickets=ledger.c.tickets + db.bindparam("added")),
+            [{"ledger_user_id": user_id, "added": count}
+             for user_id, count in sorted(added.items())])
+        # Not every driver can count the rows of a batched UPDATE
+        if (db.session.get_bind().dialect.supports_sane_multi_rowcount
+                and result.rowcount != len(added)):
+            raise ValidationError({"total_tickets": [
+                f"Maximum {MAX_TICKETS_PER_USER} tickets allowed per user per event"
+            ]})
+    return results
@@ -4,6 +4,7 @@ from marshmallow.validate import Regexp, Length, And
 
 # Imports from local files
 from init import db, ma
+from compiled_schema import TimedSchema
 
 
 # Create model class extended from the SQLAlchemy model class
@@ -46,6 +47,9 @@ class User(db.Model):
         # Link to the Attending model - A user can have 0 or multiple attendances
         attending = db.relationship(
             "Attending", back_populates="user", cascade="all, delete")
+        # Link to the TicketLedger model - Tickets held for each event
+        ticket_ledger = db.relationship(
+            "TicketLedger", back_populates="user", cascade="all, delete")
     except Exception as e:
         # Handle unexpected errors
         print(str(e)), 500
@@ -53,7 +57,7 @@ class User(db.Model):
 # Schema instance from Marshmallow - Convert DB objects to Python objects and vice versa
 
 
-class UserSchema(ma.Schema):
+class UserSchema(TimedSchema):
     try:
         # A user can have zero or more posts; list of PostSchema objects
         posts = fields.List(fields.Nested("PostSchema", exclude=["user"]))
@@ -121,3 +125,13 @@ class UserSchema(ma.Schema):
 user_schema = UserSchema(exclude=["password"])
 # Handle a list of user objects
 users_schema = UserSchema(many=True, exclude=["password"])
+
+# Loader profile - the relationships UserSchema serialises (and the ones
+# they serialise in turn), eager loaded by the user routes
+user_loader_profile = {
+    "posts": {"comments": {"user": {}}, "likes": {"user": {}}},
+    "comments": {"post": {"user": {}, "likes": {"user": {}}}},
+    "likes": {"post": {}},
+    "events": {"attending": {"user": {}}, "invoice": {}},
+    "attending": {"event": {}, "invoice": {}}
+}
@@ -0,0 +1,170 @@
+# Read replicas
+# When DATABASE_REPLICA_URLS lists one or more read replicas, GET and HEAD
+# requests read from one of them (picked at random per request) through a
+# SQLAlchemy bind, and everything else uses the primary database. Anything
+# that writes (a flush, an INSERT, UPDATE or DELETE, a SELECT ... FOR UPDATE)
+# always goes to the primary, even during a GET.
+# Replicas lag a little behind the primary, so after a client's own write
+# that client reads from the primary for REPLICA_PIN_SECONDS (read your
+# writes). The client is recognised by its JWT identity within this server
+# process, and by a cookie across processes.
+# GET routes that must read the primary can be decorated with @use_primary.
+
+# Built-in Python Libraries
+import math
+import random
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from functools import wraps
+
+# External Libraries
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+
+# Constants
+# Prefix of the bind keys of the replicas, e.g. replica_1
+REPLICA_PREFIX = "replica_"
+# Cookie holding the time until which the client reads from the primary
+PIN_COOKIE = "read_primary_until"
+# Methods that only read, and can be sent to a replica
+READ_METHODS = ("GET", "HEAD")
+
+# Time until which each user reads from the primary, by JWT identity
+_pins = {}
+_pins_lock = threading.Lock()
+
+# Define a function to build the binds of the replicas from their URLs, each
+# with the same engine options the primary would get for that URL
+
+
+def replica_binds(urls, engine_options):
+    return {f"{REPLICA_PREFIX}{number}": {"url": url, **engine_options(url)}
+            for number, url in enumerate(urls, start=1)}
+
+# Define a function to get the bind key of the replica this request reads
+# from, None to use the primary
+
+
+def current_replica():
+    if has_request_context():
+        return g.get("replica")
+    return None
+
+# Session class that sends reads to the request's replica and writes to the
+# primary
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = current_replica()
+        if replica is not None and bind is None:
+            writes = (self._flushing or getattr(clause, "is_dml", False)
+                      or getattr(clause, "_for_update_arg", None) is not None)
+            if not writes:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+# Define a decorator for GET routes that must read from the primary
+
+
+def use_primary(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        g.replica = None
+        return function(*args, **kwargs)
+    wrapper.use_primary = True
+    return wrapper
+
+# Define a function to check whether the client made a write recently
+
+
+def pinned_to_primary():
+    now = time.time()
+    # Pinned by the cookie, set by any server process
+    try:
+        if float(request.cookies.get(PIN_COOKIE, 0)) > now:
+            return True
+    except ValueError:
+        pass
+    # Pinned by identity, only decode the token when someone is pinned
+    if not _pins:
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+        identity = get_jwt_identity()
+    except Exception:
+        # The route's own JWT check reports bad tokens
+        return False
+    return identity is not None and _pins.get(identity, 0) > now
+
+# Define a function to pick the database a request reads from
+
+
+def choose_database():
+    g.replica = None
+    replicas = current_app.config.get("REPLICA_BIND_KEYS")
+    if not replicas or request.method not in READ_METHODS:
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    if view is None or getattr(view, "use_primary", False):
+        return
+    if not pinned_to_primary():
+        g.replica = random.choice(replicas)
+
+# Define a function to pin a client to the primary after a successful write
+
+
+def pin_after_write(response):
+    if (not current_app.config.get("REPLICA_BIND_KEYS")
+            or request.method in READ_METHODS or request.method == "OPTIONS"
+            or response.status_code >= 400):
+        return response
+    seconds = current_app.config.get("REPLICA_PIN_SECONDS", 5)
+    until = time.time() + seconds
+    response.set_cookie(PIN_COOKIE, f"{until:.3f}", max_age=math.ceil(seconds),
+                        httponly=True, samesite="Lax")
+    try:
+        identity = get_jwt_identity()
+    except Exception:
+        # No JWT on this request, e.g. register or login
+        identity = None
+    if identity is not None:
+        with _pins_lock:
+            _pins[identity] = until
+            # Forget expired pins now and then
+            if len(_pins) > 10000:
+                now = time.time()
+                for key in [key for key, value in _pins.items() if value <= now]:
+                    del _pins[key]
+    return response
+
+# Define a function to copy the primary SQLite database to the SQLite
+# replicas, to try replicas out locally. Returns the replica files written
+
+
+def sync_sqlite_replicas(primary_url, replica_urls):
+    primary = make_url(primary_url)
+    if primary.get_backend_name() != "sqlite":
+        raise ValueError("Only SQLite databases can be copied")
+    written = []
+    with closing(sqlite3.connect(primary.database)) as source:
+        for url in replica_urls:
+            replica = make_url(url)
+            if replica.get_backend_name() != "sqlite":
+                continue
+            with closing(sqlite3.connect(replica.database)) as target:
+                source.backup(target)
+            written.append(replica.database)
+    return written
+
+# Define a function to route an app's reads to its replicas
+
+
+def init_app(app):
+    app.before_request(choose_database)
+    app.after_request(pin_after_write)
@@ -0,0 +1,190 @@
+# Indexed search for the search routes
+# Searching with ilike('%term%') cannot use an index, so every search read
+# the whole table. Each searchable column now gets a search index that the
+# database keeps up to date itself as rows are inserted, updated and deleted:
+# - PostgreSQL: a GIN full text index on to_tsvector('simple', column) for
+#   ranked word and prefix matches, and a GIN pg_trgm index on lower(column)
+#   so partial matches inside a word ('my' finds 'Tommy') are indexed too
+# - SQLite (local development): an FTS5 table kept in sync with triggers,
+#   matching word prefixes ranked with bm25
+# Any other database falls back to the old ilike search.
+
+# Built-in Python Libraries
+import re
+
+# External Libraries
+from sqlalchemy import DDL, event
+
+# Imports from local files
+from init import db
+from models.event import Event
+from models.user import User
+from utils import get_page_args, encode_cursor, decode_cursor
+
+# Constants
+# Columns that can be searched, as (model, column name) pairs
+SEARCH_COLUMNS = [(Event, "title"), (User, "user_name")]
+
+# Define a function to build the names used for a column's search index
+
+
+def index_names(table, column):
+    return {
+        "table": table.name,
+        "column": column,
+        "fts": f"{table.name}_{column}_search",
+        "tsvector": f"ix_{table.name}_{column}_tsvector",
+        "trigram": f"ix_{table.name}_{column}_trigram"
+    }
+
+# Define a function to list the statements that create a column's search
+# index for a database dialect. Every statement can safely be run again
+
+
+def index_statements(dialect, table, column):
+    names = index_names(table, column)
+    if dialect == "postgresql":
+        return [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX IF NOT EXISTS {tsvector} ON {table} USING gin "
+            "(to_tsvector('simple'::regconfig, coalesce({column}, '')))",
+            "CREATE INDEX IF NOT EXISTS {trigram} ON {table} USING gin "
+            "(lower({column}) gin_trgm_ops)"
+        ]
+    if dialect == "sqlite":
+        return [
+            # External content table, the text is read from the real table
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            "{column}, content='{table}', content_rowid='id', prefix='2 3')",
+            # Triggers keep the FTS table in step with the real table
+            "CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} "
+            "BEGIN INSERT INTO {fts}(rowid, {column}) "
+            "VALUES (new.id, new.{column}); END",
+            "CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} "
+            "BEGIN INSERT INTO {fts}({fts}, rowid, {column}) "
+            "VALUES ('delete', old.id, old.{column}); END",
+            "CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} "
+            "ON {table} BEGIN INSERT INTO {fts}({fts}, rowid, {column}) "
+            "VALUES ('delete', old.id, old.{column}); "
+            "INSERT INTO {fts}(rowid, {column}) "
+            "VALUES (new.id, new.{column}); END"
+        ]
+    return []
+
+# Define a function to register a column as searchable. The search index is
+# then created by db.create_all() together with the table
+
+
+def search_index(table, column):
+    for dialect in ("postgresql", "sqlite"):
+        for statement in index_statements(dialect, table, column):
+            # Braces are filled in here, DDL only substitutes %(name)s
+            event.listen(table, "after_create", DDL(
+                statement.format(**index_names(table, column))
+            ).execute_if(dialect=dialect))
+    # The SQLite FTS table is not dropped with the table, drop it first
+    event.listen(table, "before_drop", DDL(
+        "DROP TABLE IF EXISTS {fts}".format(**index_names(table, column))
+    ).execute_if(dialect="sqlite"))
+
+# Define a function to create (or rebuild) a column's search index on a
+# database whose tables already exist, used by 'flask db search_index'
+
+
+def build_search_index(table, column):
+    dialect = db.session.get_bind().dialect.name
+    names = index_names(table, column)
+    for statement in index_statements(dialect, table, column):
+        db.session.execute(db.text(statement.format(**names)))
+    # Index the rows that were added before the FTS table existed
+    if dialect == "sqlite":
+        db.session.execute(db.text(
+            "INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(**names)))
+    db.session.commit()
+    return dialect in ("postgresql", "sqlite")
+
+# Define a function to split a search term into words, the same way the
+# search indexes split the indexed text (letters and digits only)
+
+
+def search_words(term):
+    return re.findall(r"[^\W_]+", term.lower())
+
+# Define a function to build a search query for 'term' on a model's column.
+# Returns a select of (model, score) rows that match, and the score
+# expression, where a higher score is a better match
+
+
+def search_query(model, column, term):
+    table = model.__table__
+    names = index_names(table, column)
+    attribute = getattr(model, column)
+    words = search_words(term)
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == "postgresql":
+        # Written exactly like the index expressions so the indexes are used
+        vector = db.func.to_tsvector(
+            db.literal_column("'simple'::regconfig"),
+            db.func.coalesce(attribute, db.literal_column("''")))
+        # Every word must match, the last one may be the start of a word
+        query = db.func.to_tsquery(
+            db.literal_column("'simple'::regconfig"),
+            " & ".join(f"'{word}':*" for word in words) or "''")
+        # Partial match anywhere in the column, answered by the trigram index
+        escaped = re.sub(r"([\\%_])", r"\\\1", term.lower())
+        contains = db.func.lower(attribute).like(f"%{escaped}%", escape="\\")
+        score = db.cast(db.func.greatest(
+            db.func.ts_rank(vector, query),
+            db.func.similarity(db.func.lower(attribute), term.lower())
+        ), db.Float)
+        stmt = db.select(model, score).filter(
+            db.or_(vector.op("@@")(query), contains))
+        return stmt, score
+
+    if dialect == "sqlite":
+        fts = db.table(names["fts"], db.column("rowid"))
+        # Each word is quoted and matched as a prefix, e.g. "tom"* "mar"*
+        query = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+        # bm25 is lower for better matches, flip it so higher is better
+        score = db.cast(-db.func.bm25(db.literal_column(names["fts"])), db.Float)
+        stmt = db.select(model, score).join(fts, fts.c.rowid == model.id)
+        # An empty query is an FTS syntax error, match nothing instead
+        if not words:
+            return stmt.filter(db.false()), score
+        stmt = stmt.filter(db.literal_column(names["fts"]).op("MATCH")(query))
+        return stmt, score
+
+    # No search index on other databases, use a case insensitive LIKE
+    score = db.cast(db.literal(0), db.Float)
+    stmt = db.select(model, score).filter(attribute.ilike(f"%{term}%"))
+    return stmt, score
+
+# Define a function to fetch one page of search results, best match first.
+# Uses the same 'cursor' and 'limit' query string parameters as paginate,
+# with the cursor holding the score and id of the last result.
+# Returns the matching objects for this page and the next cursor (or None)
+
+
+def paginate_search(stmt, score, id_column):
+    cursor, limit = get_page_args()
+    stmt = stmt.order_by(score.desc(), id_column.desc())
+    # Only select results after the cursor
+    if cursor:
+        last_score, last_id = decode_cursor(cursor, [score, id_column])
+        stmt = stmt.filter(db.or_(
+            score < last_score,
+            db.and_(score == last_score, id_column < last_id)
+        ))
+    # Fetch one extra row to find out whether there is another page
+    rows = db.session.execute(stmt.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last, last_score = rows[-1]
+        next_cursor = encode_cursor([last_score, last.id])
+    return [row[0] for row in rows], next_cursor
+
+# Register the search indexes so db.create_all() creates them
+for model, column in SEARCH_COLUMNS:
+    search_index(model.__table__, column)
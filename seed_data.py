@@ -0,0 +1,249 @@
+# Synthetic data for capacity testing
+# Generates any number of users, events, posts, comments, likes, bookings
+# (attending) and invoices for 'flask db seed --users N ...'. Every row
+# points at rows that exist, and the data follows the same rules as the
+# routes: no more tickets than a section holds (SECTION_CAPACITY), at most
+# MAX_TICKETS_PER_USER tickets and one booking per user per event, at most
+# one like per user per post and one invoice per booking. The seat
+# inventory and ticket ledger rows are not written, the routes create them
+# the first time an event is booked, counting the bookings made before.
+# The same --seed gives the same data, each table has its own random
+# generator so changing one volume does not change the other tables.
+# Rows are made as they are inserted, 'chunk_size' at a time with one
+# multi-row INSERT and a commit per chunk, so memory use stays flat.
+
+# Built-in Python Libraries
+import random
+from datetime import date, timedelta
+from itertools import batched
+
+# Imports from local files
+from init import db, bcrypt
+from models.user import User
+from models.post import Post
+from models.comment import Comment
+from models.like import Like
+from models.event import Event
+from models.attending import Attending, VALID_SEAT_SECTIONS, MAX_TICKETS_PER_USER
+from models.invoice import Invoice
+from models.seat_inventory import SECTION_CAPACITY
+
+# Constants
+# Number of rows inserted and committed at a time
+DEFAULT_CHUNK_SIZE = 10000
+# Password of every generated user, hashed once for all of them
+SEED_PASSWORD = "Abc12345"
+# Dates are spread over the year after this date
+BASE_DATE = date(2024, 1, 1)
+# Words the generated text is made from
+FIRST_NAMES = ["Tom", "Ava", "Liam", "Mia", "Noah", "Zoe", "Jack", "Ella",
+               "Leo", "Ruby", "Oscar", "Isla", "Max", "Chloe", "Sam", "Grace"]
+LAST_NAMES = ["Martin", "Smith", "Jones", "Brown", "Wilson", "Taylor",
+              "Nguyen", "Walker", "White", "Harris", "Lee", "King"]
+EVENT_WORDS = ["Summer", "Winter", "Jazz", "Rock", "Comedy", "Food", "Wine",
+               "Film", "Art", "Tech", "Street", "Night", "Folk", "Dance"]
+EVENT_KINDS = ["Festival", "Night", "Fair", "Show", "Market", "Gala",
+               "Concert", "Expo", "Meetup", "Party"]
+CITIES = ["Adelaide", "Sydney", "Melbourne", "Brisbane", "Perth", "Hobart",
+          "Darwin", "Canberra"]
+SENTENCES = ["Great night out.", "Can't wait for this one!",
+             "Who else is going?", "Tickets are selling fast.",
+             "Best event of the year.", "Bring your friends.",
+             "See you all there.", "Loved every minute."]
+
+# Define a function to make the random generator for one table, so each
+# table only depends on the seed and its own volume
+
+
+def table_random(seed, table):
+    return random.Random(f"{seed}:{table}")
+
+# Define a function to pick a date 'days' days after BASE_DATE at most
+
+
+def random_date(rng, days=365, start=BASE_DATE):
+    return start + timedelta(days=rng.randrange(days))
+
+# Define a function to split 'total' rows over 'parents' parents as evenly as
+# possible, returns the count for parent number 'index'
+
+
+def share(total, parents, index):
+    return total // parents + (1 if index < total % parents else 0)
+
+# Define a function to insert rows from a generator 'chunk_size' at a time,
+# reporting progress after each chunk. Returns the number of rows inserted
+# and, if 'returning' columns are given, their values for each new row in
+# the order the rows were generated
+
+
+def insert_chunks(model, rows, total, chunk_size, report, returning=()):
+    done, returned = 0, []
+    for chunk in batched(rows, chunk_size):
+        stmt = db.insert(model)
+        if returning:
+            stmt = stmt.returning(*returning, sort_by_parameter_order=True)
+            returned.extend(db.session.execute(stmt, list(chunk)).all())
+        else:
+            db.session.execute(stmt, list(chunk))
+        db.session.commit()
+        done += len(chunk)
+        report(model.__tablename__, done, total)
+    return done, returned
+
+# Define the generators for each table, each yields one dict per row
+
+
+def generate_users(rng, count, password):
+    for n in range(1, count + 1):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield {
+            "name": f"{first} {last}",
+            "user_name": f"{first.lower()}{n}",
+            "email": f"user{n}@example.com",
+            "password": password,
+            "dob": date(1960, 1, 1) + timedelta(days=rng.randrange(40 * 365)),
+            # The first user is an admin, to test admin only routes
+            "is_admin": n == 1
+        }
+
+
+def generate_events(rng, count, user_ids):
+    for n in range(1, count + 1):
+        yield {
+            "title": f"{rng.choice(EVENT_WORDS)} {rng.choice(EVENT_KINDS)} {n}",
+            "description": rng.choice(SENTENCES),
+            "date": random_date(rng, start=BASE_DATE + timedelta(days=60)),
+            "ticket_price": rng.choice([0.0, 10.0, 25.0, 49.5, 80.0, 120.0]),
+            "event_admin_id": rng.choice(user_ids)
+        }
+
+
+def generate_posts(rng, count, user_ids):
+    for n in range(1, count + 1):
+        yield {
+            "title": f"post {n}",
+            "content": " ".join(rng.sample(SENTENCES, 2)),
+            "date": random_date(rng),
+            "location": rng.choice(CITIES),
+            "user_id": rng.choice(user_ids)
+        }
+
+
+def generate_comments(rng, count, user_ids, post_ids):
+    for _ in range(count):
+        yield {
+            "content": rng.choice(SENTENCES),
+            "timestamp": random_date(rng),
+            "user_id": rng.choice(user_ids),
+            "post_id": rng.choice(post_ids)
+        }
+
+# Likes are spread evenly over the posts, each from a different user
+
+
+def generate_likes(rng, count, user_ids, post_ids):
+    for index, post_id in enumerate(post_ids):
+        likes = min(share(count, len(post_ids), index), len(user_ids))
+        for user_id in rng.sample(user_ids, likes):
+            yield {"user_id": user_id, "post_id": post_id}
+
+# Bookings are spread evenly over the events, each from a different user,
+# until the event runs out of seats. Yields (booking, ticket price) so the
+# invoice can be made once the booking has an id
+
+
+def generate_attending(rng, count, user_ids, events):
+    for index, (event_id, event_date, price) in enumerate(events):
+        bookings = min(share(count, len(events), index), len(user_ids))
+        remaining = dict(SECTION_CAPACITY)
+        for user_id in rng.sample(user_ids, bookings):
+            sections = [section for section in VALID_SEAT_SECTIONS
+                        if remaining[section]]
+            # Sold out
+            if not sections:
+                break
+            section = rng.choice(sections)
+            tickets = rng.randint(
+                1, min(MAX_TICKETS_PER_USER, remaining[section]))
+            remaining[section] -= tickets
+            yield {
+                "total_tickets": tickets,
+                "seat_section": section,
+                # Booked up to 60 days before the event
+                "timestamp": event_date - timedelta(days=rng.randrange(60)),
+                "event_id": event_id,
+                "attending_id": user_id
+            }, price
+
+# Define a function to insert the bookings with an invoice each, both in the
+# same chunk so a booking never exists without its invoice.
+# Returns the number of bookings made
+
+
+def insert_attending(rows, total, chunk_size, report):
+    done = 0
+    for chunk in batched(rows, chunk_size):
+        bookings = [booking for booking, _ in chunk]
+        ids = db.session.scalars(
+            db.insert(Attending).returning(
+                Attending.id, sort_by_parameter_order=True),
+            bookings).all()
+        db.session.execute(db.insert(Invoice), [{
+            "total_cost": booking["total_tickets"] * price,
+            "timestamp": booking["timestamp"],
+            "event_id": booking["event_id"],
+            "attendee_id": attendee_id
+        } for (booking, price), attendee_id in zip(chunk, ids)])
+        db.session.commit()
+        done += len(chunk)
+        report(Attending.__tablename__, done, total)
+    return done
+
+# Define a function to generate and insert all the data.
+# 'report' is called with (table name, rows done, rows asked for) after each
+# chunk. Returns the number of rows inserted per table
+
+
+def seed_synthetic(users=0, events=0, posts=0, comments=0, likes=0,
+                   attending=0, seed=0, chunk_size=DEFAULT_CHUNK_SIZE,
+                   report=lambda table, done, total: None):
+    # Hash the password once, every user shares it
+    password = bcrypt.generate_password_hash(SEED_PASSWORD).decode("utf-8")
+
+    _, rows = insert_chunks(
+        User, generate_users(table_random(seed, "users"), users, password),
+        users, chunk_size, report, returning=[User.id])
+    user_ids = [user_id for user_id, in rows]
+    counts = dict.fromkeys(["users", "events", "posts", "comments", "likes",
+                            "attending", "invoices"], 0)
+    counts["users"] = len(user_ids)
+    # Everything else belongs to a user
+    if not user_ids:
+        return counts
+
+    # Keep the date and price of each event for its bookings and invoices
+    counts["events"], events = insert_chunks(
+        Event, generate_events(table_random(seed, "events"), events, user_ids),
+        events, chunk_size, report,
+        returning=[Event.id, Event.date, Event.ticket_price])
+    counts["posts"], rows = insert_chunks(
+        Post, generate_posts(table_random(seed, "posts"), posts, user_ids),
+        posts, chunk_size, report, returning=[Post.id])
+    post_ids = [post_id for post_id, in rows]
+
+    if post_ids:
+        counts["comments"], _ = insert_chunks(
+            Comment, generate_comments(table_random(seed, "comments"),
+                                       comments, user_ids, post_ids),
+            comments, chunk_size, report)
+        counts["likes"], _ = insert_chunks(
+            Like, generate_likes(table_random(seed, "likes"), likes,
+                                 user_ids, post_ids),
+            likes, chunk_size, report)
+    if events:
+        counts["attending"] = counts["invoices"] = insert_attending(
+            generate_attending(table_random(seed, "attending"), attending,
+                               user_ids, events),
+            attending, chunk_size, report)
+    return counts
@@ -0,0 +1,150 @@
+# Per-request timing
+# Times every request and splits the time between the database (SQL
+# statements, from SQLAlchemy's cursor events) and serialisation (schema
+# dumps and JSON encoding). Each response gets a Server-Timing header, e.g.
+#   Server-Timing: db;dur=3.2, queries;desc="4", serialise;dur=1.1, total;dur=6.0
+# which the browser's developer tools show next to the request. Time spent
+# running SQL during a dump (lazy loading) counts as database time, not
+# serialisation time. Streamed responses (NDJSON) are timed up to the start
+# of the stream.
+# The same breakdown is sent with the 'request_timed' signal after each
+# request, connect to it to log or collect it, e.g.
+#   @request_timed.connect_via(app)
+#   def log_timing(app, timing, **extra): ...
+# LOG_REQUEST_TIMING logs it for every request at INFO level.
+
+# Built-in Python Libraries
+import logging
+import time
+from contextlib import contextmanager
+
+# External Libraries
+from blinker import Namespace
+from flask import current_app, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Signal sent after each request with the request's timing breakdown
+request_timed = Namespace().signal("request-timed")
+
+# Define a function to get the current request's timings, None outside a
+# request
+
+
+def current_timing():
+    if has_request_context():
+        return g.get("timing")
+    return None
+
+# Define a function to time a block of work under 'name', in milliseconds.
+# Database time spent inside the block is left out, and a block inside a
+# block of the same name (a nested schema dump) is only counted once
+
+
+@contextmanager
+def measure(name):
+    timing = current_timing()
+    if timing is None or name in timing["open"]:
+        yield
+        return
+    timing["open"].add(name)
+    db_before = timing["db"]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        timing[name] = timing.get(name, 0.0) + elapsed - (timing["db"] - db_before)
+        timing["open"].discard(name)
+
+# Time every SQL statement run during a request, on every engine. The start
+# is kept on the statement's execution context, which is dropped with it
+# even when the statement fails and after_cursor_execute never runs
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "statement_start", None)
+    if start is None:
+        return
+    timing = current_timing()
+    if timing is not None:
+        timing["db"] += (time.perf_counter() - start) * 1000
+        timing["queries"] += 1
+
+# JSON provider that times turning a route's return value into JSON
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def response(self, *args, **kwargs):
+        with measure("serialise"):
+            return super().response(*args, **kwargs)
+
+# Define a function to start timing a request
+
+
+def start_request():
+    g.timing = {"start": time.perf_counter(), "db": 0.0, "queries": 0,
+                "serialise": 0.0, "open": set()}
+
+# Define a function to add the Server-Timing header to a response and send
+# the request_timed signal
+
+
+def finish_request(response):
+    app = current_app._get_current_object()
+    timing = g.pop("timing", None)
+    if timing is None:
+        return response
+    breakdown = {
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "total_ms": round((time.perf_counter() - timing["start"]) * 1000, 3),
+        "db_ms": round(timing["db"], 3),
+        "queries": timing["queries"],
+        "serialise_ms": round(timing["serialise"], 3)
+    }
+    if app.config.get("SERVER_TIMING", True):
+        response.headers.add("Server-Timing", ", ".join([
+            f"db;dur={breakdown['db_ms']:.2f}",
+            f"queries;desc=\"{breakdown['queries']}\"",
+            f"serialise;dur={breakdown['serialise_ms']:.2f}",
+            f"total;dur={breakdown['total_ms']:.2f}"
+        ]))
+    request_timed.send(app, timing=breakdown)
+    return response
+
+# Define a function to log a request's timing breakdown, if LOG_REQUEST_TIMING
+# is switched on
+
+
+def log_timing(app, timing, **extra):
+    if not app.config.get("LOG_REQUEST_TIMING"):
+        return
+    app.logger.info("%(method)s %(path)s %(status)s total=%(total_ms).1fms "
+                    "db=%(db_ms).1fms queries=%(queries)s "
+                    "serialise=%(serialise_ms).1fms", timing)
+
+# Define a function to time the requests of an app
+
+
+def init_app(app):
+    # Swap in the timed JSON provider, keeping the app's settings
+    provider = TimedJSONProvider(app)
+    provider.sort_keys = app.json.sort_keys
+    app.json = provider
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    request_timed.connect(log_timing, app)
+    # Flask's logger only shows warnings unless debugging
+    if app.config.get("LOG_REQUEST_TIMING"):
+        app.logger.setLevel(logging.INFO)
@@ -1,21 +1,559 @@
 # Built-in Python Libraries
+import base64
+import csv
+import hashlib
+import io
+import json
+import zlib
+from datetime import timezone
+from functools import lru_cache, wraps
 
 # External Libraries
-from flask_jwt_extended import get_jwt_identity
+from flask import current_app, g, make_response, request, stream_with_context
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from marshmallow.exceptions import ValidationError
 
 # Imports from local files
 from init import db
 from models.user import User
+from models.resource_version import read_versions, track_versions
+
+# Constants
+# Number of rows returned by a listing route when no limit is given
+DEFAULT_PAGE_LIMIT = 50
+# Largest page a client is allowed to request
+MAX_PAGE_LIMIT = 200
+# Largest number of records a bulk route accepts in one request
+MAX_BULK_ITEMS = 1000
+# Number of rows read from the database at a time when streaming
+STREAM_BATCH_SIZE = 500
+# First characters that make a spreadsheet read a CSV cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+# Define a function to get the logged in user. The user is fetched from the
+# DB at most once per request and kept on flask.g for the rest of it
+
+
+def get_current_user():
+    if "current_user" not in g:
+        # Get the users id from get_jwt_identity()
+        user_id = get_jwt_identity()
+        # Fetch the user from the DB with correct id, db.session.get also
+        # reuses the user if this request already loaded it
+        g.current_user = db.session.get(User, int(user_id))
+    return g.current_user
 
 # Define a function to check if the user is an admin
 
 
 def authorise_as_admin():
-    # Get the users id from get_jwt_identity()
-    user_id = get_jwt_identity()
-    # Fetch the user from the DB
-    stmt = db.select(User).filter_by(id=user_id)
-    # Fetch the user from the DB with correct id
-    user = db.session.scalar(stmt)
+    # The access token carries the user's admin status from when they logged
+    # in. If JWT_TRUST_ADMIN_CLAIM is on, use it and skip the DB entirely
+    claims = get_jwt()
+    if current_app.config.get("JWT_TRUST_ADMIN_CLAIM") and "is_admin" in claims:
+        return bool(claims["is_admin"])
+    # Otherwise fetch the user, so admin rights removed since login apply
+    user = get_current_user()
     # Return True if the user is an admin
-    return user.is_admin
+    return bool(user and user.is_admin)
+
+# Define a function to fetch a nested resource and all of its parents in one
+# query, e.g. the event, attending record and invoice of
+# /events/<event_id>/attending/<attending_id>/invoice/<invoice_id>.
+# Each link is a (model, id) pair, parent first. Each model is outer joined
+# to the ones before it through its foreign keys, so a child only matches if
+# it belongs to its parents. Returns one object per link, with None for the
+# first link that was not found and every link after it, so the route can
+# still tell the client exactly which one is missing.
+# Extra loader options, e.g. from eager_load, can be passed with 'options'
+
+
+def resolve_chain(*links, options=()):
+    models = [model for model, _ in links]
+    first_model, first_id = links[0]
+    stmt = db.select(*models).where(first_model.id == first_id)
+    for index, (model, model_id) in enumerate(links[1:], start=1):
+        # Tables of the models already in the query
+        parents = {parent.__table__ for parent in models[:index]}
+        # Join on the id from the URL and every foreign key to a parent
+        conditions = [model.id == model_id] + [
+            model.__table__.c[foreign_key.parent.name] == foreign_key.column
+            for foreign_key in model.__table__.foreign_keys
+            if foreign_key.column.table in parents
+        ]
+        stmt = stmt.outerjoin(model, db.and_(*conditions))
+    row = db.session.execute(stmt.options(*options)).first()
+    # The first link does not exist
+    if row is None:
+        return [None] * len(links)
+    # A missing link leaves everything after it missing too
+    resolved = list(row)
+    for index, value in enumerate(resolved):
+        if value is None:
+            return resolved[:index] + [None] * (len(links) - index)
+    return resolved
+
+# Define a function to turn a loader profile into SQLAlchemy eager loading
+# options. A loader profile is a nested dict that mirrors what a schema
+# serialises, for example {"user": {}, "comments": {"user": {}}} loads each
+# row's user, its comments and each comment's user. Collections are loaded
+# with one extra SELECT ... IN query per relationship (selectinload) and
+# single objects are joined into the parent query (joinedload), so the
+# number of queries no longer grows with the number of rows returned
+
+
+def eager_load(model, profile, parent=None):
+    options = []
+    for name, nested in profile.items():
+        # Look up the relationship on the model, e.g. Post.comments
+        attribute = getattr(model, name)
+        relationship = attribute.property
+        # Collections use selectinload, single objects use joinedload
+        loader = db.selectinload if relationship.uselist else db.joinedload
+        # Chain onto the parent option so nested loads follow the same path
+        option = (loader(attribute) if parent is None
+                  else getattr(parent, loader.__name__)(attribute))
+        # Relationships with no nested profile end the chain here
+        if nested:
+            options.extend(eager_load(
+                relationship.mapper.class_, nested, option))
+        else:
+            options.append(option)
+    return options
+
+# Define a function to build (and remember) a copy of a schema that only
+# dumps some of its fields, so each combination is only built once
+
+
+@lru_cache(maxsize=256)
+def _sparse_schema(schema_class, many, only, exclude):
+    return schema_class(many=many, only=only, exclude=exclude)
+
+# Define a function to read the 'fields' and 'expand' query string parameters
+# and apply them to a schema and its loader profile.
+# ?fields=id,name only returns the listed fields.
+# ?expand=posts,events only returns the listed nested relationships, and
+# ?expand= (empty) returns none of them. Without either parameter the schema
+# and profile are returned unchanged. The loader profile is trimmed to match,
+# so relationships that are not serialised are never loaded from the DB.
+# Returns the schema to dump with and the loader profile to query with
+
+
+def select_fields(schema, profile):
+    fields = request.args.get("fields")
+    expand = request.args.get("expand")
+    # Nothing requested, use the full schema
+    if fields is None and expand is None:
+        return schema, profile
+
+    # Split the comma separated lists, ignoring blanks and spaces
+    def split(value):
+        return {name.strip() for name in value.split(",") if name.strip()}
+
+    # Fields the schema can dump, in the order it dumps them
+    available = list(schema.fields)
+    # Unknown names are a client error
+    errors = {}
+    if fields is not None:
+        unknown = split(fields) - set(available)
+        if unknown:
+            errors["fields"] = [
+                f"Unknown field(s): {', '.join(sorted(unknown))}"]
+    if expand is not None:
+        unknown = split(expand) - set(profile)
+        if unknown:
+            errors["expand"] = [
+                f"Unknown relationship(s): {', '.join(sorted(unknown))}"]
+    if errors:
+        raise ValidationError(errors)
+
+    # Start from the requested fields, or every field
+    selected = [name for name in available
+                if fields is None or name in split(fields)]
+    # Drop relationships that were not asked to be expanded
+    if expand is not None:
+        selected = [name for name in selected
+                    if name not in profile or name in split(expand)]
+
+    # Build the sparse schema, keeping any fields the original excluded
+    sparse = _sparse_schema(type(schema), schema.many, tuple(selected),
+                            tuple(schema.exclude))
+    # Only load the relationships that will be serialised
+    sparse_profile = {name: nested for name, nested in profile.items()
+                      if name in selected}
+    return sparse, sparse_profile
+
+# Define a function to turn the sort key of the last row on a page into an
+# opaque cursor string the client sends back to fetch the next page
+
+
+def encode_cursor(values):
+    # Dates are not JSON serialisable, so store them as ISO strings
+    values = [value.isoformat() if hasattr(value, "isoformat") else value
+              for value in values]
+    # JSON encode the values and make them URL safe
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+# Define a function to turn a cursor string back into the sort key values,
+# converting each value back to the Python type of its column
+
+
+def decode_cursor(cursor, columns):
+    try:
+        # Restore the base64 padding stripped by encode_cursor
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+        # The cursor must hold one value per sort column
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        decoded = []
+        for column, value in zip(columns, values):
+            python_type = column.type.python_type
+            # Dates were stored as ISO strings by encode_cursor
+            if value is not None and hasattr(python_type, "fromisoformat"):
+                value = python_type.fromisoformat(value)
+            elif value is not None:
+                value = python_type(value)
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError):
+        # Any malformed cursor is a client error
+        raise ValidationError({"cursor": ["Invalid pagination cursor"]})
+
+# Define a function to read the 'cursor' and 'limit' query string parameters
+
+
+def get_page_args():
+    # Cursor is optional, no cursor means the first page
+    cursor = request.args.get("cursor") or None
+    # Limit is optional, fall back to the default page size
+    limit = request.args.get("limit", DEFAULT_PAGE_LIMIT)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValidationError({"limit": ["Limit must be a whole number"]})
+    # Limit must be between 1 and the maximum page size
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise ValidationError(
+            {"limit": [f"Limit must be between 1 and {MAX_PAGE_LIMIT}"]})
+    return cursor, limit
+
+# Define a function to order a select statement by sort_column then
+# id_column, and if a cursor is given only select the rows after it.
+# Pass sort_column=None to order by the id column alone
+
+
+def keyset_order(stmt, id_column, sort_column=None, descending=True,
+                 cursor=None):
+    # Columns that make up the sort key, id last as the unique tiebreaker
+    columns = [id_column] if sort_column is None else [sort_column, id_column]
+
+    if sort_column is None:
+        # Order by id only
+        order = [id_column.desc() if descending else id_column.asc()]
+    else:
+        # Rows with no sort value always come after the rest
+        order = [
+            (sort_column.desc() if descending else sort_column.asc()).nulls_last(),
+            id_column.desc() if descending else id_column.asc()
+        ]
+    stmt = stmt.order_by(*order)
+
+    # If a cursor was given, only select rows after it
+    if cursor:
+        values = decode_cursor(cursor, columns)
+        last_id = values[-1]
+        # 'after' means smaller when sorting in descending order
+        if descending:
+            id_after = id_column < last_id
+        else:
+            id_after = id_column > last_id
+        if sort_column is None:
+            stmt = stmt.filter(id_after)
+        elif values[0] is None:
+            # Already in the trailing rows with no sort value
+            stmt = stmt.filter(sort_column.is_(None), id_after)
+        else:
+            sort_after = (sort_column < values[0] if descending
+                          else sort_column > values[0])
+            stmt = stmt.filter(db.or_(
+                sort_after,
+                db.and_(sort_column == values[0], id_after),
+                sort_column.is_(None)
+            ))
+    return stmt
+
+# Define a function to apply keyset (cursor) pagination to a select statement.
+# Rows are ordered by sort_column then id_column, and the next page starts
+# strictly after the last row of the previous page, so every page costs the
+# same as the first one no matter how deep the client has paged.
+# Pass sort_column=None to order by the id column alone.
+# Runs on db.session unless another session is given.
+# Returns the rows for this page and the cursor for the next page (or None)
+
+
+def paginate(stmt, id_column, sort_column=None, descending=True,
+             session=None):
+    cursor, limit = get_page_args()
+    # Columns that make up the sort key, id last as the unique tiebreaker
+    columns = [id_column] if sort_column is None else [sort_column, id_column]
+    stmt = keyset_order(stmt, id_column, sort_column, descending, cursor)
+
+    # Fetch one extra row to find out whether there is another page
+    rows = (session or db.session).scalars(stmt.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(
+            [getattr(last, column.key) for column in columns])
+    return rows, next_cursor
+
+# Define a function to check whether the client asked for a streamed
+# response, with '?stream=1' or an 'Accept: application/x-ndjson' header
+
+
+def wants_stream():
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+    return request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+
+# Define a function to stream the rows of a select statement to the client
+# as newline delimited JSON (NDJSON), one serialised row per line.
+# Only the ids are read through a server side cursor, STREAM_BATCH_SIZE at
+# a time. Each batch of rows is then loaded by id with the statement's
+# loader options, serialised and sent before the next batch is read, so
+# memory use stays the same however many rows there are. (SQLAlchemy cannot
+# combine yield_per on the whole statement with selectinload.)
+# An error part way through is sent as a final {"error": ...} line, because
+# the status code has already been sent
+
+
+def stream_rows(stmt, schema):
+    model = stmt.column_descriptions[0]["entity"]
+    # Run the query now so an error before the first row is still a 500
+    ids = db.session.execute(stmt.with_only_columns(model.id).execution_options(
+        yield_per=STREAM_BATCH_SIZE))
+
+    def generate():
+        try:
+            for batch in ids.partitions():
+                batch_ids = [row[0] for row in batch]
+                rows = {row.id: row for row in db.session.scalars(
+                    stmt.where(model.id.in_(batch_ids)))}
+                # Send the batch in the order of the original statement,
+                # skipping rows deleted since their id was read
+                for row_id in batch_ids:
+                    if row_id in rows:
+                        yield current_app.json.dumps(
+                            schema.dump(rows[row_id], many=False)) + "\n"
+        except Exception as e:
+            yield current_app.json.dumps({"error": str(e)}) + "\n"
+        finally:
+            ids.close()
+
+    # Keep the request (and its DB session) open while the rows are sent
+    return current_app.response_class(
+        stream_with_context(generate()), mimetype="application/x-ndjson")
+
+# Define a function to make a CSV cell safe to open in a spreadsheet. Text
+# starting with a formula character is prefixed with a quote, so e.g. a
+# user named "=HYPERLINK(...)" is shown as text instead of run as a formula
+
+
+def csv_cell(value):
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+# Define a function to stream the rows of a select statement to the client
+# as a CSV file download, under a header row. The rows are read through a
+# server side cursor STREAM_BATCH_SIZE at a time, and each batch is written
+# and sent before the next one is read, so memory use stays the same however
+# many rows there are. If the client accepts gzip the CSV is compressed as
+# it is sent.
+# An error part way through ends the response without finishing the CSV and
+# its gzip stream, so the client can tell the download is incomplete
+
+
+def stream_csv(stmt, header, filename):
+    # Run the query now so an error before the first row is still a 500
+    rows = db.session.execute(
+        stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+    gzip = request.accept_encodings.quality("gzip") > 0
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # wbits=31 writes the gzip header and trailer around the data
+        compressor = zlib.compressobj(wbits=31) if gzip else None
+
+        # Define the function taking what was written so far, ready to send
+        def take():
+            data = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(data) if compressor else data
+
+        try:
+            writer.writerow(header)
+            for batch in rows.partitions():
+                writer.writerows([csv_cell(value) for value in row]
+                                 for row in batch)
+                chunk = take()
+                # The compressor may hold on to a small batch
+                if chunk:
+                    yield chunk
+            yield take() + (compressor.flush() if compressor else b"")
+        finally:
+            rows.close()
+
+    # Keep the request (and its DB session) open while the rows are sent
+    response = current_app.response_class(
+        stream_with_context(generate()), mimetype="text/csv")
+    response.headers["Content-Disposition"] = (
+        f'attachment; filename="{filename}"')
+    if gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+# Define a function to read the body of a bulk route, a JSON array of
+# records, raising a ValidationError if it is not one
+
+
+def get_bulk_items():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        raise ValidationError(
+            {"items": ["Request body must be a non-empty JSON array"]})
+    if len(items) > MAX_BULK_ITEMS:
+        raise ValidationError(
+            {"items": [f"At most {MAX_BULK_ITEMS} records per request"]})
+    # Every record must be a JSON object
+    errors = {index: ["Each record must be a JSON object"]
+              for index, item in enumerate(items) if not isinstance(item, dict)}
+    if errors:
+        raise ValidationError({"items": errors})
+    return items
+
+# Define a function to insert the records of a bulk route with a single
+# INSERT statement and commit them together. The new records are then
+# loaded back with their relationships in one go and serialised.
+# Returns the serialised records in the same order as 'rows'
+
+
+def bulk_insert(model, rows, schema, profile):
+    if not rows:
+        ids = []
+    elif db.session.get_bind().dialect.name == "sqlite":
+        # SQLite sends one INSERT per row when RETURNING has to follow the
+        # order of the rows. Its RETURNING order is not defined, but the
+        # new ids go up in the order the rows are inserted and nothing else
+        # can write while the transaction holds the write lock, so sorting
+        # them puts them back in the order of 'rows'
+        ids = sorted(db.session.scalars(
+            db.insert(model).returning(model.id), rows))
+    else:
+        ids = db.session.scalars(
+            db.insert(model).returning(model.id, sort_by_parameter_order=True),
+            rows).all()
+    db.session.commit()
+    if not ids:
+        return []
+    stmt = db.select(model).where(model.id.in_(ids)).options(
+        *eager_load(model, profile))
+    records = {record.id: record for record in db.session.scalars(stmt)}
+    return [schema.dump(records[record_id]) for record_id in ids]
+
+# Define a function to build the response of a bulk route from one result per
+# record, each either {"status": 201, "data": ...} or
+# {"status": <error code>, "error": ...}. The status code is 201 if every
+# record was created, 400 if none were and 207 (Multi-Status) otherwise
+
+
+def bulk_response(results):
+    created = sum(1 for result in results if result["status"] == 201)
+    if created == len(results):
+        status = 201
+    elif created == 0:
+        status = 400
+    else:
+        status = 207
+    return {
+        "created": created,
+        "failed": len(results) - created,
+        "results": results
+    }, status
+
+# Define a function to list the tables a model and its loader profile read
+# from, e.g. Post with {"user": {}} reads from posts and users
+
+
+def profile_tables(model, profile):
+    tables = {model.__tablename__}
+    for name, nested in profile.items():
+        related = getattr(model, name).property.mapper.class_
+        tables |= profile_tables(related, nested)
+    return tables
+
+# Define a function to answer a GET request that reads from some tables,
+# with a 304 if the client's If-None-Match header matches the latest
+# response, otherwise with what render() returns, see conditional_get.
+# Reads the table versions on db.session unless another session is given
+
+
+def conditional_response(tables, render, session=None):
+    versions = read_versions(tables, session)
+    # Same URL, format and table versions means the same response
+    key = request.full_path + "|" + request.headers.get(
+        "Accept", "") + "|" + ",".join(
+        f"{name}:{versions.get(name, (0, None))[0]}" for name in tables)
+    etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    # Time of the last write to any of the tables, if there was one
+    written = [updated_at for _, updated_at in versions.values()]
+    last_modified = (max(written).replace(tzinfo=timezone.utc)
+                     if written else None)
+
+    # Only the ETag decides, Last-Modified is whole seconds so it
+    # cannot tell apart two writes made in the same second
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+        # Errors are not cached
+        if response.status_code != 200:
+            return response
+    # The client must check back every time, and only it may cache
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    # Collections can be streamed depending on the Accept header
+    response.vary.add("Accept")
+    return response
+
+# Define a decorator for GET routes that adds an ETag and Last-Modified
+# header to their responses and answers a request whose If-None-Match
+# header matches the latest response with a 304.
+# The ETag is built from the request URL and the versions of every table the
+# route's model and loader profile read from, which go up on every write to
+# those tables (see models/resource_version.py). Working that out is one
+# small query, so a 304 skips loading and serialising the response entirely.
+# Place it below @jwt_required() so the client is still authenticated
+
+
+def conditional_get(model, profile):
+    tables = sorted(profile_tables(model, profile))
+    # Keep versions for these tables from now on
+    track_versions(tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return conditional_response(tables, lambda: view(*args, **kwargs))
+        # The tables the ETag is built from, e.g. for asgi.py
+        wrapper.versioned_tables = tables
+        return wrapper
+    return decorator